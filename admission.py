@@ -0,0 +1,157 @@
+"""
+Admission control for inference.
+
+``AdmissionController`` caps how many requests run inference at once and
+how many may wait for a slot. A request that finds the waiting queue full
+is rejected immediately rather than slowing everyone else down. A request
+that is still waiting when its deadline passes, or whose client has
+disconnected, leaves the queue without ever reaching the model. Callers turn
+``Rejected`` into a 503 with ``retry_after`` as the Retry-After header.
+
+Slots are granted in arrival order.
+"""
+import math
+import select
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# How often a waiting request checks whether its client is still there
+CANCEL_POLL_SECONDS = 0.25
+
+
+class Rejected(Exception):
+    """Raised when a request is not admitted.
+
+    ``reason`` is 'queue_full', 'deadline' or 'disconnected'.
+    ``retry_after`` is a suggested wait in whole seconds.
+    """
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(f"Server is busy ({reason.replace('_', ' ')}); retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bound concurrent inference to ``max_concurrent`` with at most
+    ``max_queue`` requests waiting.
+
+    ``default_timeout`` is the longest a request waits for a slot when it
+    does not bring its own deadline.
+    """
+
+    def __init__(self, max_concurrent=4, max_queue=32, default_timeout=10.0):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        self.max_concurrent = int(max_concurrent)
+        self.max_queue = max(0, int(max_queue))
+        self.default_timeout = float(default_timeout)
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._running = 0
+        # Moving average of how long a slot is held, for Retry-After
+        self._hold_seconds = None
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'deadline': 0, 'disconnected': 0}
+
+    @contextmanager
+    def admit(self, deadline=None, cancelled=None):
+        """Hold an inference slot for the ``with`` block.
+
+        ``deadline`` is a ``time.monotonic()`` value; ``cancelled`` is a
+        callable that returns True once the client is gone. Yields the
+        seconds spent waiting. Raises ``Rejected`` without running the block
+        if no slot is granted.
+        """
+        started = time.monotonic()
+        if deadline is None:
+            deadline = started + self.default_timeout
+        ticket = object()
+        with self._cond:
+            if self._running < self.max_concurrent and not self._waiting:
+                self._running += 1
+            else:
+                if len(self._waiting) >= self.max_queue:
+                    raise self._reject('queue_full')
+                self._waiting.append(ticket)
+                self._wait_for_slot(ticket, deadline, cancelled)
+            self.admitted += 1
+        waited = time.monotonic() - started
+
+        try:
+            yield waited
+        finally:
+            held = time.monotonic() - started - waited
+            with self._cond:
+                self._running -= 1
+                self._hold_seconds = held if self._hold_seconds is None else \
+                    0.9 * self._hold_seconds + 0.1 * held
+                self._cond.notify_all()
+
+    def _wait_for_slot(self, ticket, deadline, cancelled):
+        """Wait, holding ``self._cond``, until ``ticket`` is first in line and
+        a slot is free; takes the slot"""
+        while not (self._waiting[0] is ticket and self._running < self.max_concurrent):
+            remaining = deadline - time.monotonic()
+            reason = None
+            if remaining <= 0:
+                reason = 'deadline'
+            elif cancelled is not None and cancelled():
+                reason = 'disconnected'
+            if reason is not None:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+                raise self._reject(reason)
+            self._cond.wait(min(remaining, CANCEL_POLL_SECONDS) if cancelled else remaining)
+        self._waiting.popleft()
+        self._running += 1
+        # The next in line may also fit if several slots freed at once
+        self._cond.notify_all()
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return Rejected(reason, self._retry_after())
+
+    def _retry_after(self):
+        """Seconds until the current queue should have drained"""
+        hold = self._hold_seconds or 1.0
+        return max(1, math.ceil((len(self._waiting) + 1) * hold / self.max_concurrent))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'default_timeout_seconds': self.default_timeout,
+                'running': self._running,
+                'queue_depth': len(self._waiting),
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'mean_hold_seconds': None if self._hold_seconds is None else round(self._hold_seconds, 4),
+            }
+
+
+def client_disconnected(environ):
+    """Best-effort check whether the HTTP client behind ``environ`` has gone.
+
+    Works with servers that expose the connection socket (werkzeug, and so
+    ``model_server.py``, and gunicorn). Call it only after the request body
+    has been read: an orderly close then shows up as a readable socket with
+    nothing to read. Returns False when the socket is not available.
+    """
+    sock = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # TLS sockets cannot peek; assume the client is still there
+        return False
+    except OSError:
+        return True
@@ -1,12 +1,33 @@
+import io
 import os
+import mimetypes
 import numpy as np
-import cv2
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from xgboost import XGBClassifier
-from sklearn.preprocessing import LabelEncoder
-from werkzeug.utils import secure_filename
-from datetime import datetime
+from flask import Flask, Response, abort, g, render_template, request, jsonify, send_from_directory, url_for
+from werkzeug.security import safe_join
+import hmac
 import json
+import threading
+import time
+import zipfile
+from collections import deque
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from batching import MicroBatcher
+from cascade import CascadeClassifier
+from compiled_backend import padded_batch_sizes
+from preprocessing import WIDTH, HEIGHT, BufferPool, load_resized, prepare_image_bytes
+from upload_writer import BackgroundWriter
+from upload_store import UploadStore
+from prediction_cache import PredictionCache, content_hash, model_fingerprint
+from near_duplicate import NearDuplicateIndex
+from tiling import decode_for_tiling, predict_tiles
+from static_assets import DEFAULT_OUTPUT, ENCODINGS, PageCache, load_manifest, negotiate
+from model_registry import ModelRegistry
+from feature_store import FeatureStore, FeatureWriter
+from admission import AdmissionController, Rejected, client_disconnected
+from jobs import JobRunner, MemoryJobStore, QueueFull, SQLiteJobStore
+from metrics import MetricsRegistry
 
 app = Flask(__name__)
 
@@ -15,33 +36,196 @@ UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# How uploads are kept: 'sync' saves on the request thread, 'background'
+# hands the bytes to a writer thread and 'none' never touches the disk.
+# Predictions always decode straight from the uploaded bytes.
+app.config['UPLOAD_PERSIST'] = os.environ.get('LEAF_UPLOAD_PERSIST', 'background')
+# Uploads are stored once per distinct content (see upload_store.py). The
+# oldest are evicted past UPLOAD_MAX_BYTES or UPLOAD_MAX_AGE; 0 disables a limit.
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('LEAF_UPLOAD_MAX_BYTES', 2 * 1024 ** 3))
+app.config['UPLOAD_MAX_AGE'] = float(os.environ.get('LEAF_UPLOAD_MAX_AGE_DAYS', 30)) * 24 * 3600
+# In background mode a name is handed out before its file is written. Under
+# model_server another worker may still be writing it, so /uploads waits this
+# many seconds for the file before answering 404.
+UPLOAD_PENDING_WAIT = 0.5
+# Decode large JPEGs at 1/2, 1/4 or 1/8 scale (never below the model input
+# size). Much faster for phone photos, but pixels differ slightly from a
+# full-resolution decode, so it is opt-in.
+app.config['REDUCED_DECODE'] = os.environ.get('LEAF_REDUCED_DECODE', '0') == '1'
 
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Load models
+# Static assets are served from a content-hashed, precompressed build (see
+# static_assets.py), rebuilt at startup when a source file changed unless
+# LEAF_ASSETS_AUTOBUILD=0. Pages that never change are rendered once.
+app.config['STATIC_BUILD_DIR'] = os.environ.get('LEAF_STATIC_BUILD', DEFAULT_OUTPUT)
+app.config['ASSETS_AUTOBUILD'] = os.environ.get('LEAF_ASSETS_AUTOBUILD', '1') == '1'
+app.config['PAGE_MAX_AGE'] = int(os.environ.get('LEAF_PAGE_MAX_AGE', 300))
+
+# Inference batching: concurrent /api/predict requests arriving within
+# BATCH_MAX_WAIT_MS of each other share one CNN and one XGBoost call.
+app.config['BATCHING_ENABLED'] = os.environ.get('LEAF_BATCHING', '1') == '1'
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('LEAF_BATCH_MAX_SIZE', 16))
+app.config['BATCH_MAX_WAIT_MS'] = float(os.environ.get('LEAF_BATCH_MAX_WAIT_MS', 5))
+# /api/predict/batch: request size limit and parallel decode threads
+app.config['BATCH_MAX_CONTENT_LENGTH'] = 256 * 1024 * 1024  # 256MB max batch upload
+app.config['BATCH_DECODE_WORKERS'] = int(os.environ.get('LEAF_BATCH_DECODE_WORKERS', os.cpu_count() or 4))
+# Zip archives are read entry by entry as the stream reaches them; a batch
+# over either limit is refused with 413 before anything is decompressed
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('LEAF_BATCH_MAX_FILES', 1000))
+app.config['BATCH_MAX_UNCOMPRESSED'] = int(os.environ.get('LEAF_BATCH_MAX_UNCOMPRESSED', 1024 * 1024 * 1024))
+# /api/predict/tiled: large field images are cut into overlapping tiles;
+# mostly-background tiles are skipped and the rest scored TILE_BATCH_SIZE
+# at a time. Images are decoded at no more than TILE_MAX_PIXELS, and scored
+# at a reduced scale if they would cut into more than TILE_MAX_TILES tiles.
+app.config['TILE_MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024  # 64MB max field image
+app.config['TILE_BATCH_SIZE'] = int(os.environ.get('LEAF_TILE_BATCH_SIZE', 32))
+app.config['TILE_OVERLAP'] = float(os.environ.get('LEAF_TILE_OVERLAP', 0.25))
+app.config['TILE_MIN_LEAF_FRACTION'] = float(os.environ.get('LEAF_TILE_MIN_LEAF', 0.15))
+app.config['TILE_MAX_PIXELS'] = int(os.environ.get('LEAF_TILE_MAX_PIXELS', 50_000_000))
+app.config['TILE_MAX_TILES'] = int(os.environ.get('LEAF_TILE_MAX_TILES', 1024))
+TILE_MAX_OVERLAP = 0.5
+
+# Load models (from the parent directory unless LEAF_MODEL_DIR says otherwise)
 BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-cnn_feature_extractor = None
-xgb_classifier = None
-label_encoder = None
-
-try:
-    from tensorflow.keras.models import load_model
-    cnn_feature_extractor = load_model(os.path.join(BASE_PATH, "cnn_feature_extractor.h5"))
-    xgb_classifier = XGBClassifier()
-    xgb_classifier.load_model(os.path.join(BASE_PATH, "xgb_classifier_model.json"))
-    label_encoder_classes = np.load(os.path.join(BASE_PATH, "label_encoder_classes.npy"), allow_pickle=True)
-    label_encoder = LabelEncoder()
-    label_encoder.classes_ = label_encoder_classes
-    print("✓ Models loaded successfully!")
-    MODELS_LOADED = True
-except Exception as e:
-    print(f"✗ Warning: Models not yet available: {e}")
-    print("ℹ Models will be loaded on first prediction attempt")
-    MODELS_LOADED = False
-
-# Image processing parameters
-WIDTH, HEIGHT = 224, 224
+MODEL_DIR = os.environ.get('LEAF_MODEL_DIR', BASE_PATH)
+CNN_MODEL_PATH = os.path.join(MODEL_DIR, "cnn_feature_extractor.h5")
+XGB_MODEL_PATH = os.path.join(MODEL_DIR, "xgb_classifier_model.json")
+LABEL_ENCODER_PATH = os.path.join(MODEL_DIR, "label_encoder_classes.npy")
+MODEL_PATHS = [CNN_MODEL_PATH, XGB_MODEL_PATH, LABEL_ENCODER_PATH]
+
+# Prediction cache keyed by a hash of the uploaded bytes. Set
+# LEAF_CACHE_DB to a file path to keep results across restarts.
+app.config['PREDICTION_CACHE_ENABLED'] = os.environ.get('LEAF_CACHE', '1') == '1'
+app.config['PREDICTION_CACHE_SIZE'] = int(os.environ.get('LEAF_CACHE_SIZE', 4096))
+app.config['PREDICTION_CACHE_TTL'] = float(os.environ.get('LEAF_CACHE_TTL', 24 * 3600))
+app.config['PREDICTION_CACHE_DB'] = os.environ.get('LEAF_CACHE_DB', '')
+# Rows kept in LEAF_CACHE_DB; expired and excess rows are purged every
+# LEAF_CACHE_DB_PURGE_INTERVAL writes
+app.config['PREDICTION_CACHE_DB_SIZE'] = int(os.environ.get('LEAF_CACHE_DB_SIZE', 100000))
+app.config['PREDICTION_CACHE_DB_PURGE_INTERVAL'] = int(os.environ.get('LEAF_CACHE_DB_PURGE_INTERVAL', 1000))
+
+# Near-duplicate reuse: uploads whose perceptual hash is within
+# NEAR_DUPLICATE_DISTANCE bits of an earlier one reuse its result.
+app.config['NEAR_DUPLICATE_ENABLED'] = os.environ.get('LEAF_NEAR_DUP', '0') == '1'
+app.config['NEAR_DUPLICATE_DISTANCE'] = int(os.environ.get('LEAF_NEAR_DUP_DISTANCE', 4))
+app.config['NEAR_DUPLICATE_SIZE'] = int(os.environ.get('LEAF_NEAR_DUP_SIZE', 10000))
+
+# CNN backend: 'keras' runs the .h5 model, 'compiled' runs it through a
+# fixed-signature tf.function (see compiled_backend.py; LEAF_XLA=1 adds XLA
+# compilation), 'tflite' runs a converted model (see tflite_backend.py)
+# with LEAF_TFLITE_THREADS interpreter threads
+app.config['CNN_BACKEND'] = os.environ.get('LEAF_CNN_BACKEND', 'keras')
+app.config['XLA_ENABLED'] = os.environ.get('LEAF_XLA', '0') == '1'
+# TensorFlow thread pools for the keras and compiled backends; 0 keeps
+# TensorFlow's default of one thread per core
+app.config['TF_INTRA_OP_THREADS'] = int(os.environ.get('LEAF_TF_INTRA_OP_THREADS', 0))
+app.config['TF_INTER_OP_THREADS'] = int(os.environ.get('LEAF_TF_INTER_OP_THREADS', 0))
+app.config['TFLITE_MODEL_PATH'] = os.environ.get('LEAF_TFLITE_MODEL',
+                                                 os.path.join(MODEL_DIR, "cnn_feature_extractor.tflite"))
+app.config['TFLITE_NUM_THREADS'] = int(os.environ.get('LEAF_TFLITE_THREADS', os.cpu_count() or 1))
+if app.config['CNN_BACKEND'] == 'tflite':
+    MODEL_PATHS.append(app.config['TFLITE_MODEL_PATH'])
+
+# Classifier engine: 'xgboost' scores with the XGBoost booster, 'numpy'
+# with the vectorized tree evaluator in tree_engine.py
+app.config['CLASSIFIER_ENGINE'] = os.environ.get('LEAF_CLASSIFIER_ENGINE', 'xgboost')
+
+# Cascade: when LEAF_CASCADE_MODEL names a model trained by cascade.py, a
+# cheap colour/texture classifier answers confident uploads before the CNN
+app.config['CASCADE_MODEL_PATH'] = os.environ.get('LEAF_CASCADE_MODEL', '')
+if app.config['CASCADE_MODEL_PATH']:
+    MODEL_PATHS.append(app.config['CASCADE_MODEL_PATH'])
+
+# Feature projection: when LEAF_PROJECTION names an existing file written
+# by projection.py, CNN features are reduced by it before the classifier.
+# The classifier must have been trained on the same projection.
+app.config['PROJECTION_PATH'] = os.environ.get('LEAF_PROJECTION', os.path.join(MODEL_DIR, "feature_projection.npz"))
+MODEL_PATHS.append(app.config['PROJECTION_PATH'])
+
+# Model hot-swap: the model files are checked every MODEL_WATCH_INTERVAL
+# seconds (0 turns this off) and, when they change, loaded and warmed up
+# next to the serving models before replacing them. POST
+# /admin/models/reload does the same on demand. With ADMIN_TOKEN set, /admin
+# requests must send it as a Bearer token; without it they must come from
+# this machine.
+app.config['MODEL_WATCH_INTERVAL'] = float(os.environ.get('LEAF_MODEL_WATCH_INTERVAL', 10))
+app.config['ADMIN_TOKEN'] = os.environ.get('LEAF_ADMIN_TOKEN', '')
+
+# Feature store: when set, CNN features of every upload are appended to this
+# directory so a new classifier can be run over them (see feature_store.py)
+app.config['FEATURE_STORE_PATH'] = os.environ.get('LEAF_FEATURE_STORE', '')
+
+# Asynchronous jobs (/api/jobs): JOBS_WORKERS predictions run at once and at
+# most JOBS_MAX_PENDING wait. Job state is kept in memory, or in the SQLite
+# file JOBS_DB, which is required when several worker processes serve the API
+# (model_server.py sets one up for its workers if it is unset).
+app.config['JOBS_WORKERS'] = int(os.environ.get('LEAF_JOBS_WORKERS', 2))
+app.config['JOBS_MAX_PENDING'] = int(os.environ.get('LEAF_JOBS_MAX_PENDING', 64))
+app.config['JOBS_TTL'] = float(os.environ.get('LEAF_JOBS_TTL', 3600))
+app.config['JOBS_DB'] = os.environ.get('LEAF_JOBS_DB', '')
+
+# Admission control for /api/predict: at most MAX_CONCURRENT requests decode
+# and predict at once, at most MAX_QUEUE wait for a slot, and none waits
+# longer than QUEUE_TIMEOUT seconds (or the client's X-Request-Timeout, if
+# shorter). Anything beyond that gets a fast 503 with Retry-After.
+app.config['ADMISSION_MAX_CONCURRENT'] = int(os.environ.get('LEAF_MAX_CONCURRENT',
+                                                            app.config['BATCH_MAX_SIZE']))
+app.config['ADMISSION_MAX_QUEUE'] = int(os.environ.get('LEAF_MAX_QUEUE', 64))
+app.config['ADMISSION_QUEUE_TIMEOUT'] = float(os.environ.get('LEAF_QUEUE_TIMEOUT', 10))
+
+# Metrics, exported on /metrics in Prometheus text format. Under a
+# multi-process server point LEAF_METRICS_DIR at a directory shared by all
+# workers (and emptied on start) so every scrape sees every worker.
+app.config['METRICS_DIR'] = os.environ.get('LEAF_METRICS_DIR', '')
+metrics = MetricsRegistry(app.config['METRICS_DIR'] or None)
+HTTP_REQUESTS = metrics.counter('leaf_http_requests_total', 'HTTP requests by endpoint and status code',
+                                ['endpoint', 'status'])
+HTTP_REQUEST_SECONDS = metrics.histogram('leaf_http_request_seconds',
+                                         'Time until the response headers were ready', ['endpoint'])
+HTTP_IN_FLIGHT = metrics.gauge('leaf_http_requests_in_flight', 'Requests currently being handled', ['endpoint'])
+STAGE_SECONDS = metrics.histogram('leaf_stage_seconds',
+                                  'Time per prediction stage; cnn and classifier are per batch', ['stage'])
+PREDICTIONS = metrics.counter('leaf_predictions_total', 'Predictions by disease and result source',
+                              ['disease', 'source'])
+PREDICTION_ERRORS = metrics.counter('leaf_prediction_errors_total', 'Failed predictions by the stage that failed',
+                                    ['stage'])
+MODEL_TIMINGS = metrics.gauge('leaf_model_timing_seconds', 'Model import, load and warm-up durations',
+                              ['phase'], mode='all')
+ADMISSION_QUEUE_DEPTH = metrics.gauge('leaf_admission_queue_depth', 'Requests waiting for an inference slot')
+ADMISSION_RUNNING = metrics.gauge('leaf_admission_running', 'Requests holding an inference slot')
+ADMISSION_WAIT_SECONDS = metrics.histogram('leaf_admission_wait_seconds',
+                                           'Time admitted requests waited for an inference slot')
+ADMISSION_REJECTED = metrics.counter('leaf_admission_rejected_total',
+                                     'Requests turned away by reason: queue_full, deadline or disconnected',
+                                     ['reason'])
+MODEL_READY = metrics.gauge('leaf_model_ready', '1 once the models are loaded and warmed up', mode='all')
+
+# Models are loaded lazily, once, by the registry. A warm-up inference runs
+# on a background thread when the server starts (or on the first request
+# under a WSGI server); /readyz reports when it has finished.
+registry = ModelRegistry(CNN_MODEL_PATH, XGB_MODEL_PATH, LABEL_ENCODER_PATH,
+                         classifier_engine=app.config['CLASSIFIER_ENGINE'],
+                         input_shape=(HEIGHT, WIDTH, 3),
+                         cnn_backend=app.config['CNN_BACKEND'],
+                         tflite_path=app.config['TFLITE_MODEL_PATH'],
+                         tflite_threads=app.config['TFLITE_NUM_THREADS'],
+                         intra_op_threads=app.config['TF_INTRA_OP_THREADS'],
+                         inter_op_threads=app.config['TF_INTER_OP_THREADS'],
+                         xla=app.config['XLA_ENABLED'],
+                         warmup_batch_sizes=padded_batch_sizes(app.config['BATCH_MAX_SIZE']),
+                         projection_path=app.config['PROJECTION_PATH'],
+                         cascade_path=app.config['CASCADE_MODEL_PATH'] or None)
+
+@metrics.on_collect
+def collect_model_metrics():
+    if _model_client is not None:
+        # The model server process reports its own model metrics
+        return
+    MODEL_READY.set(1 if registry.ready else 0)
+    for phase, seconds in registry.timings.items():
+        MODEL_TIMINGS.set(seconds, phase.replace('_seconds', ''))
 
 # Disease information
 DISEASE_INFO = {
@@ -265,51 +449,487 @@ DISEASE_INFO = {
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_image(image_path):
-    """Process image for model prediction"""
-    img = cv2.imread(image_path)
-    if img is None:
-        raise ValueError(f"Image not found at path: {image_path}")
-    img = cv2.resize(img, (WIDTH, HEIGHT))
-    img = img / 255.0
-    img = np.expand_dims(img, axis=0)
-    return img
+def predict_batch(images, keys=None):
+    """Predict diseases for a batch of processed images of shape (N, H, W, C)
+
+    Returns one (disease, confidence, model_version) triple per image.
+    ``keys`` are optional content hashes, one per image; when the feature
+    store is enabled the CNN features of keyed images are saved to it.
+    """
+    # One reference for the whole batch: a hot swap mid-batch cannot mix versions
+    models = registry.get()
+    with STAGE_SECONDS.time('cnn'):
+        features = models.cnn.predict(images, verbose=0)
+    if keys is not None:
+        with STAGE_SECONDS.time('feature_store'):
+            store_features(keys, features, models.version)
+    with STAGE_SECONDS.time('classifier'):
+        class_names, confidences, _ = score_features(models, features)
+    return [(class_name, float(confidence), models.version)
+            for class_name, confidence in zip(class_names, confidences)]
+
+def score_features(models, features):
+    """Score CNN features in one classifier pass.
+
+    Returns (class_names, confidences, probabilities); confidences are
+    percentages and probabilities has one row per input. With a feature
+    projection loaded, it is applied to the whole batch first.
+    """
+    if models.projection is not None:
+        features = models.projection.transform(features)
+    prediction_proba = models.classifier.predict_proba(features)
+    predicted_class_idx = np.argmax(prediction_proba, axis=1)
+    class_names = models.label_encoder.inverse_transform(predicted_class_idx)
+    confidences = prediction_proba[np.arange(len(predicted_class_idx)), predicted_class_idx] * 100
+    return class_names, confidences, prediction_proba
+
+_feature_store = None
+_feature_writer = None
+_feature_store_versions = {}
+_feature_store_lock = threading.Lock()
+
+def get_feature_store(model_version=None):
+    """Return (store, extractor version id) for the models of
+    ``model_version``, or (None, None) when disabled"""
+    global _feature_store, _feature_writer
+    if not app.config['FEATURE_STORE_PATH']:
+        return None, None
+    if model_version not in _feature_store_versions:
+        with _feature_store_lock:
+            if _feature_store is None:
+                _feature_store = FeatureStore(app.config['FEATURE_STORE_PATH'])
+                _feature_writer = FeatureWriter(_feature_store)
+            if model_version not in _feature_store_versions:
+                # Registered when the models are first used, so after a hot
+                # swap the fingerprint is that of the new extractor
+                backend = app.config['CNN_BACKEND']
+                cnn_path = app.config['TFLITE_MODEL_PATH'] if backend == 'tflite' else CNN_MODEL_PATH
+                _feature_store_versions[model_version] = _feature_store.register_version(
+                    f"{backend}:{model_fingerprint([cnn_path])}", backend=backend, model=os.path.basename(cnn_path))
+    return _feature_store, _feature_store_versions[model_version]
+
+def store_features(keys, features, model_version=None):
+    """Queue CNN features of keyed images for the background writer;
+    failures never fail a prediction"""
+    rows = [i for i, key in enumerate(keys) if key is not None]
+    if not rows:
+        return
+    try:
+        store, version = get_feature_store(model_version)
+    except Exception as e:
+        print(f"✗ Warning: could not open the feature store: {e}")
+        return
+    if store is not None:
+        _feature_writer.submit([keys[i] for i in rows], features[rows], version)
+
+# Batches are normalized straight into reusable float32 buffers
+buffer_pool = BufferPool(app.config['BATCH_MAX_SIZE'])
+tile_buffer_pool = BufferPool(app.config['TILE_BATCH_SIZE'], max_buffers=2)
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_batcher():
+    """Return the shared micro-batcher, creating it on first use"""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(predict_batch,
+                                        max_batch_size=app.config['BATCH_MAX_SIZE'],
+                                        max_wait_ms=app.config['BATCH_MAX_WAIT_MS'],
+                                        collate=buffer_pool.batch)
+    return _batcher
+
+# Set in HTTP worker processes started by model_server.py, where a separate
+# process owns the models; predictions are then sent to it instead
+_model_client = None
+
+def set_model_client(client):
+    """Route predictions to a model server client instead of local models"""
+    global _model_client
+    _model_client = client
+
+def predict_prepared(image, key=None):
+    """Predict disease from a prepared (decoded and resized, uint8) image"""
+    if _model_client is not None:
+        return _model_client.predict(image, key)
+    if app.config['BATCHING_ENABLED']:
+        return get_batcher().predict(image, key)
+    with buffer_pool.batch([image]) as batch:
+        return predict_batch(batch, [key])[0]
+
+def predict_prepared_batch(images, keys=None, pool=buffer_pool):
+    """Predict diseases for a list of prepared images in one pass"""
+    if _model_client is not None:
+        return _model_client.predict_many(images, keys)
+    with pool.batch(images) as batch:
+        return predict_batch(batch, keys)
 
 def predict_disease(image_path):
     """Predict disease from image"""
     try:
-        global cnn_feature_extractor, xgb_classifier, label_encoder, MODELS_LOADED
-        
-        if not MODELS_LOADED or cnn_feature_extractor is None:
-            # Try loading models if not already loaded
-            try:
-                from tensorflow.keras.models import load_model
-                cnn_feature_extractor = load_model(os.path.join(BASE_PATH, "cnn_feature_extractor.h5"))
-                xgb_classifier = XGBClassifier()
-                xgb_classifier.load_model(os.path.join(BASE_PATH, "xgb_classifier_model.json"))
-                label_encoder_classes = np.load(os.path.join(BASE_PATH, "label_encoder_classes.npy"), allow_pickle=True)
-                label_encoder = LabelEncoder()
-                label_encoder.classes_ = label_encoder_classes
-                MODELS_LOADED = True
-            except Exception as load_error:
-                raise Exception(f"Failed to load models: {str(load_error)}")
-        
-        processed_image = process_image(image_path)
-        features = cnn_feature_extractor.predict(processed_image, verbose=0)
-        predicted_class_idx = xgb_classifier.predict(features)[0]
-        class_name = label_encoder.inverse_transform([predicted_class_idx])[0]
-        
-        # Get probability
-        prediction_proba = xgb_classifier.predict_proba(features)[0]
-        confidence = float(np.max(prediction_proba)) * 100
-        
-        return class_name, confidence
+        with STAGE_SECONDS.time('decode'):
+            image = load_resized(image_path)
+    except Exception as e:
+        PREDICTION_ERRORS.inc('decode')
+        raise Exception(f"Prediction error: {str(e)}")
+    try:
+        disease, confidence, _version = predict_prepared(image)
+        return disease, confidence
     except Exception as e:
+        PREDICTION_ERRORS.inc('model')
         raise Exception(f"Prediction error: {str(e)}")
 
-@app.route('/')
-def home():
-    """Home page with disease information"""
+_prediction_cache = None
+_prediction_cache_lock = threading.Lock()
+
+def get_prediction_cache():
+    """Return the shared prediction cache, or None when caching is disabled"""
+    global _prediction_cache
+    if not app.config['PREDICTION_CACHE_ENABLED']:
+        return None
+    if _prediction_cache is None:
+        with _prediction_cache_lock:
+            if _prediction_cache is None:
+                _prediction_cache = PredictionCache(
+                    MODEL_PATHS,
+                    max_entries=app.config['PREDICTION_CACHE_SIZE'],
+                    ttl_seconds=app.config['PREDICTION_CACHE_TTL'],
+                    db_path=app.config['PREDICTION_CACHE_DB'] or None,
+                    max_disk_entries=app.config['PREDICTION_CACHE_DB_SIZE'],
+                    purge_interval=app.config['PREDICTION_CACHE_DB_PURGE_INTERVAL'])
+    return _prediction_cache
+
+_cascade = None
+_cascade_fingerprint = None
+_cascade_checked = 0.0
+_cascade_lock = threading.Lock()
+
+def get_cascade():
+    """Return the pre-classifier cascade, or None when not configured.
+
+    The registry loads it with the other models, so a hot swap replaces it
+    too. HTTP workers under model_server.py hold no models; they load their
+    own copy and reload it when the file changes, checked at most once a
+    second.
+    """
+    global _cascade, _cascade_fingerprint, _cascade_checked
+    path = app.config['CASCADE_MODEL_PATH']
+    if not path:
+        return None
+    if _model_client is None:
+        return registry.get().cascade
+    if _cascade is None or time.monotonic() - _cascade_checked >= 1.0:
+        with _cascade_lock:
+            if _cascade is None or time.monotonic() - _cascade_checked >= 1.0:
+                _cascade_checked = time.monotonic()
+                fingerprint = model_fingerprint([path])
+                if fingerprint != _cascade_fingerprint:
+                    try:
+                        _cascade = CascadeClassifier.from_json(path)
+                        _cascade_fingerprint = fingerprint
+                    except Exception as e:
+                        if _cascade is None:
+                            raise
+                        # Like a failed hot swap: keep the cascade that works
+                        print(f"✗ Warning: cascade reload failed, keeping {_cascade.version}: {e}")
+    return _cascade
+
+_near_duplicate_index = None
+_near_duplicate_lock = threading.Lock()
+
+def get_near_duplicate_index():
+    """Return the shared near-duplicate index, or None when disabled"""
+    global _near_duplicate_index
+    if not app.config['NEAR_DUPLICATE_ENABLED']:
+        return None
+    if _near_duplicate_index is None:
+        with _near_duplicate_lock:
+            if _near_duplicate_index is None:
+                _near_duplicate_index = NearDuplicateIndex(
+                    max_distance=app.config['NEAR_DUPLICATE_DISTANCE'],
+                    max_entries=app.config['NEAR_DUPLICATE_SIZE'],
+                    model_paths=MODEL_PATHS)
+    return _near_duplicate_index
+
+admission = AdmissionController(max_concurrent=app.config['ADMISSION_MAX_CONCURRENT'],
+                                max_queue=app.config['ADMISSION_MAX_QUEUE'],
+                                default_timeout=app.config['ADMISSION_QUEUE_TIMEOUT'])
+
+@metrics.on_collect
+def collect_admission_metrics():
+    stats = admission.stats()
+    ADMISSION_QUEUE_DEPTH.set(stats['queue_depth'])
+    ADMISSION_RUNNING.set(stats['running'])
+
+@contextmanager
+def admitted(deadline=None, cancelled=None):
+    """Hold an admission slot for the block, recording wait time and rejections"""
+    try:
+        with admission.admit(deadline, cancelled) as waited:
+            ADMISSION_WAIT_SECONDS.observe(waited)
+            yield
+    except Rejected as e:
+        ADMISSION_REJECTED.inc(e.reason)
+        raise
+
+# Version of the models behind the latest model prediction. Cached and
+# near-duplicate results from any other version are ignored, so answers
+# from the previous models stop being served as soon as a hot swap lands.
+_serving_version = None
+
+def note_model_version(version):
+    global _serving_version
+    _serving_version = version
+
+def reusable_result(value):
+    """(disease, confidence, model_version) from a stored result, or None if
+    the models that produced it are no longer serving"""
+    disease, confidence, *rest = value
+    # Entries written before results were versioned have no version
+    version = rest[0] if rest else None
+    if version is not None and _serving_version is not None and version != _serving_version \
+            and not version.startswith('cascade-'):
+        return None
+    return disease, confidence, version
+
+def predict_upload(data, key=None, progress=None, admit=None):
+    """Predict disease for uploaded bytes.
+
+    ``key`` is the content hash of ``data`` if the caller already has it.
+    ``progress`` is called with 'decoding' and 'predicting' as those stages
+    start. ``admit`` returns a context manager held around decoding and
+    prediction (cache hits skip it). Returns (disease, confidence, source,
+    model_version) where source is 'cache', 'near_duplicate', 'cascade' or
+    'model'.
+    """
+    cache = get_prediction_cache()
+    if key is None and (cache is not None or app.config['FEATURE_STORE_PATH']):
+        key = content_hash(data)
+    if cache is not None:
+        cached = cache.get(key)
+        result = reusable_result(cached) if cached is not None else None
+        if result is not None:
+            disease, confidence, version = result
+            return disease, confidence, 'cache', version
+
+    with (admit() if admit is not None else nullcontext()):
+        return _predict_uncached(data, key, cache, progress)
+
+def _predict_uncached(data, key, cache, progress):
+    """Decode and predict an upload that missed the cache"""
+    if progress is not None:
+        progress('decoding')
+    try:
+        with STAGE_SECONDS.time('decode'):
+            image = prepare_image_bytes(data, reduced=app.config['REDUCED_DECODE'])
+    except Exception as e:
+        PREDICTION_ERRORS.inc('decode')
+        raise Exception(f"Prediction error: {str(e)}")
+
+    index = get_near_duplicate_index()
+    if index is not None:
+        image_hash = index.hash(image)
+        match = index.lookup(image_hash)
+        result = reusable_result(match[0]) if match is not None else None
+        if result is not None:
+            disease, confidence, version = result
+            return disease, confidence, 'near_duplicate', version
+
+    cascade = get_cascade()
+    answer = None
+    if cascade is not None:
+        with STAGE_SECONDS.time('cascade'):
+            answer = cascade.predict(image)
+    if answer is not None:
+        (disease, confidence), source, version = answer, 'cascade', cascade.version
+    else:
+        if progress is not None:
+            progress('predicting')
+        try:
+            disease, confidence, version = predict_prepared(image, key)
+        except Exception as e:
+            PREDICTION_ERRORS.inc('model')
+            raise Exception(f"Prediction error: {str(e)}")
+        note_model_version(version)
+        source = 'model'
+
+    if cache is not None:
+        cache.put(key, [disease, confidence, version])
+    if index is not None:
+        index.add(image_hash, (disease, confidence, version))
+    return disease, confidence, source, version
+
+_upload_writer = None
+_upload_writer_lock = threading.Lock()
+_upload_store = None
+_upload_store_lock = threading.Lock()
+
+def get_upload_store():
+    """Return the shared upload store, starting its eviction thread on first use"""
+    global _upload_store
+    if _upload_store is None:
+        with _upload_store_lock:
+            if _upload_store is None:
+                store = UploadStore(app.config['UPLOAD_FOLDER'],
+                                    max_bytes=app.config['UPLOAD_MAX_BYTES'],
+                                    max_age_seconds=app.config['UPLOAD_MAX_AGE'])
+                store.start_eviction()
+                _upload_store = store
+    return _upload_store
+
+def save_upload(filename, data, digest=None):
+    """Persist an upload according to UPLOAD_PERSIST; returns its URL or None
+
+    ``filename`` only supplies the extension; ``digest`` is the content hash
+    when the caller already has it. In background mode the URL is returned
+    before the file is written; ``uploaded_file`` serves it from the
+    writer's queue until then.
+    """
+    global _upload_writer
+    mode = app.config['UPLOAD_PERSIST']
+    if mode == 'none':
+        return None
+    writer = None
+    if mode != 'sync':
+        if _upload_writer is None:
+            with _upload_writer_lock:
+                if _upload_writer is None:
+                    _upload_writer = BackgroundWriter()
+        writer = _upload_writer
+    name = get_upload_store().put(data, filename, writer=writer, digest=digest)
+    if name is None:
+        return None
+    return f'/uploads/{name}'
+
+@app.before_request
+def ensure_warmup():
+    """Start loading the models as soon as the server sees any traffic"""
+    if _model_client is None:
+        registry.start_warmup()
+        registry.start_watching(app.config['MODEL_WATCH_INTERVAL'])
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_flusher()
+    g.metrics_endpoint = request.endpoint or 'unmatched'
+    g.metrics_started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc(g.metrics_endpoint)
+
+@app.after_request
+def record_first_byte(response):
+    registry.record_first_byte()
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = g.get('metrics_endpoint')
+    if endpoint is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_started, endpoint)
+        HTTP_REQUESTS.inc(endpoint, response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is not None:
+        HTTP_IN_FLIGHT.dec(endpoint)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz')
+def healthz():
+    """Liveness probe: the process is up and serving HTTP"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: models are loaded and warmed up"""
+    status = _model_client.status() if _model_client is not None else registry.status()
+    return jsonify(status), (200 if status['ready'] else 503)
+
+def admin_allowed():
+    token = app.config['ADMIN_TOKEN']
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+def model_control(command):
+    """Run 'status' or 'reload' against whichever process owns the models"""
+    if _model_client is not None:
+        return _model_client.control(command)
+    if command == 'reload':
+        registry.start_reload()
+    return registry.status()
+
+@app.route('/admin/models')
+def admin_models():
+    """Serving model version and reload state"""
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(model_control('status'))
+
+@app.route('/admin/models/reload', methods=['POST'])
+def admin_reload_models():
+    """Load the current model files in the background and swap them in once warm"""
+    if not admin_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(model_control('reload')), 202
+
+asset_manifest = load_manifest(app.config['STATIC_BUILD_DIR'], app.static_folder,
+                               autobuild=app.config['ASSETS_AUTOBUILD'])
+
+@app.template_global()
+def asset_url(filename):
+    """URL of a static file, content-hashed when a build is available"""
+    hashed = asset_manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('hashed_asset', filename=hashed)
+
+@app.route('/assets/<path:filename>')
+def hashed_asset(filename):
+    """Serve a content-hashed asset, precompressed if the client accepts it
+
+    The name changes whenever the content does, so the response may be
+    cached for a year.
+    """
+    root = app.config['STATIC_BUILD_DIR']
+    path = safe_join(root, filename)
+    if path is None:
+        abort(404)
+    available = [encoding for encoding, suffix in ENCODINGS if os.path.isfile(path + suffix)]
+    encoding = negotiate(request.accept_encodings, available)
+    suffix = dict(ENCODINGS)[encoding] if encoding else ''
+    response = send_from_directory(root, filename + suffix,
+                                   mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                   etag=filename + suffix, max_age=365 * 24 * 3600, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+page_cache = PageCache()
+
+def cached_page(key, render):
+    """Serve a page rendered once, with an ETag and precompressed variants"""
+    body, encoding, etag = page_cache.get(key, render).select(request.accept_encodings)
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['PAGE_MAX_AGE']
+    return response.make_conditional(request)
+
+def render_home():
     diseases = []
     for disease_name, info in DISEASE_INFO.items():
         if disease_name != 'healthy':
@@ -320,68 +940,575 @@ def home():
             })
     return render_template('index.html', diseases=diseases)
 
+def render_disease_detail(disease_key):
+    return render_template('disease_detail.html',
+                           disease_name=disease_key.title(),
+                           disease_info=DISEASE_INFO[disease_key])
+
+def prerender_pages():
+    """Render every static page into the page cache"""
+    with app.test_request_context('/'):
+        page_cache.get('home', render_home)
+        page_cache.get('predictor', lambda: render_template('predictor.html'))
+        for disease_key in DISEASE_INFO:
+            page_cache.get(f'disease:{disease_key}', lambda: render_disease_detail(disease_key))
+
+@app.route('/')
+def home():
+    """Home page with disease information"""
+    return cached_page('home', render_home)
+
 @app.route('/predictor')
 def predictor():
     """Predictor page"""
-    return render_template('predictor.html')
+    return cached_page('predictor', lambda: render_template('predictor.html'))
 
 @app.route('/disease/<disease_name>')
 def disease_detail(disease_name):
     """Disease detail page"""
     disease_key = disease_name.lower()
     if disease_key in DISEASE_INFO:
-        info = DISEASE_INFO[disease_key]
-        return render_template('disease_detail.html', 
-                             disease_name=disease_name.title(), 
-                             disease_info=info)
+        return cached_page(f'disease:{disease_key}', lambda: render_disease_detail(disease_key))
     return "Disease not found", 404
 
+def build_prediction_response(disease, confidence):
+    """Build the JSON body for a prediction, enriched with DISEASE_INFO"""
+    disease_info = DISEASE_INFO.get(disease, {})
+    return {
+        'disease': disease.title(),
+        'disease_key': disease,
+        'confidence': round(confidence, 2),
+        'description': disease_info.get('description', ''),
+        'symptoms': disease_info.get('symptoms', []),
+        'causes': disease_info.get('causes', ''),
+        'prevention': disease_info.get('prevention', []),
+        'treatment': disease_info.get('treatment', [])
+    }
+
+def upload_error():
+    """Error response for a missing or invalid 'file' upload, or None if it is usable"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = request.files['file']
+    
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file format. Allowed: png, jpg, jpeg, gif, bmp'}), 400
+    return None
+
+def predict_and_save(filename, data, progress=None, admit=None):
+    """Predict, persist the upload and build the /api/predict response body"""
+    # One hash of the bytes keys both the prediction cache and the upload store
+    digest = content_hash(data)
+    disease, confidence, source, version = predict_upload(data, digest, progress, admit)
+    PREDICTIONS.inc(disease, source)
+    with STAGE_SECONDS.time('save'):
+        image_path = save_upload(filename, data, digest)
+    
+    with STAGE_SECONDS.time('response'):
+        response = build_prediction_response(disease, confidence)
+        response.update({
+            'image_path': image_path,
+            'cached': source == 'cache',
+            'near_duplicate': source == 'near_duplicate',
+            'cascade': source == 'cascade',
+            'model_version': version
+        })
+    return response
+
+def request_deadline():
+    """Monotonic deadline for waiting on an inference slot.
+
+    Clients may shorten the server's QUEUE_TIMEOUT by sending the seconds
+    they are willing to wait in an X-Request-Timeout header.
+    """
+    timeout = app.config['ADMISSION_QUEUE_TIMEOUT']
+    try:
+        timeout = min(timeout, float(request.headers.get('X-Request-Timeout', timeout)))
+    except ValueError:
+        pass
+    return time.monotonic() + max(0.0, timeout)
+
+def busy_response(rejected):
+    """503 for a request turned away by admission control"""
+    response = jsonify({'error': str(rejected)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(rejected.retry_after)
+    return response
+
+def request_admission():
+    """Admission slot for the current request, given up if the client disconnects"""
+    environ = request.environ
+    return admitted(request_deadline(), lambda: client_disconnected(environ))
+
+def request_admission_factory():
+    """Like ``request_admission``, callable once per inference after the
+    request context is gone (streamed responses); each slot gets the
+    request's own wait limit"""
+    environ = request.environ
+    timeout = request_deadline() - time.monotonic()
+    return lambda: admitted(time.monotonic() + timeout, lambda: client_disconnected(environ))
+
 @app.route('/api/predict', methods=['POST'])
 def api_predict():
     """API endpoint for image prediction"""
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
+        error = upload_error()
+        if error is not None:
+            return error
         
+        # Read the upload once; the prediction decodes from memory and the
+        # original is persisted according to UPLOAD_PERSIST
         file = request.files['file']
+        return jsonify(predict_and_save(file.filename, file.read(), admit=request_admission))
+    
+    except Rejected as e:
+        return busy_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+def get_job_runner():
+    """Return the shared job runner, creating its store on first use"""
+    global _job_runner
+    if _job_runner is None:
+        with _job_runner_lock:
+            if _job_runner is None:
+                if app.config['JOBS_DB']:
+                    store = SQLiteJobStore(app.config['JOBS_DB'], ttl_seconds=app.config['JOBS_TTL'])
+                else:
+                    store = MemoryJobStore(ttl_seconds=app.config['JOBS_TTL'])
+                _job_runner = JobRunner(store, max_workers=app.config['JOBS_WORKERS'],
+                                        max_pending=app.config['JOBS_MAX_PENDING'])
+    return _job_runner
+
+def run_prediction_job(progress, filename, data):
+    # Jobs wait for an inference slot like /api/predict; a job turned away
+    # fails with the busy message
+    return predict_and_save(filename, data, progress, admit=admitted)
+
+def job_response(job):
+    """Public view of a job, with links for polling and streaming"""
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+        'status_url': f"/api/jobs/{job['id']}",
+        'events_url': f"/api/jobs/{job['id']}/events",
+    }
+
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    """Queue a prediction and return its job id without waiting for it"""
+    try:
+        error = upload_error()
+        if error is not None:
+            return error
         
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file format. Allowed: png, jpg, jpeg, gif, bmp'}), 400
-        
-        # Save the file
-        filename = secure_filename(f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Make prediction
-        disease, confidence = predict_disease(filepath)
-        
-        disease_info = DISEASE_INFO.get(disease, {})
-        
-        response = {
-            'disease': disease.title(),
-            'disease_key': disease,
-            'confidence': round(confidence, 2),
-            'description': disease_info.get('description', ''),
-            'symptoms': disease_info.get('symptoms', []),
-            'causes': disease_info.get('causes', ''),
-            'prevention': disease_info.get('prevention', []),
-            'treatment': disease_info.get('treatment', []),
-            'image_path': f'/uploads/{filename}'
-        }
+        file = request.files['file']
+        runner = get_job_runner()
+        try:
+            job_id = runner.submit(run_prediction_job, file.filename, file.read())
+        except QueueFull:
+            response = jsonify({'error': 'Too many pending jobs, try again shortly'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
         
-        return jsonify(response)
+        response = jsonify(job_response(runner.get(job_id)))
+        response.headers['Location'] = f'/api/jobs/{job_id}'
+        return response, 202
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/jobs/<job_id>')
+def api_get_job(job_id):
+    """Current state of a job; the result is included once it is done"""
+    job = get_job_runner().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job_response(job))
+
+@app.route('/api/jobs/<job_id>/events')
+def api_job_events(job_id):
+    """Stream job progress as server-sent events until it finishes"""
+    runner = get_job_runner()
+    job = runner.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+
+    def generate(job):
+        last_update = None
+        last_sent = time.monotonic()
+        while True:
+            if job is None:
+                yield 'event: error\ndata: {"error": "Job not found or expired"}\n\n'
+                return
+            if job['updated_at'] != last_update:
+                last_update = job['updated_at']
+                last_sent = time.monotonic()
+                yield f"event: {job['status']}\ndata: {json.dumps(job_response(job))}\n\n"
+                if job['status'] in ('done', 'failed'):
+                    return
+            elif time.monotonic() - last_sent > 15:
+                # Comment line keeps proxies from closing an idle stream
+                last_sent = time.monotonic()
+                yield ': keep-alive\n\n'
+            runner.wait_for_change(0.5)
+            job = runner.get(job_id)
+
+    response = Response(generate(job), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+class BatchTooLarge(Exception):
+    """A batch upload over BATCH_MAX_FILES images or BATCH_MAX_UNCOMPRESSED bytes"""
+
+def collect_batch_uploads(files, resources):
+    """List the images in uploaded files and zip archives without reading them
+
+    Returns (count, uploads), where ``uploads`` lazily yields (filename,
+    bytes) pairs; bytes is None for an unreadable or oversized image. Only
+    the zip directories are read here, so a batch with too many images, or
+    whose entries declare more than BATCH_MAX_UNCOMPRESSED bytes, raises
+    BatchTooLarge before anything is decompressed.
+
+    The request closes its files as soon as the view returns, so the
+    uploaded streams are handed to the ``resources`` ExitStack instead,
+    which the caller closes once the stream is done.
+    """
+    sources = []
+    declared = 0
+    for file in files:
+        if file.filename == '':
+            continue
+        stream, file.stream = file.stream, io.BytesIO()
+        resources.callback(stream.close)
+        if file.filename.lower().endswith('.zip'):
+            try:
+                archive = resources.enter_context(zipfile.ZipFile(stream))
+            except zipfile.BadZipFile:
+                sources.append((file.filename, None, None))
+                continue
+            for entry in archive.infolist():
+                if entry.is_dir() or not allowed_file(entry.filename):
+                    continue
+                sources.append((entry.filename, archive, entry))
+                declared += entry.file_size
+        else:
+            sources.append((file.filename, None, stream))
+        if len(sources) > app.config['BATCH_MAX_FILES']:
+            raise BatchTooLarge(f"Too many images. Maximum is {app.config['BATCH_MAX_FILES']} per batch")
+    if declared > app.config['BATCH_MAX_UNCOMPRESSED']:
+        raise BatchTooLarge(f"Batch too large. Maximum is "
+                            f"{app.config['BATCH_MAX_UNCOMPRESSED'] // (1024 * 1024)}MB of images")
+    return len(sources), _read_batch_uploads(sources)
+
+def _read_batch_uploads(sources):
+    # Declared sizes are not trusted: every read stops one byte past the
+    # image limit or what is left of the batch's budget
+    budget = app.config['BATCH_MAX_UNCOMPRESSED']
+    for filename, archive, source in sources:
+        limit = min(app.config['MAX_CONTENT_LENGTH'], budget)
+        data = None
+        try:
+            if archive is not None:
+                with archive.open(source) as f:
+                    data = f.read(limit + 1)
+            elif source is not None:
+                data = source.read(limit + 1)
+        except Exception:
+            data = None
+        if data is not None and len(data) > limit:
+            data = None
+        if data is not None:
+            budget -= len(data)
+        yield filename, data
+
+def _decode_batch_item(data):
+    with STAGE_SECONDS.time('decode'):
+        return prepare_image_bytes(data, reduced=app.config['REDUCED_DECODE'])
+
+def generate_batch_predictions(uploads, admit=None, first_slot=None):
+    """Yield one NDJSON line per upload as each inference batch finishes.
+
+    Each inference batch holds an admission slot from ``admit()``; the
+    first uses ``first_slot`` (an ExitStack holding one) when given. A
+    batch turned away yields error lines for its images.
+    """
+    cache = get_prediction_cache()
+    held = [first_slot] if first_slot is not None else []
+    batch_size = app.config['BATCH_MAX_SIZE']
+    pending = []
+
+    def emit(index, filename, data, result=None, error=None, source='model', key=None):
+        item = {'index': index, 'filename': filename}
+        if error is not None:
+            item['error'] = error
+        else:
+            disease, confidence, version = result
+            PREDICTIONS.inc(disease, source)
+            item.update(build_prediction_response(disease, confidence))
+            item['image_path'] = save_upload(filename, data, key)
+            item['cached'] = source == 'cache'
+            item['model_version'] = version
+        return json.dumps(item) + '\n'
+
+    def run_pending():
+        lines = []
+        decoded = []
+        for index, filename, data, key, future in pending:
+            try:
+                decoded.append((index, filename, data, key, future.result()))
+            except Exception as e:
+                PREDICTION_ERRORS.inc('decode')
+                lines.append(emit(index, filename, data, error=f"Prediction error: {str(e)}"))
+        if decoded:
+            try:
+                slot = held.pop() if held else (admit() if admit is not None else nullcontext())
+                with slot:
+                    results = predict_prepared_batch([item[4] for item in decoded], [item[3] for item in decoded])
+            except Rejected as e:
+                lines.extend(emit(index, filename, data, error=str(e))
+                             for index, filename, data, _key, _image in decoded)
+            except Exception as e:
+                PREDICTION_ERRORS.inc('model', amount=len(decoded))
+                lines.extend(emit(index, filename, data, error=f"Prediction error: {str(e)}")
+                             for index, filename, data, _key, _image in decoded)
+            else:
+                for (index, filename, data, key, _image), (disease, confidence, version) in zip(decoded, results):
+                    note_model_version(version)
+                    if cache is not None:
+                        cache.put(key, [disease, confidence, version])
+                    lines.append(emit(index, filename, data, result=(disease, confidence, version), key=key))
+        pending.clear()
+        return lines
+
+    def settle(index, filename, data, key, work):
+        if data is None:
+            return [emit(index, filename, data, error='Invalid or oversized image')]
+        if not hasattr(work, 'result'):
+            return [emit(index, filename, data, result=work, source='cache', key=key)]
+        pending.append((index, filename, data, key, work))
+        return run_pending() if len(pending) >= batch_size else []
+
+    with ThreadPoolExecutor(max_workers=app.config['BATCH_DECODE_WORKERS']) as pool:
+        # Uploads are read as they are reached, and decodes run up to one
+        # batch ahead so the next batch decodes while this one is on the CNN
+        queued = deque()
+        for index, (filename, data) in enumerate(uploads):
+            if data is None:
+                queued.append((index, filename, data, None, None))
+            else:
+                key = content_hash(data) if cache is not None or app.config['FEATURE_STORE_PATH'] else None
+                cached = cache.get(key) if cache is not None else None
+                result = reusable_result(cached) if cached is not None else None
+                if result is not None:
+                    queued.append((index, filename, data, key, result))
+                else:
+                    queued.append((index, filename, data, key, pool.submit(_decode_batch_item, data)))
+            if len(queued) > batch_size:
+                yield from settle(*queued.popleft())
+        while queued:
+            yield from settle(*queued.popleft())
+        yield from run_pending()
+    # A first slot left unused (every image cached or undecodable)
+    for slot in held:
+        slot.close()
+
+@app.route('/api/predict/batch', methods=['POST'])
+def api_predict_batch():
+    """Predict many images in one request, streaming NDJSON results"""
+    # Batch uploads may be much larger than a single image
+    request.max_content_length = app.config['BATCH_MAX_CONTENT_LENGTH']
+    # Holds the uploaded files; closed here unless the stream takes them over
+    with ExitStack() as uploaded:
+        try:
+            files = request.files.getlist('files') + request.files.getlist('file')
+            if not files:
+                return jsonify({'error': 'No files provided'}), 400
+
+            rejected = [f.filename for f in files
+                        if f.filename and not f.filename.lower().endswith('.zip') and not allowed_file(f.filename)]
+            if rejected:
+                return jsonify({'error': 'Invalid file format. Allowed: png, jpg, jpeg, gif, bmp, zip',
+                                'files': rejected}), 400
+
+            try:
+                count, uploads = collect_batch_uploads(files, uploaded)
+            except BatchTooLarge as e:
+                return jsonify({'error': str(e)}), 413
+            if not count:
+                return jsonify({'error': 'No images found in upload'}), 400
+
+            # The first slot is taken before the stream starts, so a busy server
+            # still answers 503 with Retry-After; later batches queue per batch
+            admit = request_admission_factory()
+            first_slot = ExitStack()
+            first_slot.enter_context(admit())
+        except Rejected as e:
+            return busy_response(e)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        resources = uploaded.pop_all()
+
+    response = Response(generate_batch_predictions(uploads, admit, first_slot), mimetype='application/x-ndjson')
+    # Released even if the stream is never read
+    response.call_on_close(first_slot.close)
+    response.call_on_close(resources.close)
+    return response
+
+@app.route('/api/predict/tiled', methods=['POST'])
+def api_predict_tiled():
+    """Predict a large field image tile by tile, with a disease heatmap
+
+    Optional form fields ``overlap`` and ``min_leaf_fraction`` override the
+    configured tiling for this request.
+    """
+    request.max_content_length = app.config['TILE_MAX_CONTENT_LENGTH']
+    try:
+        error = upload_error()
+        if error is not None:
+            return error
+        try:
+            overlap = float(request.form.get('overlap', app.config['TILE_OVERLAP']))
+            min_leaf_fraction = float(request.form.get('min_leaf_fraction', app.config['TILE_MIN_LEAF_FRACTION']))
+        except ValueError:
+            return jsonify({'error': 'overlap and min_leaf_fraction must be numbers'}), 400
+        if not 0 <= overlap <= TILE_MAX_OVERLAP:
+            return jsonify({'error': f'overlap must be between 0 and {TILE_MAX_OVERLAP}'}), 400
+
+        data = request.files['file'].read()
+        admit = request_admission_factory()
+        with admit():
+            try:
+                with STAGE_SECONDS.time('decode'):
+                    image, scale = decode_for_tiling(data, app.config['TILE_MAX_PIXELS'])
+            except Exception as e:
+                PREDICTION_ERRORS.inc('decode')
+                raise Exception(f"Prediction error: {str(e)}")
+
+        def predict_tile_batch(tiles):
+            # Each batch queues for its own slot, so a big image takes turns
+            # with other requests instead of holding one slot throughout
+            with admit():
+                return predict_prepared_batch(tiles, pool=tile_buffer_pool)
+
+        try:
+            result = predict_tiles(image, predict_tile_batch, batch_size=app.config['TILE_BATCH_SIZE'],
+                                   overlap=overlap, min_leaf_fraction=min_leaf_fraction, scale=scale,
+                                   max_tiles=app.config['TILE_MAX_TILES'])
+        except Rejected:
+            raise
+        except Exception as e:
+            PREDICTION_ERRORS.inc('model')
+            raise Exception(f"Prediction error: {str(e)}")
+
+        summary = result['summary']
+        PREDICTIONS.inc(summary['disease'], 'tiled')
+        with STAGE_SECONDS.time('response'):
+            response = build_prediction_response(summary['disease'], summary['confidence'])
+            # Reported once, as decode_scale
+            decode_scale = result.pop('scale')
+            response.update(result)
+            response.update({'image_size': [round(image.shape[1] / scale), round(image.shape[0] / scale)],
+                             'decode_scale': round(decode_scale, 4),
+                             'model_version': result['model_versions'][-1] if result['model_versions'] else None})
+        return jsonify(response)
+
+    except Rejected as e:
+        return busy_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/stats/batching')
+def batching_stats():
+    """Micro-batching statistics for tuning the batching window"""
+    if not app.config['BATCHING_ENABLED']:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **get_batcher().stats()})
+
+@app.route('/api/stats/cache')
+def cache_stats():
+    """Prediction cache statistics"""
+    cache = get_prediction_cache()
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **cache.stats()})
+
+@app.route('/api/stats/jobs')
+def job_stats():
+    """Async job queue statistics"""
+    return jsonify(get_job_runner().stats())
+
+@app.route('/api/stats/admission')
+def admission_stats():
+    """Inference admission queue statistics"""
+    return jsonify(admission.stats())
+
+@app.route('/api/stats/cascade')
+def cascade_stats():
+    """Share of uploads answered by the pre-classifier cascade"""
+    cascade = get_cascade()
+    if cascade is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **cascade.stats()})
+
+@app.route('/api/stats/pages')
+def page_stats():
+    """Prerendered page cache and static build statistics"""
+    return jsonify({**page_cache.stats(), 'assets': len(asset_manifest)})
+
+@app.route('/api/stats/near-duplicates')
+def near_duplicate_stats():
+    """Near-duplicate index statistics"""
+    index = get_near_duplicate_index()
+    if index is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **index.stats()})
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    """Serve uploaded files"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Serve uploaded files
+
+    Stored names are content hashes, so the hash is a strong ETag and the
+    file can be cached for a year. Legacy names not yet migrated are served
+    from the flat directory as before.
+    """
+    store = get_upload_store()
+    path = store.path_for(filename)
+    if path is None:
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    etag = filename.split('.', 1)[0]
+    if not os.path.exists(path):
+        # A background write may not have landed yet: serve the queued bytes
+        # from this process, or give another worker's writer a moment
+        data = store.pending(filename, _upload_writer)
+        if data is not None:
+            response = Response(data, mimetype=mimetypes.guess_type(filename)[0])
+            response.set_etag(etag)
+            response.cache_control.max_age = 365 * 24 * 3600
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            return response.make_conditional(request)
+        deadline = time.monotonic() + UPLOAD_PENDING_WAIT
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    response = send_from_directory(os.path.dirname(path), filename, etag=etag,
+                                   max_age=365 * 24 * 3600, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
@@ -398,6 +1525,8 @@ def server_error(error):
     """Handle 500 errors"""
     return render_template('500.html'), 500
 
+prerender_pages()
+
 if __name__ == '__main__':
     print("=" * 50)
     print("🌿 Leaf Disease Predictor - Flask App")
@@ -405,4 +1534,7 @@ if __name__ == '__main__':
     print("Starting Flask server...")
     print("Visit: http://localhost:5000")
     print("=" * 50)
+    # With the reloader on, only the serving child process warms up
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        registry.start_warmup()
     app.run(debug=True, host='0.0.0.0', port=5000)
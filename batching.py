@@ -0,0 +1,177 @@
+"""
+Dynamic micro-batching for CNN/XGBoost inference.
+
+Requests that arrive within a short window are collected into a single
+batch so the CNN and the classifier each run once per batch instead of
+once per image.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Collect single-image requests and run them through a batch function.
+
+    ``batch_fn`` receives a float array of shape (N, H, W, C) and the list of
+    N ``key`` values passed to ``submit``, and must return a sequence of N
+    results, one per input image, in the same order. ``collate`` turns the
+    list of submitted images into that array; it is a context manager so
+    the array can come from (and go back to) a buffer pool.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=5.0, stats_window=1024, collate=None):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.batch_fn = batch_fn
+        self.collate = collate or _stack
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._queue_waits = deque(maxlen=stats_window)
+        self._batch_times = deque(maxlen=stats_window)
+        self._total_requests = 0
+        self._total_batches = 0
+        self._total_errors = 0
+
+        self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, image, key=None):
+        """Queue one preprocessed image (1, H, W, C) or (H, W, C); returns a Future
+
+        ``key`` is handed to ``batch_fn`` alongside the image.
+        """
+        if image.ndim == 4:
+            if image.shape[0] != 1:
+                raise ValueError("submit() takes a single image; use batch_fn directly for batches")
+            image = image[0]
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self._queue.append((image, key, future, time.perf_counter()))
+            self._cond.notify()
+        return future
+
+    def predict(self, image, key=None, timeout=None):
+        """Submit an image and block until its result is available"""
+        return self.submit(image, key).result(timeout=timeout)
+
+    def close(self, timeout=None):
+        """Stop accepting requests and let the worker drain the queue"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+
+            # The window opens when the oldest request arrived, so a request
+            # never waits longer than max_wait for company.
+            deadline = self._queue[0][3] + self.max_wait
+            while len(self._queue) < self.max_batch_size and not self._closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            count = min(len(self._queue), self.max_batch_size)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            started = time.perf_counter()
+            images, keys, futures, enqueued = zip(*batch)
+            try:
+                with self.collate(images) as batch_images:
+                    results = self.batch_fn(batch_images, list(keys))
+                if len(results) != len(futures):
+                    raise RuntimeError(
+                        f"batch function returned {len(results)} results for {len(futures)} inputs")
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                failed = True
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+                failed = False
+            finished = time.perf_counter()
+
+            with self._stats_lock:
+                self._total_requests += len(batch)
+                self._total_batches += 1
+                if failed:
+                    self._total_errors += 1
+                self._batch_sizes.append(len(batch))
+                self._batch_times.append(finished - started)
+                self._queue_waits.extend(started - t for t in enqueued)
+
+    def stats(self):
+        """Batch-size and queue-wait statistics over the recent window"""
+        with self._stats_lock:
+            sizes = np.array(self._batch_sizes, dtype=np.float64)
+            waits = np.array(self._queue_waits, dtype=np.float64) * 1000.0
+            times = np.array(self._batch_times, dtype=np.float64) * 1000.0
+            totals = {
+                'total_requests': self._total_requests,
+                'total_batches': self._total_batches,
+                'failed_batches': self._total_errors,
+            }
+        with self._cond:
+            queue_depth = len(self._queue)
+
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'queue_depth': queue_depth,
+            **totals,
+            'batch_size': _summary(sizes),
+            'batch_size_histogram': _histogram(sizes, self.max_batch_size),
+            'queue_wait_ms': _summary(waits),
+            'batch_time_ms': _summary(times),
+        }
+
+
+@contextmanager
+def _stack(images):
+    yield np.stack(images)
+
+
+def _summary(values):
+    if values.size == 0:
+        return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'count': int(values.size),
+        'mean': round(float(values.mean()), 3),
+        'p50': round(float(p50), 3),
+        'p95': round(float(p95), 3),
+        'p99': round(float(p99), 3),
+        'max': round(float(values.max()), 3),
+    }
+
+
+def _histogram(sizes, max_batch_size):
+    counts = np.bincount(sizes.astype(np.int64), minlength=max_batch_size + 1)
+    return {str(size): int(count) for size, count in enumerate(counts) if size and count}
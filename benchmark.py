@@ -0,0 +1,331 @@
+"""
+End-to-end performance benchmark for the prediction pipeline.
+
+Times each stage of a prediction on its own (decode, resize/normalize,
+CNN, XGBoost, JSON assembly), then drives ``/api/predict`` through the
+Flask test client at several concurrency levels. Latency percentiles and
+throughput are written to a JSON file; pass an earlier file as
+``--baseline`` to flag regressions.
+
+When the real model files are missing (or with ``--stand-in``), small
+stand-in models are built first: a four-layer Keras CNN with the same
+4096-wide feature output and an XGBoost classifier trained on random
+features. Their absolute numbers are only comparable with other stand-in
+runs.
+
+Usage:
+    python benchmark.py [--output results.json] [--baseline old.json]
+    python benchmark.py --stand-in --concurrency 1 4 16 --requests 128
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_FILES = ("cnn_feature_extractor.h5", "xgb_classifier_model.json", "label_encoder_classes.npy")
+STAND_IN_DIR = os.path.join(tempfile.gettempdir(), "leaf-benchmark-models")
+STAND_IN_CLASSES = ['bacterial spot', 'early blight', 'healthy', 'late blight', 'leaf mold',
+                    'septoria leaf spot', 'spider mites two-spotted spider mite', 'target spot',
+                    'tomato mosaic virus', 'tomato yellow leaf curl virus']
+FEATURE_DIM = 4096
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
+
+# Latency metrics where an increase is a regression; throughput is the
+# other way round
+LATENCY_KEYS = ('p50', 'p95', 'p99')
+
+
+def build_stand_in_models(model_dir, seed=0):
+    """Write a tiny CNN, XGBoost model and label encoder to ``model_dir``"""
+    import tensorflow as tf
+    from xgboost import XGBClassifier
+
+    os.makedirs(model_dir, exist_ok=True)
+    tf.random.set_seed(seed)
+    inputs = tf.keras.Input((224, 224, 3))
+    x = inputs
+    for filters in (8, 16, 32, 64):
+        x = tf.keras.layers.Conv2D(filters, 3, strides=2, padding='same', activation='relu')(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(FEATURE_DIM, activation='relu')(x)
+    tf.keras.Model(inputs, outputs).save(os.path.join(model_dir, MODEL_FILES[0]))
+
+    rng = np.random.default_rng(seed)
+    features = rng.random((500, FEATURE_DIM), dtype=np.float32)
+    labels = rng.integers(0, len(STAND_IN_CLASSES), 500)
+    labels[:len(STAND_IN_CLASSES)] = np.arange(len(STAND_IN_CLASSES))  # every class present
+    classifier = XGBClassifier(n_estimators=20, max_depth=4, random_state=seed)
+    classifier.fit(features, labels)
+    classifier.save_model(os.path.join(model_dir, MODEL_FILES[1]))
+
+    np.save(os.path.join(model_dir, MODEL_FILES[2]), np.array(STAND_IN_CLASSES, dtype=object),
+            allow_pickle=True)
+    print(f"✓ Built stand-in models in {model_dir}")
+
+
+def resolve_model_dir(model_dir=None, stand_in=False):
+    """Pick the model directory, building stand-ins when needed.
+
+    Returns (model_dir, kind) where kind is 'real' or 'stand-in'.
+    """
+    model_dir = model_dir or BASE_PATH
+    has_models = all(os.path.exists(os.path.join(model_dir, name)) for name in MODEL_FILES)
+    if has_models and not stand_in:
+        return model_dir, 'real'
+    if not stand_in:
+        print(f"ℹ Model files not found in {model_dir}; using stand-in models")
+    if not all(os.path.exists(os.path.join(STAND_IN_DIR, name)) for name in MODEL_FILES):
+        build_stand_in_models(STAND_IN_DIR)
+    return STAND_IN_DIR, 'stand-in'
+
+
+def load_samples(image_dir=None, count=16, size=(1024, 768), seed=0):
+    """Encoded image bytes: files from ``image_dir`` or synthetic JPEGs"""
+    if image_dir:
+        samples = []
+        for dirpath, _, filenames in os.walk(image_dir):
+            for name in sorted(filenames):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    with open(os.path.join(dirpath, name), 'rb') as f:
+                        samples.append((name, f.read()))
+                if len(samples) >= count:
+                    return samples
+        if samples:
+            return samples
+        print(f"ℹ No images found in {image_dir}; using synthetic images")
+
+    rng = np.random.default_rng(seed)
+    samples = []
+    for i in range(count):
+        # Upscaled noise compresses like a photo rather than like pure noise
+        base = rng.integers(0, 255, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+        image = cv2.resize(base, size, interpolation=cv2.INTER_CUBIC)
+        _, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        samples.append((f"synthetic_{i}.jpg", encoded.tobytes()))
+    return samples
+
+
+def summarize(samples_ms):
+    """Mean, percentiles and max of a list of millisecond timings"""
+    values = np.asarray(samples_ms, dtype=np.float64)
+    if values.size == 0:
+        return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'count': int(values.size),
+        'mean': round(float(values.mean()), 3),
+        'p50': round(float(p50), 3),
+        'p95': round(float(p95), 3),
+        'p99': round(float(p99), 3),
+        'max': round(float(values.max()), 3),
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def benchmark_stages(leaf_app, samples, repeats=3):
+    """Time every stage of a single-image prediction on its own"""
+    from preprocessing import BufferPool, decode_image, resize_image
+
+    models = leaf_app.registry.get()
+    pool = BufferPool(batch_size=1, max_buffers=1)
+    timings = {'decode': [], 'resize_normalize': [], 'cnn': [], 'xgboost': [], 'json': []}
+    reduced = leaf_app.app.config['REDUCED_DECODE']
+
+    with leaf_app.app.app_context():
+        for _ in range(repeats):
+            for _, data in samples:
+                img, ms = _timed(decode_image, data, reduced)
+                timings['decode'].append(ms)
+
+                started = time.perf_counter()
+                with pool.batch([resize_image(img)]) as batch:
+                    timings['resize_normalize'].append((time.perf_counter() - started) * 1000)
+                    features, ms = _timed(models.cnn.predict, batch, verbose=0)
+                timings['cnn'].append(ms)
+
+                (class_names, confidences, _), ms = _timed(leaf_app.score_features, models, features)
+                timings['xgboost'].append(ms)
+
+                started = time.perf_counter()
+                body = leaf_app.build_prediction_response(class_names[0], float(confidences[0]))
+                leaf_app.jsonify(body).get_data()
+                timings['json'].append((time.perf_counter() - started) * 1000)
+
+    return {stage: summarize(values) for stage, values in timings.items()}
+
+
+def benchmark_endpoint(leaf_app, samples, concurrency, total_requests):
+    """POST ``total_requests`` uploads to /api/predict from ``concurrency`` threads"""
+    def worker(worker_id):
+        client = leaf_app.app.test_client()
+        latencies, errors = [], 0
+        for i in range(worker_id, total_requests, concurrency):
+            name, data = samples[i % len(samples)]
+            started = time.perf_counter()
+            response = client.post('/api/predict', data={'file': (io.BytesIO(data), name)},
+                                   content_type='multipart/form-data')
+            response.get_data()
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors += 1
+        return latencies, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [ms for worker_latencies, _ in results for ms in worker_latencies]
+    errors = sum(worker_errors for _, worker_errors in results)
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 3) if elapsed else None,
+        'latency_ms': summarize(latencies),
+    }
+
+
+def compare_results(current, baseline, threshold=0.10):
+    """Return (rows, regressions) comparing two result files.
+
+    A regression is a latency percentile that grew, or a throughput that
+    fell, by more than ``threshold`` (a fraction).
+    """
+    rows, regressions = [], []
+
+    def check(name, old, new, higher_is_worse):
+        if old is None or new is None or old == 0:
+            return
+        change = (new - old) / old
+        worse = change > threshold if higher_is_worse else change < -threshold
+        rows.append((name, old, new, change, worse))
+        if worse:
+            regressions.append(name)
+
+    for stage, summary in current.get('stages', {}).items():
+        old = baseline.get('stages', {}).get(stage)
+        if old:
+            for key in LATENCY_KEYS:
+                check(f"stage.{stage}.{key}_ms", old.get(key), summary.get(key), True)
+
+    old_endpoint = {str(run['concurrency']): run for run in baseline.get('endpoint', [])}
+    for run in current.get('endpoint', []):
+        old = old_endpoint.get(str(run['concurrency']))
+        if not old:
+            continue
+        prefix = f"endpoint.c{run['concurrency']}"
+        for key in LATENCY_KEYS:
+            check(f"{prefix}.{key}_ms", old['latency_ms'].get(key), run['latency_ms'].get(key), True)
+        check(f"{prefix}.throughput_rps", old.get('throughput_rps'), run.get('throughput_rps'), False)
+    return rows, regressions
+
+
+def print_results(results):
+    print(f"\nStages (ms per image, {results['meta']['models']} models)")
+    print(f"{'stage':<18} {'p50':>9} {'p95':>9} {'p99':>9} {'mean':>9}")
+    for stage, s in results['stages'].items():
+        print(f"{stage:<18} {s['p50']:>9.3f} {s['p95']:>9.3f} {s['p99']:>9.3f} {s['mean']:>9.3f}")
+
+    print("\n/api/predict (ms per request)")
+    print(f"{'concurrency':>11} {'req/s':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}")
+    for run in results['endpoint']:
+        s = run['latency_ms']
+        print(f"{run['concurrency']:>11} {run['throughput_rps']:>9.2f} {s['p50']:>9.2f} "
+              f"{s['p95']:>9.2f} {s['p99']:>9.2f} {run['errors']:>7}")
+
+
+def print_comparison(rows, threshold):
+    print(f"\nAgainst baseline (regression threshold {threshold * 100:.0f}%)")
+    print(f"{'metric':<34} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, old, new, change, worse in rows:
+        flag = '  ✗ REGRESSION' if worse else ''
+        print(f"{name:<34} {old:>10.3f} {new:>10.3f} {change * 100:>7.1f}%{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the leaf disease prediction pipeline")
+    parser.add_argument('--output', default='benchmark_results.json', help="Where to write the JSON results")
+    parser.add_argument('--baseline', default=None, help="Earlier results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Relative change counted as a regression (default: 0.10)")
+    parser.add_argument('--model-dir', default=None, help="Directory with the model files (default: ..)")
+    parser.add_argument('--stand-in', action='store_true', help="Always use the small stand-in models")
+    parser.add_argument('--images', default=None, help="Directory of sample images (default: synthetic)")
+    parser.add_argument('--num-images', type=int, default=16)
+    parser.add_argument('--image-size', type=int, nargs=2, default=(1024, 768), metavar=('W', 'H'),
+                        help="Size of the synthetic images")
+    parser.add_argument('--repeats', type=int, default=3, help="Passes over the samples per stage")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=64, help="Requests per concurrency level")
+    args = parser.parse_args(argv)
+
+    model_dir, kind = resolve_model_dir(args.model_dir, args.stand_in)
+    os.environ['LEAF_MODEL_DIR'] = model_dir
+    # Measure the models, not the cache or the disk, unless asked otherwise
+    os.environ.setdefault('LEAF_CACHE', '0')
+    os.environ.setdefault('LEAF_NEAR_DUP', '0')
+    os.environ.setdefault('LEAF_UPLOAD_PERSIST', 'none')
+    import app as leaf_app
+
+    samples = load_samples(args.images, args.num_images, tuple(args.image_size))
+    started = time.perf_counter()
+    leaf_app.registry.warm_up()
+    print(f"✓ Models loaded and warmed up in {time.perf_counter() - started:.1f}s")
+
+    config = leaf_app.app.config
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'models': kind,
+            'model_dir': model_dir,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'samples': len(samples),
+            'config': {key: config[key] for key in (
+                'BATCHING_ENABLED', 'BATCH_MAX_SIZE', 'BATCH_MAX_WAIT_MS', 'PREDICTION_CACHE_ENABLED',
+                'NEAR_DUPLICATE_ENABLED', 'REDUCED_DECODE', 'UPLOAD_PERSIST', 'CNN_BACKEND',
+                'CLASSIFIER_ENGINE')},
+        },
+        'stages': benchmark_stages(leaf_app, samples, args.repeats),
+        'endpoint': [benchmark_endpoint(leaf_app, samples, c, args.requests) for c in args.concurrency],
+    }
+
+    print_results(results)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n✓ Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('models') != kind:
+            print(f"ℹ Baseline used {baseline.get('meta', {}).get('models')} models; this run used {kind}")
+        rows, regressions = compare_results(results, baseline, args.threshold)
+        print_comparison(rows, args.threshold)
+        if regressions:
+            print(f"\n✗ {len(regressions)} metric(s) regressed")
+            return 1
+        print("\n✓ No regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
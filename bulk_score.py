@@ -0,0 +1,259 @@
+"""
+Offline bulk scoring of leaf image archives.
+
+Walks a directory tree, decodes and resizes images in a process pool,
+feeds them through a bounded prefetch queue into batched CNN/XGBoost
+inference and writes results incrementally to CSV or Parquet. A checkpoint
+file next to the output records finished images so an interrupted run can
+be resumed. Images whose batch failed inference get an error row but stay
+out of the checkpoint, so the next run retries them (their retried row is
+appended after the error row).
+
+Usage:
+    python bulk_score.py IMAGE_DIR results.csv
+    python bulk_score.py IMAGE_DIR results.parquet --batch-size 64 --workers 8
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+from preprocessing import BufferPool, load_resized
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
+FIELDS = ['path', 'disease', 'confidence', 'error']
+
+
+def find_images(root):
+    """Yield image paths under ``root`` relative to it, in a stable order"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.relpath(os.path.join(dirpath, name), root)
+
+
+def _decode(path):
+    """Process-pool task: load and resize one image, timing the work"""
+    started = time.perf_counter()
+    try:
+        return load_resized(path), None, time.perf_counter() - started
+    except Exception as e:
+        return None, str(e), time.perf_counter() - started
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+class CsvResultWriter:
+    def __init__(self, path):
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, 'a', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=FIELDS)
+        if not exists:
+            self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetResultWriter:
+    """Writes each flush as a new part file inside the output directory"""
+
+    def __init__(self, path):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("✗ Parquet output needs pyarrow: pip install pyarrow")
+        self._dir = path
+        os.makedirs(path, exist_ok=True)
+        self._part = len([n for n in os.listdir(path) if n.endswith('.parquet')])
+
+    def write(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(rows, schema=pa.schema([
+            ('path', pa.string()), ('disease', pa.string()),
+            ('confidence', pa.float64()), ('error', pa.string())]))
+        part_path = os.path.join(self._dir, f"part-{self._part:05d}.parquet")
+        pq.write_table(table, part_path + '.tmp')
+        os.replace(part_path + '.tmp', part_path)
+        self._part += 1
+
+    def close(self):
+        pass
+
+
+class StageTimer:
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+
+def score(image_dir, output, batch_size=32, workers=None, prefetch=None, flush_every=1):
+    """Score every image under ``image_dir`` and write results to ``output``"""
+    # The models (and TensorFlow) are loaded only in the parent, on the
+    # first predict_batch call, so worker processes stay small.
+    import app as leaf_app
+
+    checkpoint_path = output + '.checkpoint'
+    done = load_checkpoint(checkpoint_path)
+    todo = [p for p in find_images(image_dir) if p not in done]
+    print(f"ℹ {len(done)} images already scored, {len(todo)} to go")
+    if not todo:
+        return
+
+    writer = ParquetResultWriter(output) if output.endswith('.parquet') else CsvResultWriter(output)
+    checkpoint = open(checkpoint_path, 'a', encoding='utf-8')
+    workers = workers or os.cpu_count() or 1
+    prefetch = prefetch or batch_size * 2
+    timer = StageTimer()
+    buffers = BufferPool(batch_size, max_buffers=1)
+    pending_rows = []
+    pending_done = []
+    scored = 0
+    undecodable = 0
+    failed = 0
+    started = time.perf_counter()
+
+    def flush():
+        t = time.perf_counter()
+        writer.write(pending_rows)
+        # Results are durable before their paths enter the checkpoint
+        checkpoint.writelines(p + '\n' for p in pending_done)
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+        pending_rows.clear()
+        pending_done.clear()
+        timer.add('write', time.perf_counter() - t)
+
+    def run_batch(batch):
+        """Score one batch; returns False if inference failed"""
+        t = time.perf_counter()
+        with buffers.batch([img for _, img in batch]) as images:
+            timer.add('normalize', time.perf_counter() - t)
+            t = time.perf_counter()
+            try:
+                results = leaf_app.predict_batch(images)
+            except Exception as e:
+                results = [(None, None, None)] * len(batch)
+                error = f"Prediction error: {str(e)}"
+            else:
+                error = None
+            timer.add('inference', time.perf_counter() - t)
+        for (rel_path, _), (disease, confidence, _version) in zip(batch, results):
+            pending_rows.append({'path': rel_path, 'disease': disease,
+                                 'confidence': None if confidence is None else round(confidence, 4),
+                                 'error': error})
+            # Only results and undecodable images are final; images whose
+            # inference failed are left for a resumed run to retry
+            if error is None:
+                pending_done.append(rel_path)
+        return error is None
+
+    try:
+        # Spawned workers never inherit TensorFlow's threads from the parent
+        spawn = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=spawn) as pool:
+            paths = iter(todo)
+            queue = deque()
+            batch = []
+            batches_since_flush = 0
+
+            def refill():
+                while len(queue) < prefetch:
+                    rel_path = next(paths, None)
+                    if rel_path is None:
+                        return
+                    queue.append((rel_path, pool.submit(_decode, os.path.join(image_dir, rel_path))))
+
+            refill()
+            while queue:
+                rel_path, future = queue.popleft()
+                t = time.perf_counter()
+                img, error, decode_seconds = future.result()
+                timer.add('decode_wait', time.perf_counter() - t)
+                timer.add('decode_cpu', decode_seconds)
+                refill()
+
+                if error is not None:
+                    pending_rows.append({'path': rel_path, 'disease': None, 'confidence': None, 'error': error})
+                    pending_done.append(rel_path)
+                    undecodable += 1
+                else:
+                    batch.append((rel_path, img))
+                if len(batch) >= batch_size or (not queue and batch):
+                    # Only images with a result count as scored
+                    if run_batch(batch):
+                        scored += len(batch)
+                    else:
+                        failed += len(batch)
+                    batch = []
+                    batches_since_flush += 1
+                if pending_rows and (batches_since_flush >= flush_every or not queue):
+                    flush()
+                    batches_since_flush = 0
+                    elapsed = time.perf_counter() - started
+                    print(f"  {len(done) + scored + undecodable}/{len(done) + len(todo)} images "
+                          f"({scored / elapsed:.1f} img/s)", end='\r', flush=True)
+    finally:
+        if pending_rows:
+            flush()
+        writer.close()
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - started
+    print()
+    print("=" * 50)
+    print(f"✓ Scored {scored} images in {elapsed:.1f}s ({scored / elapsed:.1f} img/s)")
+    if undecodable:
+        print(f"✗ Could not decode {undecodable} images")
+    if failed:
+        print(f"✗ Inference failed for {failed} images; run again to retry them")
+    print(f"  workers={workers} batch_size={batch_size} prefetch={prefetch}")
+    for stage in ('decode_cpu', 'decode_wait', 'normalize', 'inference', 'write'):
+        seconds = timer.totals.get(stage, 0.0)
+        per_image = seconds * 1000 / max(scored, 1)
+        print(f"  {stage:<12} {seconds:8.2f}s  {per_image:7.2f} ms/img")
+    print("  (decode_cpu is summed across worker processes; decode_wait is time"
+          " inference spent waiting on them)")
+    print("=" * 50)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-score a directory of leaf images")
+    parser.add_argument('image_dir', help="Directory tree of images to score")
+    parser.add_argument('output', help="Output .csv file or .parquet directory")
+    parser.add_argument('--batch-size', type=int, default=32, help="Images per CNN/XGBoost call")
+    parser.add_argument('--workers', type=int, default=None, help="Decode processes (default: CPU count)")
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help="Decoded images to keep queued ahead of inference (default: 2x batch size)")
+    parser.add_argument('--flush-every', type=int, default=1, help="Batches between output flushes")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.image_dir):
+        print(f"✗ Not a directory: {args.image_dir}")
+        return 1
+    score(args.image_dir, args.output, batch_size=args.batch_size, workers=args.workers,
+          prefetch=args.prefetch, flush_every=args.flush_every)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
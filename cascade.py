@@ -0,0 +1,340 @@
+"""
+Cheap pre-classifier that answers easy uploads without the CNN.
+
+A multinomial logistic regression over about fifty hand-crafted features
+is computed on a 64x64 copy of the prepared image: HSV histograms, Lab
+colour moments, the fractions of leaf, brown, yellow and dark pixels, and
+gradient/Laplacian texture statistics. The whole stage costs about a
+millisecond on one CPU core. When its top probability reaches the calibrated ``threshold``
+the pipeline returns its answer directly. Otherwise the image falls
+through to the CNN and classifier.
+
+The cascade is trained to reproduce the full pipeline's predictions (not
+the folder labels), because what matters is that skipping the CNN changes
+no answers. The threshold is the lowest one at which the held-out
+agreement with the full pipeline is still at least ``--target-agreement``.
+
+The model is a small JSON file, so serving needs only NumPy and OpenCV.
+
+Usage:
+    python cascade.py train LABELLED_DIR [--output cascade.json] [--target-agreement 0.99]
+    python cascade.py evaluate LABELLED_DIR [--model cascade.json]
+
+LABELLED_DIR holds one sub-directory per class, named after the class
+('healthy', 'late_blight', 'Tomato___Late_blight', ...). Images in folders
+that match no class still train the cascade; they are left out of accuracy.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from preprocessing import load_resized
+from tiling import leaf_fraction
+
+FEATURE_VERSION = 1
+FEATURE_SIZE = 64
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cascade.json")
+
+
+def cascade_features(image):
+    """Hand-crafted colour and texture features of a prepared BGR uint8 image"""
+    small = cv2.resize(image, (FEATURE_SIZE, FEATURE_SIZE), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    hue, sat, val = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    pixels = float(hue.size)
+
+    # Hue is only meaningful for saturated pixels
+    chromatic = (sat > 40).astype(np.uint8)
+    hue_hist = cv2.calcHist([hsv], [0], chromatic, [18], [0, 180]).ravel() / pixels
+    sat_hist = cv2.calcHist([hsv], [1], None, [8], [0, 256]).ravel() / pixels
+    val_hist = cv2.calcHist([hsv], [2], None, [8], [0, 256]).ravel() / pixels
+
+    lab = cv2.cvtColor(small, cv2.COLOR_BGR2LAB).reshape(-1, 3).astype(np.float32) / 255.0
+    colour_moments = np.concatenate([lab.mean(axis=0), lab.std(axis=0)])
+
+    saturated = sat > 50
+    fractions = np.array([
+        leaf_fraction(small),
+        np.count_nonzero(saturated & (hue >= 5) & (hue < 20)) / pixels,   # brown lesions
+        np.count_nonzero(saturated & (hue >= 20) & (hue < 35)) / pixels,  # yellowing
+        np.count_nonzero(val < 50) / pixels,                              # dark spots, shadow
+    ])
+
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255.0
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    magnitude = cv2.magnitude(gx, gy)
+    local_contrast = np.abs(gray - cv2.blur(gray, (5, 5)))
+    texture = np.array([
+        np.log1p(cv2.Laplacian(gray, cv2.CV_32F).var() * 1000.0),
+        magnitude.mean(), magnitude.std(),
+        local_contrast.mean(), local_contrast.std(),
+    ])
+    return np.concatenate([hue_hist, sat_hist, val_hist, colour_moments, fractions, texture]).astype(np.float64)
+
+
+class CascadeClassifier:
+    """Standardized-feature softmax regression with a confidence threshold"""
+
+    def __init__(self, classes, mean, scale, coef, intercept, threshold, answer_classes=None, version=None):
+        self.classes = list(classes)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        coef = np.asarray(coef, dtype=np.float64)
+        intercept = np.asarray(intercept, dtype=np.float64)
+        if len(self.classes) == 2 and coef.shape[0] == 1:
+            # Binary logistic regression: softmax over [0, z] is sigmoid(z)
+            coef = np.vstack([np.zeros_like(coef), coef])
+            intercept = np.concatenate([[0.0], intercept])
+        self.coef = coef
+        self.intercept = intercept
+        self.threshold = float(threshold)
+        self.answer_classes = set(answer_classes) if answer_classes else None
+        # Reported as the model version of the answers this cascade gives
+        self.version = version
+        self._lock = threading.Lock()
+        self.answered = 0
+        self.passed = 0
+        self._seconds = 0.0
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        model = json.loads(raw)
+        if model.get('feature_version') != FEATURE_VERSION:
+            raise ValueError(f"{path} was trained on feature version {model.get('feature_version')}, "
+                             f"this code computes version {FEATURE_VERSION}")
+        return cls(model['classes'], model['mean'], model['scale'], model['coef'], model['intercept'],
+                   model['threshold'], model.get('answer_classes'),
+                   version=f"cascade-{hashlib.sha256(raw).hexdigest()[:16]}")
+
+    def predict_proba(self, features):
+        z = (np.atleast_2d(features) - self.mean) / self.scale
+        logits = z @ self.coef.T + self.intercept
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, image, threshold=None):
+        """(disease, confidence percent) if confident enough, else None"""
+        started = time.perf_counter()
+        probabilities = self.predict_proba(cascade_features(image))[0]
+        best = int(probabilities.argmax())
+        threshold = self.threshold if threshold is None else threshold
+        disease = self.classes[best]
+        answer = None
+        if probabilities[best] >= threshold and (self.answer_classes is None or disease in self.answer_classes):
+            answer = disease, float(probabilities[best] * 100)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._seconds += elapsed
+            if answer is None:
+                self.passed += 1
+            else:
+                self.answered += 1
+        return answer
+
+    def stats(self):
+        with self._lock:
+            total = self.answered + self.passed
+            return {
+                'threshold': self.threshold,
+                'answer_classes': sorted(self.answer_classes) if self.answer_classes else None,
+                'answered': self.answered,
+                'passed_to_cnn': self.passed,
+                'coverage': round(self.answered / total, 4) if total else None,
+                'mean_ms': round(self._seconds / total * 1000, 3) if total else None,
+            }
+
+
+def find_labelled_images(root):
+    """(path, folder name) for every image below ``root``"""
+    items = []
+    for dirpath, _, filenames in os.walk(root):
+        folder = os.path.relpath(dirpath, root).split(os.sep)[0]
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                items.append((os.path.join(dirpath, name), None if folder == '.' else folder))
+    return sorted(items)
+
+
+def match_label(folder, classes):
+    """Class name for a folder such as 'Tomato___Late_blight', or None"""
+    if folder is None:
+        return None
+    name = ' '.join(folder.lower().replace('_', ' ').replace('-', ' ').split())
+    if name in classes:
+        return name
+    matches = [c for c in classes if name.endswith(c)]
+    return max(matches, key=len) if matches else None
+
+
+def _load_set(root, batch_size=32):
+    """Prepared images, cascade features, full-pipeline predictions and labels"""
+    import app as leaf_app
+
+    classes = [str(c) for c in leaf_app.registry.get().label_encoder.classes_]
+    images, labels, skipped = [], [], 0
+    for path, folder in find_labelled_images(root):
+        try:
+            images.append(load_resized(path))
+        except ValueError:
+            skipped += 1
+            continue
+        labels.append(match_label(folder, classes))
+    if not images:
+        raise ValueError(f"No readable images under {root}")
+    if skipped:
+        print(f"ℹ Skipped {skipped} unreadable images")
+
+    features = np.array([cascade_features(image) for image in images])
+    predictions = []
+    for start in range(0, len(images), batch_size):
+        predictions.extend(disease for disease, *_ in leaf_app.predict_prepared_batch(images[start:start + batch_size]))
+    return images, features, np.array(predictions), np.array(labels, dtype=object), classes
+
+
+def calibrate_threshold(confidence, agrees, target_agreement, min_answered=10):
+    """Lowest threshold whose answered subset agrees at least ``target_agreement``.
+
+    Returns 1.01 (never answer) when no threshold reaches the target on at
+    least ``min_answered`` samples.
+    """
+    order = np.argsort(-confidence)
+    running = np.cumsum(agrees[order]) / np.arange(1, len(order) + 1)
+    ok = np.nonzero((running >= target_agreement) & (np.arange(1, len(order) + 1) >= min_answered))[0]
+    if ok.size == 0:
+        return 1.01
+    return float(confidence[order][ok[-1]])
+
+
+def train(root, output, target_agreement=0.99, answer_classes=None, holdout=0.3, seed=0):
+    """Fit the cascade on full-pipeline predictions and calibrate its threshold"""
+    from sklearn.linear_model import LogisticRegression
+
+    _, features, predictions, labels, _ = _load_set(root)
+    trained_classes = sorted(set(predictions))
+    if len(trained_classes) < 2:
+        raise ValueError(f"The full pipeline predicted only {trained_classes} on {root}; "
+                         "the cascade needs examples of at least two classes")
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(features))
+    n_holdout = max(1, int(len(order) * holdout))
+    held, fit = order[:n_holdout], order[n_holdout:]
+
+    mean = features[fit].mean(axis=0)
+    scale = features[fit].std(axis=0)
+    scale[scale < 1e-9] = 1.0
+    regression = LogisticRegression(max_iter=2000, C=1.0)
+    regression.fit((features[fit] - mean) / scale, predictions[fit])
+
+    model = CascadeClassifier([str(c) for c in regression.classes_], mean, scale, regression.coef_,
+                              regression.intercept_, threshold=1.01, answer_classes=answer_classes)
+    probabilities = model.predict_proba(features[held])
+    best = probabilities.argmax(axis=1)
+    confidence = probabilities[np.arange(len(best)), best]
+    agrees = np.array([model.classes[b] for b in best]) == predictions[held]
+    if answer_classes:
+        allowed = np.isin([model.classes[b] for b in best], list(answer_classes))
+        confidence = np.where(allowed, confidence, 0.0)
+    threshold = calibrate_threshold(confidence, agrees, target_agreement,
+                                    min_answered=min(10, max(1, len(held) // 10)))
+    answered = confidence >= threshold
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'feature_version': FEATURE_VERSION,
+            'classes': model.classes,
+            'mean': mean.tolist(),
+            'scale': scale.tolist(),
+            'coef': regression.coef_.tolist(),
+            'intercept': regression.intercept_.tolist(),
+            'threshold': threshold,
+            'answer_classes': sorted(answer_classes) if answer_classes else None,
+            'target_agreement': target_agreement,
+            'trained_on': len(fit),
+            'calibrated_on': len(held),
+        }, f)
+    print(f"✓ Wrote {output}: {len(model.classes)} classes, threshold {threshold:.3f}")
+    print(f"  held-out coverage {answered.mean() * 100:.1f}%, agreement on answered "
+          f"{(agrees[answered].mean() * 100 if answered.any() else float('nan')):.1f}%")
+    return output
+
+
+def evaluate(root, model_path):
+    """Report coverage, agreement, accuracy and latency of the cascade"""
+    import app as leaf_app
+
+    cascade = CascadeClassifier.from_json(model_path)
+    images, _, predictions, labels, _ = _load_set(root)
+
+    # Time both paths one image at a time, as requests arrive in serving
+    cascade_seconds, full_seconds, answers = [], [], []
+    for image in images:
+        started = time.perf_counter()
+        answers.append(cascade.predict(image))
+        cascade_seconds.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        leaf_app.predict_prepared_batch([image])
+        full_seconds.append(time.perf_counter() - started)
+
+    answered = np.array([a is not None for a in answers])
+    cascade_labels = np.array([a[0] if a is not None else p for a, p in zip(answers, predictions)])
+    labelled = np.array([label is not None for label in labels])
+    full_ms = np.mean(full_seconds) * 1000
+    cascade_ms = np.mean(cascade_seconds) * 1000
+    pipeline_ms = cascade_ms + full_ms * (1 - answered.mean())
+
+    print(f"\nEvaluated on {len(images)} images ({labelled.sum()} labelled), threshold {cascade.threshold:.3f}")
+    print(f"  coverage (answered by the cascade) {answered.mean() * 100:>6.1f}%")
+    if answered.any():
+        print(f"  agreement with full pipeline        {np.mean(cascade_labels[answered] == predictions[answered]) * 100:>6.1f}% "
+              f"on answered images")
+    if labelled.any():
+        full_accuracy = np.mean(predictions[labelled] == labels[labelled])
+        cascade_accuracy = np.mean(cascade_labels[labelled] == labels[labelled])
+        print(f"  accuracy vs labels                  {full_accuracy * 100:>6.1f}% full, "
+              f"{cascade_accuracy * 100:.1f}% with cascade")
+    print(f"  latency per image                   {full_ms:>6.2f} ms full, {cascade_ms:.2f} ms cascade stage, "
+          f"{pipeline_ms:.2f} ms expected with cascade ({(1 - pipeline_ms / full_ms) * 100:.1f}% saved)")
+    return {'coverage': float(answered.mean()), 'full_ms': full_ms, 'cascade_ms': cascade_ms,
+            'pipeline_ms': pipeline_ms}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train and evaluate the pre-classifier cascade")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('train', help="Fit the cascade to the full pipeline and calibrate its threshold")
+    p.add_argument('root', help="Directory of images, one sub-directory per class")
+    p.add_argument('--output', default=DEFAULT_MODEL_PATH)
+    p.add_argument('--target-agreement', type=float, default=0.99,
+                   help="Required agreement with the full pipeline on answered images")
+    p.add_argument('--classes', nargs='+', default=None,
+                   help="Only answer these classes (for example: healthy)")
+    p.add_argument('--holdout', type=float, default=0.3, help="Fraction kept for threshold calibration")
+
+    p = sub.add_parser('evaluate', help="Report coverage, agreement and latency on a labelled set")
+    p.add_argument('root', help="Directory of images, one sub-directory per class")
+    p.add_argument('--model', default=DEFAULT_MODEL_PATH)
+
+    args = parser.parse_args(argv)
+    if args.command == 'train':
+        train(args.root, args.output, args.target_agreement, args.classes, args.holdout)
+    else:
+        evaluate(args.root, args.model)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Compiled TensorFlow serving backend for the CNN feature extractor.
+
+Keras' ``model.predict`` builds a data adapter and a fresh execution loop
+on every call, which dominates the cost of small batches. This backend
+calls the model from a ``tf.function`` with a fixed input signature
+(float32, any batch size, the model's image shape), so each call is a
+single graph execution. With ``jit_compile`` the graph is compiled by XLA;
+XLA specializes on the concrete batch size, so batches are padded up to
+the nearest of a few fixed sizes and every one of them is compiled during
+warm-up instead of on a live request.
+
+Thread pools are process-wide and must be sized before TensorFlow runs its
+first op, which is why ``configure_threads`` is called by the model
+registry right after importing TensorFlow.
+
+Usage:
+    python compiled_backend.py compare [--samples DIR] [--batch-sizes 1 8 16] [--xla]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from preprocessing import WIDTH, HEIGHT, process_image
+from tflite_backend import DEFAULT_H5_PATH, find_images
+
+
+def configure_threads(intra_op=0, inter_op=0):
+    """Size TensorFlow's thread pools; 0 leaves TensorFlow's default.
+
+    Returns False if TensorFlow was already initialized and the setting
+    could not be applied.
+    """
+    import tensorflow as tf
+
+    try:
+        if intra_op:
+            tf.config.threading.set_intra_op_parallelism_threads(int(intra_op))
+        if inter_op:
+            tf.config.threading.set_inter_op_parallelism_threads(int(inter_op))
+    except RuntimeError as e:
+        print(f"✗ Warning: TensorFlow thread settings not applied: {e}")
+        return False
+    return True
+
+
+def padded_batch_sizes(max_batch_size):
+    """Powers of two up to ``max_batch_size``, plus ``max_batch_size`` itself"""
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(int(max_batch_size))
+    return sizes
+
+
+class CompiledFeatureExtractor:
+    """Drop-in replacement for the Keras model's ``predict`` method.
+
+    ``batch_sizes`` are the batch sizes traced (and, with ``jit_compile``,
+    compiled) by ``warm_up``. Under XLA, inputs are zero-padded to the
+    smallest of them that fits and split into chunks of the largest.
+    """
+
+    def __init__(self, model, batch_sizes=(1,), jit_compile=False):
+        import tensorflow as tf
+
+        self.model = model
+        self.jit_compile = bool(jit_compile)
+        self.batch_sizes = sorted(set(int(size) for size in batch_sizes))
+        self.input_shape = tuple(int(dim) for dim in model.input_shape[1:])
+        signature = [tf.TensorSpec((None, *self.input_shape), tf.float32)]
+        self._function = tf.function(self._forward, input_signature=signature,
+                                     jit_compile=self.jit_compile, reduce_retracing=True)
+        self._lock = threading.Lock()
+        self.warmed_up = False
+
+    def _forward(self, images):
+        return self.model(images, training=False)
+
+    def _run(self, images):
+        return self._function(images).numpy()
+
+    def predict(self, images, verbose=0):
+        images = np.asarray(images, dtype=np.float32)
+        if not self.jit_compile:
+            return self._run(images)
+
+        largest = self.batch_sizes[-1]
+        outputs = []
+        for start in range(0, len(images), largest):
+            chunk = images[start:start + largest]
+            size = next(size for size in self.batch_sizes if size >= len(chunk))
+            if size != len(chunk):
+                padded = np.zeros((size, *chunk.shape[1:]), dtype=np.float32)
+                padded[:len(chunk)] = chunk
+                chunk = padded
+            outputs.append(self._run(chunk)[:min(largest, len(images) - start)])
+        return outputs[0] if len(outputs) == 1 else np.concatenate(outputs)
+
+    def warm_up(self):
+        """Trace (and compile) every batch size once; returns seconds taken"""
+        with self._lock:
+            started = time.perf_counter()
+            for size in self.batch_sizes:
+                self._run(np.zeros((size, *self.input_shape), dtype=np.float32))
+            self.warmed_up = True
+            return time.perf_counter() - started
+
+
+def _time_calls(predict, images, batch_size, repeats):
+    """(ms per call, images per second) over ``repeats`` calls of ``batch_size`` images"""
+    batch = images[:batch_size]
+    if len(batch) < batch_size:
+        batch = np.resize(images, (batch_size, *images.shape[1:]))
+    predict(batch)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        predict(batch)
+    elapsed = time.perf_counter() - started
+    return elapsed * 1000 / repeats, batch_size * repeats / elapsed
+
+
+def compare(h5_path, samples_dir=None, batch_sizes=(1, 8, 16), repeats=20, jit_compile=False,
+            intra_op=0, inter_op=0):
+    """Report per-call latency and throughput of Keras ``predict`` against
+    the compiled backend, with and without XLA"""
+    configure_threads(intra_op, inter_op)
+    from tensorflow.keras.models import load_model
+
+    paths = find_images(samples_dir, max(batch_sizes)) if samples_dir else []
+    if paths:
+        images = np.concatenate([process_image(p) for p in paths]).astype(np.float32)
+    else:
+        print("ℹ No sample images given; comparing on random inputs")
+        images = np.random.default_rng(0).random((max(batch_sizes), HEIGHT, WIDTH, 3), dtype=np.float32)
+
+    model = load_model(h5_path)
+    reference = model.predict(images, verbose=0)
+    backends = [('keras predict', lambda x: model.predict(x, verbose=0), 0.0, 0.0)]
+    for jit in ([False, True] if jit_compile else [False]):
+        extractor = CompiledFeatureExtractor(model, batch_sizes, jit_compile=jit)
+        warmup_seconds = extractor.warm_up()
+        max_diff = float(np.abs(extractor.predict(images) - reference).max())
+        backends.append(('compiled' + (' + xla' if jit else ''), extractor.predict, warmup_seconds, max_diff))
+
+    print(f"\nCompared on {len(images)} images, {repeats} calls per batch size "
+          f"(intra_op={intra_op or 'default'}, inter_op={inter_op or 'default'})")
+    print(f"{'backend':<16} {'warm-up s':>9} {'max |diff|':>11} " +
+          ' '.join(f"{f'bs{size} ms':>9} {f'bs{size} img/s':>11}" for size in batch_sizes))
+    rows = []
+    for name, predict, warmup_seconds, max_diff in backends:
+        timings = [_time_calls(predict, images, size, repeats) for size in batch_sizes]
+        rows.append((name, warmup_seconds, max_diff, timings))
+        print(f"{name:<16} {warmup_seconds:>9.2f} {max_diff:>11.2e} " +
+              ' '.join(f"{ms:>9.2f} {rate:>11.1f}" for ms, rate in timings))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the compiled CNN backend with Keras predict")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('compare', help="Time Keras predict against the compiled backend")
+    p.add_argument('--h5', default=DEFAULT_H5_PATH)
+    p.add_argument('--samples', default=None, help="Directory of sample images")
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 16])
+    p.add_argument('--repeats', type=int, default=20)
+    p.add_argument('--xla', action='store_true', help="Also time the XLA-compiled backend")
+    p.add_argument('--intra-op-threads', type=int, default=int(os.environ.get('LEAF_TF_INTRA_OP_THREADS', 0)))
+    p.add_argument('--inter-op-threads', type=int, default=int(os.environ.get('LEAF_TF_INTER_OP_THREADS', 0)))
+
+    args = parser.parse_args(argv)
+    compare(args.h5, args.samples, args.batch_sizes, args.repeats, args.xla,
+            args.intra_op_threads, args.inter_op_threads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""
+Streaming accuracy and throughput evaluation of the CNN + classifier pipeline.
+
+Images under a labelled directory are read by a ``tf.data`` pipeline that
+decodes and resizes them on ``--parallel`` threads (cv2 releases the GIL),
+batches them and prefetches ``--prefetch`` batches ahead of the models.
+Decoding goes through ``load_resized``, the function ``process_image``
+uses, and batches are normalized with the same lookup table into a pooled
+buffer, so the models see exactly the inputs they see in serving. Only
+paths, labels and running counts are held, so memory does not grow with
+the dataset.
+
+The report has a confusion matrix, per-class precision and recall, and
+images per second for each stage. The input stage is the time the models
+sat waiting for the next batch; near zero means the pipeline keeps up.
+``--input-only`` runs the pipeline without the models to measure how fast
+it can go on its own. A parallelism or prefetch of 0 lets tf.data tune it.
+
+Usage:
+    python evaluate.py LABELLED_DIR [--batch-size 32] [--parallel 0] [--prefetch 0] [--output report.json]
+    python evaluate.py LABELLED_DIR --input-only --parallel 8
+
+LABELLED_DIR holds one sub-directory per class, named after the class
+(see ``cascade.py``). Images in folders that match no class are skipped.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from cascade import find_labelled_images, match_label
+from preprocessing import WIDTH, HEIGHT, BufferPool, load_resized
+
+STAGES = ('input', 'normalize', 'cnn', 'classifier')
+
+
+def labelled_paths(root, classes):
+    """(paths, label indices, unmatched count) for the images under ``root``"""
+    index = {name: i for i, name in enumerate(classes)}
+    paths, labels, unmatched = [], [], 0
+    for path, folder in find_labelled_images(root):
+        label = match_label(folder, classes)
+        if label is None:
+            unmatched += 1
+            continue
+        paths.append(path)
+        labels.append(index[label])
+    return paths, np.array(labels, dtype=np.int32), unmatched
+
+
+def _read(path):
+    """tf.numpy_function body: (prepared uint8 image, readable?)"""
+    try:
+        return load_resized(path.decode()), True
+    except ValueError:
+        return np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8), False
+
+
+def build_dataset(paths, labels, batch_size=32, parallel=0, prefetch=0):
+    """Batches of (uint8 images, label indices); unreadable images are dropped"""
+    import tensorflow as tf
+
+    def load(path, label):
+        image, ok = tf.numpy_function(_read, [path], (tf.uint8, tf.bool))
+        image.set_shape((HEIGHT, WIDTH, 3))
+        ok.set_shape(())
+        return image, label, ok
+
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+    # Order does not matter for the counts, so a slow image never stalls the rest
+    dataset = dataset.map(load, num_parallel_calls=parallel or tf.data.AUTOTUNE, deterministic=False)
+    dataset = dataset.filter(lambda image, label, ok: ok)
+    dataset = dataset.map(lambda image, label, ok: (image, label))
+    return dataset.batch(batch_size).prefetch(prefetch or tf.data.AUTOTUNE)
+
+
+def class_metrics(confusion, classes):
+    """Per-class precision, recall and support from a confusion matrix
+    (rows are true classes, columns predictions)"""
+    predicted = confusion.sum(axis=0)
+    actual = confusion.sum(axis=1)
+    correct = np.diag(confusion)
+    return {
+        name: {
+            'precision': round(float(correct[i] / predicted[i]), 4) if predicted[i] else None,
+            'recall': round(float(correct[i] / actual[i]), 4) if actual[i] else None,
+            'support': int(actual[i]),
+        }
+        for i, name in enumerate(classes)
+    }
+
+
+def evaluate(root, batch_size=32, parallel=0, prefetch=0, limit=None):
+    """Stream every labelled image through the models; returns the report"""
+    import app as leaf_app
+
+    models = leaf_app.registry.get()
+    classes = [str(c) for c in models.label_encoder.classes_]
+    paths, labels, unmatched = labelled_paths(root, classes)
+    if limit:
+        paths, labels = paths[:limit], labels[:limit]
+    if not paths:
+        raise ValueError(f"No images under {root} are in a folder named after a class")
+    print(f"ℹ Evaluating {len(paths)} images ({unmatched} in unmatched folders skipped)")
+
+    class_index = {name: i for i, name in enumerate(classes)}
+    confusion = np.zeros((len(classes), len(classes)), dtype=np.int64)
+    seconds = dict.fromkeys(STAGES, 0.0)
+    pool = BufferPool(batch_size, max_buffers=1)
+    evaluated = 0
+
+    batches = iter(build_dataset(paths, labels, batch_size, parallel, prefetch))
+    started = time.perf_counter()
+    while True:
+        t = time.perf_counter()
+        batch = next(batches, None)
+        seconds['input'] += time.perf_counter() - t
+        if batch is None:
+            break
+        images, batch_labels = batch[0].numpy(), batch[1].numpy()
+
+        t = time.perf_counter()
+        with pool.batch(images) as inputs:
+            seconds['normalize'] += time.perf_counter() - t
+            t = time.perf_counter()
+            features = models.cnn.predict(inputs, verbose=0)
+            seconds['cnn'] += time.perf_counter() - t
+        t = time.perf_counter()
+        class_names, _, _ = leaf_app.score_features(models, features)
+        seconds['classifier'] += time.perf_counter() - t
+
+        predicted = np.array([class_index[str(name)] for name in class_names])
+        np.add.at(confusion, (batch_labels, predicted), 1)
+        evaluated += len(batch_labels)
+    elapsed = time.perf_counter() - started
+    if not evaluated:
+        raise ValueError(f"None of the images under {root} could be read")
+
+    return {
+        'images': evaluated,
+        'unreadable': len(paths) - evaluated,
+        'unmatched_folder': unmatched,
+        'batch_size': batch_size,
+        'parallel': parallel or 'autotune',
+        'prefetch': prefetch or 'autotune',
+        'cnn_backend': leaf_app.registry.cnn_backend,
+        'accuracy': round(float(np.trace(confusion) / evaluated), 4),
+        'classes': classes,
+        'confusion_matrix': confusion.tolist(),
+        'per_class': class_metrics(confusion, classes),
+        'seconds': {stage: round(value, 3) for stage, value in seconds.items()},
+        'images_per_second': {
+            **{stage: round(evaluated / value, 1) if value else None for stage, value in seconds.items()},
+            'end_to_end': round(evaluated / elapsed, 1) if elapsed else None,
+        },
+    }
+
+
+def time_input(root, batch_size=32, parallel=0, prefetch=0, limit=None):
+    """Images per second of the input pipeline alone"""
+    import app as leaf_app
+
+    classes = [str(c) for c in np.load(leaf_app.LABEL_ENCODER_PATH, allow_pickle=True)]
+    paths, labels, _ = labelled_paths(root, classes)
+    if limit:
+        paths, labels = paths[:limit], labels[:limit]
+    dataset = build_dataset(paths, labels, batch_size, parallel, prefetch)
+    started = time.perf_counter()
+    images = sum(len(batch_labels) for _, batch_labels in dataset)
+    elapsed = time.perf_counter() - started
+    return {'images': images, 'seconds': round(elapsed, 3),
+            'images_per_second': round(images / elapsed, 1) if elapsed else None}
+
+
+def print_report(report):
+    classes = report['classes']
+    width = max(len(name) for name in classes)
+    print(f"\nAccuracy: {report['accuracy']:.2%} over {report['images']} images "
+          f"({report['unreadable']} unreadable)")
+    print(f"\n{'class':<{width}} {'precision':>9} {'recall':>7} {'support':>8}")
+    for name, row in report['per_class'].items():
+        precision = '-' if row['precision'] is None else f"{row['precision']:.3f}"
+        recall = '-' if row['recall'] is None else f"{row['recall']:.3f}"
+        print(f"{name:<{width}} {precision:>9} {recall:>7} {row['support']:>8}")
+
+    print("\nConfusion matrix (rows: true class, columns: predicted, numbered as above)")
+    print(' ' * 4 + ''.join(f"{i:>6}" for i in range(len(classes))))
+    for i, row in enumerate(report['confusion_matrix']):
+        print(f"{i:>4}" + ''.join(f"{count:>6}" for count in row))
+
+    print(f"\nThroughput (batch {report['batch_size']}, parallel {report['parallel']}, "
+          f"prefetch {report['prefetch']}, {report['cnn_backend']} CNN)")
+    print(f"{'stage':<12} {'seconds':>8} {'img/s':>9}")
+    for stage, value in report['seconds'].items():
+        rate = report['images_per_second'][stage]
+        print(f"{stage:<12} {value:>8.2f} {rate if rate is not None else '-':>9}")
+    print(f"{'end to end':<12} {'':>8} {report['images_per_second']['end_to_end']:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate accuracy and throughput on a labelled image folder")
+    parser.add_argument('labelled_dir')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--parallel', type=int, default=0, help="Decode threads; 0 lets tf.data tune it")
+    parser.add_argument('--prefetch', type=int, default=0, help="Batches read ahead; 0 lets tf.data tune it")
+    parser.add_argument('--limit', type=int, default=None, help="Evaluate at most this many images")
+    parser.add_argument('--input-only', action='store_true', help="Time the input pipeline without the models")
+    parser.add_argument('--output', default=None, help="Also write the report as JSON")
+
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.labelled_dir):
+        print(f"✗ {args.labelled_dir} is not a directory")
+        return 1
+    if args.input_only:
+        report = time_input(args.labelled_dir, args.batch_size, args.parallel, args.prefetch, args.limit)
+        print(f"✓ Input pipeline: {report['images']} images in {report['seconds']:.2f}s "
+              f"({report['images_per_second']} img/s)")
+    else:
+        report = evaluate(args.labelled_dir, args.batch_size, args.parallel, args.prefetch, args.limit)
+        print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
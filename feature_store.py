@@ -0,0 +1,443 @@
+"""
+Append-only store of CNN feature vectors keyed by image content hash.
+
+Layout of a store directory:
+
+    meta.json        feature dimension, current generation and the
+                     extractor versions seen so far
+    index.<G>.bin    fixed-size records: SHA-256 digest, extractor version
+                     id, timestamp; row ``i`` describes row ``i`` of the
+                     features file of the same generation
+    features.<G>.f32 float32 feature rows, appended in index order
+
+Rows are read through ``numpy.memmap``, so batches of historical features
+can be fed to a new classifier without copying or re-running the CNN.
+Appends from several threads or worker processes are serialized with a
+lock file; the index record is written after the feature row, so a row
+only becomes visible once it is complete. Compaction writes a new
+generation of both files and switches ``meta.json`` over atomically.
+
+Usage:
+    python feature_store.py stats STORE
+    python feature_store.py rescore STORE --model new_xgb.json [--labels classes.npy] [--projection P.npz]
+                                          [--version ID | --all-versions] [--output out.csv]
+    python feature_store.py compact STORE [--keep-version ID ...]
+"""
+import argparse
+import atexit
+import csv
+import fcntl
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Keys are raw void bytes: a NUL-padded 'S32' field would strip digests
+# that happen to end in zero bytes
+INDEX_DTYPE = np.dtype([('key', 'V32'), ('version', '<u4'), ('stored_at', '<f8')])
+FEATURE_DTYPE = np.dtype('<f4')
+
+
+def _key_bytes(key):
+    return bytes.fromhex(key) if isinstance(key, str) else bytes(key)
+
+
+class FeatureStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._meta_path = os.path.join(path, 'meta.json')
+        self._lock_path = os.path.join(path, 'lock')
+        self._thread_lock = threading.Lock()
+        self._positions = {}  # (key, version) -> latest row
+        self._positions_generation = None
+        self._indexed_rows = 0
+        with self._locked():
+            self._meta = self._read_meta()
+            if not os.path.exists(self._meta_path):
+                self._write_meta()
+            for name in self._files(self._meta['generation']):
+                open(name, 'ab').close()
+
+    # -- locking and metadata -------------------------------------------
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            with open(self._lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self):
+        if not os.path.exists(self._meta_path):
+            return {'dim': None, 'generation': 0, 'versions': []}
+        with open(self._meta_path) as f:
+            return json.load(f)
+
+    def _write_meta(self):
+        tmp_path = self._meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._meta, f, indent=2)
+        os.replace(tmp_path, self._meta_path)
+
+    def _files(self, generation):
+        return (os.path.join(self.path, f'index.{generation}.bin'),
+                os.path.join(self.path, f'features.{generation}.f32'))
+
+    @property
+    def dim(self):
+        return self._meta['dim']
+
+    @property
+    def versions(self):
+        return list(self._meta['versions'])
+
+    def register_version(self, name, **info):
+        """Return the id for extractor version ``name``, adding it if new"""
+        with self._locked():
+            self._meta = self._read_meta()
+            for version in self._meta['versions']:
+                if version['name'] == name:
+                    return version['id']
+            version_id = len(self._meta['versions'])
+            self._meta['versions'].append({'id': version_id, 'name': name, 'registered_at': time.time(), **info})
+            self._write_meta()
+            return version_id
+
+    # -- writing --------------------------------------------------------
+
+    def append(self, keys, features, version, skip_existing=True):
+        """Append feature rows for content hashes ``keys``; returns rows written"""
+        features = np.ascontiguousarray(features, dtype=FEATURE_DTYPE)
+        if features.ndim != 2 or features.shape[0] != len(keys):
+            raise ValueError("features must have one row per key")
+        with self._locked():
+            self._meta = self._read_meta()
+            if self._meta['dim'] is None:
+                self._meta['dim'] = int(features.shape[1])
+                self._write_meta()
+            elif features.shape[1] != self._meta['dim']:
+                raise ValueError(f"Feature dimension {features.shape[1]} does not match store ({self._meta['dim']})")
+
+            index_path, features_path = self._files(self._meta['generation'])
+            self._refresh_positions()
+            raw_keys = [_key_bytes(k) for k in keys]
+            if skip_existing:
+                keep = [i for i, k in enumerate(raw_keys) if (k, version) not in self._positions]
+                # Duplicates inside one call also only need storing once
+                seen = set()
+                keep = [i for i in keep if not (raw_keys[i] in seen or seen.add(raw_keys[i]))]
+            else:
+                keep = list(range(len(raw_keys)))
+            if not keep:
+                return 0
+
+            rows = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+            # Drop any partial row left by a writer that died mid-append
+            with open(features_path, 'r+b') as f:
+                f.truncate(rows * self.dim * FEATURE_DTYPE.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(features[keep].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            records = np.zeros(len(keep), dtype=INDEX_DTYPE)
+            records['key'] = np.frombuffer(b''.join(raw_keys[i] for i in keep), dtype='V32')
+            records['version'] = version
+            records['stored_at'] = time.time()
+            with open(index_path, 'ab') as f:
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh_positions()
+            return len(keep)
+
+    # -- reading --------------------------------------------------------
+
+    def snapshot(self):
+        """Consistent memory-mapped (index, features) views of committed rows"""
+        while True:
+            meta = self._read_meta()
+            index_path, features_path = self._files(meta['generation'])
+            try:
+                rows = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+                if rows == 0 or meta['dim'] is None:
+                    index = np.zeros(0, dtype=INDEX_DTYPE)
+                    features = np.zeros((0, meta['dim'] or 0), dtype=FEATURE_DTYPE)
+                else:
+                    index = np.memmap(index_path, dtype=INDEX_DTYPE, mode='r', shape=(rows,))
+                    features = np.memmap(features_path, dtype=FEATURE_DTYPE, mode='r', shape=(rows, meta['dim']))
+            except FileNotFoundError:
+                # A compaction switched generations under us; read meta again
+                continue
+            self._meta = meta
+            return index, features
+
+    def __len__(self):
+        return len(self.snapshot()[0])
+
+    def _refresh_positions(self):
+        index, _ = self.snapshot()
+        if self._meta['generation'] != self._positions_generation:
+            self._positions.clear()
+            self._indexed_rows = 0
+            self._positions_generation = self._meta['generation']
+        for row in range(self._indexed_rows, len(index)):
+            self._positions[(bytes(index['key'][row]), int(index['version'][row]))] = row
+        self._indexed_rows = len(index)
+
+    def lookup(self, keys, version):
+        """Row numbers for ``keys`` under ``version`` (-1 where missing)"""
+        with self._thread_lock:
+            self._refresh_positions()
+            return np.array([self._positions.get((_key_bytes(k), version), -1) for k in keys], dtype=np.int64)
+
+    def get(self, keys, version):
+        """Features for ``keys`` (rows of NaN where a key is missing)"""
+        rows = self.lookup(keys, version)
+        _, features = self.snapshot()
+        out = np.full((len(rows), features.shape[1]), np.nan, dtype=FEATURE_DTYPE)
+        found = rows >= 0
+        if found.any():
+            out[found] = features[rows[found]]
+        return out
+
+    def iter_batches(self, batch_size=1024, version=None, latest_only=True):
+        """Yield (hex_keys, features) batches.
+
+        Features are zero-copy memmap slices whenever every row in the range
+        is selected.
+        """
+        index, features = self.snapshot()
+        selected = np.ones(len(index), dtype=bool)
+        if version is not None:
+            selected &= index['version'] == version
+        if latest_only:
+            selected &= _latest_mask(index)
+        for start in range(0, len(index), batch_size):
+            stop = min(start + batch_size, len(index))
+            mask = selected[start:stop]
+            if not mask.any():
+                continue
+            keys = [bytes(k).hex() for k in index['key'][start:stop][mask]]
+            batch = features[start:stop] if mask.all() else features[start:stop][mask]
+            yield keys, batch
+
+    # -- maintenance ----------------------------------------------------
+
+    def compact(self, keep_versions=None):
+        """Rewrite the store keeping only the latest row per (key, version)"""
+        with self._locked():
+            self._meta = self._read_meta()
+            index, features = self.snapshot()
+            keep = _latest_mask(index)
+            if keep_versions is not None:
+                keep &= np.isin(index['version'], list(keep_versions))
+            rows = np.flatnonzero(keep)
+
+            old_files = self._files(self._meta['generation'])
+            generation = self._meta['generation'] + 1
+            index_path, features_path = self._files(generation)
+            with open(features_path, 'wb') as f:
+                for start in range(0, len(rows), 4096):
+                    f.write(np.ascontiguousarray(features[rows[start:start + 4096]]).tobytes())
+            with open(index_path, 'wb') as f:
+                f.write(np.ascontiguousarray(index[rows]).tobytes())
+            removed = len(index) - len(rows)
+            del index, features
+
+            # Readers pick up the new generation from meta.json; open memmaps
+            # of the old files stay valid until they are released.
+            self._meta['generation'] = generation
+            self._write_meta()
+            for name in old_files:
+                os.remove(name)
+            self._refresh_positions()
+            return removed
+
+    def stats(self):
+        index, _ = self.snapshot()
+        index_path, features_path = self._files(self._read_meta()['generation'])
+        per_version = np.bincount(index['version'], minlength=len(self.versions)) if len(index) else []
+        return {
+            'rows': int(len(index)),
+            'unique_keys': int(len(np.unique(index['key']))) if len(index) else 0,
+            'dim': self.dim,
+            'bytes': os.path.getsize(features_path) + os.path.getsize(index_path),
+            'versions': [{**v, 'rows': int(per_version[v['id']]) if v['id'] < len(per_version) else 0}
+                         for v in self.versions],
+        }
+
+
+def _latest_mask(index):
+    """True for the last occurrence of each (key, version) pair"""
+    if len(index) == 0:
+        return np.zeros(0, dtype=bool)
+    pairs = np.empty(len(index), dtype=[('key', 'V32'), ('version', '<u4')])
+    pairs['key'] = index['key']
+    pairs['version'] = index['version']
+    # np.unique returns first occurrences, so search the reversed array
+    _, first_in_reversed = np.unique(pairs[::-1], return_index=True)
+    mask = np.zeros(len(index), dtype=bool)
+    mask[len(index) - 1 - first_in_reversed] = True
+    return mask
+
+
+class FeatureWriter:
+    """Append feature rows to a store on a daemon thread.
+
+    Keeps the lock file and fsyncs of ``append`` off the inference path.
+    Rows queued while a write is in progress are appended together, one
+    call per extractor version. The queue is bounded; when it is full new
+    rows are dropped and counted, since the features can be recomputed.
+    """
+
+    def __init__(self, store, max_pending=256):
+        self.store = store
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name="feature-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, keys, features, version):
+        """Queue rows for ``keys``; returns False if they were dropped"""
+        try:
+            self._queue.put_nowait((list(keys), features, version))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(keys)
+            return False
+
+    def flush(self):
+        """Block until every queued row has been appended"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            by_version = {}
+            for keys, features, version in items:
+                by_version.setdefault(version, []).append((keys, features))
+            for version, parts in by_version.items():
+                keys = [key for part_keys, _ in parts for key in part_keys]
+                try:
+                    written = self.store.append(keys, np.concatenate([f for _, f in parts]), version)
+                    with self._lock:
+                        self.written += written
+                except Exception as e:
+                    print(f"✗ Warning: could not store features: {e}")
+                    with self._lock:
+                        self.failed += len(keys)
+            for _ in items:
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+
+def rescore(store, model_path, labels_path, output, version=None, batch_size=4096, projection_path=None,
+            all_versions=False):
+    """Run a classifier over stored features without touching the CNN.
+
+    Only rows of ``version`` are scored, by default the most recently
+    registered extractor version; rows of different extractors are mixed
+    only with ``all_versions``. A classifier trained on projected features
+    (see ``projection.py``) needs its ``projection_path``; stored rows are
+    always full width.
+    """
+    if version is None and not all_versions and store.versions:
+        version = store.versions[-1]['id']
+        print(f"ℹ Scoring rows of extractor version {version} ({store.versions[-1]['name']})")
+    from xgboost import XGBClassifier
+
+    classifier = XGBClassifier()
+    classifier.load_model(model_path)
+    classes = np.load(labels_path, allow_pickle=True) if labels_path else None
+    projection = None
+    if projection_path:
+        from projection import Projection
+        projection = Projection.load(projection_path)
+
+    started = time.perf_counter()
+    total = 0
+    with open(output, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['key', 'disease', 'confidence'])
+        for keys, features in store.iter_batches(batch_size, version=version):
+            if projection is not None:
+                features = projection.transform(features)
+            proba = classifier.predict_proba(features)
+            idx = np.argmax(proba, axis=1)
+            names = classes[idx] if classes is not None else idx
+            confidence = proba[np.arange(len(idx)), idx] * 100
+            writer.writerows(zip(keys, names, np.round(confidence, 4)))
+            total += len(keys)
+    elapsed = time.perf_counter() - started
+    print(f"✓ Rescored {total} stored feature rows in {elapsed:.2f}s "
+          f"({total / max(elapsed, 1e-9):.0f} rows/s) -> {output}")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and maintain the CNN feature store")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('stats', help="Show row counts per extractor version")
+    p.add_argument('store')
+
+    p = sub.add_parser('rescore', help="Score stored features with a classifier model")
+    p.add_argument('store')
+    p.add_argument('--model', required=True, help="XGBoost model JSON")
+    p.add_argument('--labels', default=None, help="label_encoder_classes.npy")
+    p.add_argument('--projection', default=None, help="feature_projection.npz the model was trained on")
+    p.add_argument('--output', default='rescored.csv')
+    p.add_argument('--version', type=int, default=None,
+                   help="Only rows from this extractor version (default: the latest registered)")
+    p.add_argument('--all-versions', action='store_true', help="Score rows from every extractor version")
+
+    p = sub.add_parser('compact', help="Drop superseded rows and, optionally, old extractor versions")
+    p.add_argument('store')
+    p.add_argument('--keep-version', type=int, action='append', default=None)
+
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.store):
+        print(f"✗ Not a feature store: {args.store}")
+        return 1
+    store = FeatureStore(args.store)
+    if args.command == 'stats':
+        print(json.dumps(store.stats(), indent=2))
+    elif args.command == 'rescore':
+        rescore(store, args.model, args.labels, args.output, version=args.version,
+                projection_path=args.projection, all_versions=args.all_versions)
+    else:
+        removed = store.compact(keep_versions=args.keep_version)
+        print(f"✓ Compacted {args.store}: removed {removed} rows, {len(store)} remain")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
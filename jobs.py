@@ -0,0 +1,258 @@
+"""
+Asynchronous prediction jobs.
+
+``JobRunner`` accepts work, returns a job id immediately and runs the work
+on a bounded thread pool, recording progress in a ``JobStore``. Two stores
+are provided: ``MemoryJobStore`` (the default, one process) and
+``SQLiteJobStore``, which survives restarts and is shared by every worker
+process pointed at the same file. Finished jobs expire after a TTL.
+
+A job is a dict with ``id``, ``status`` (queued, running, done, failed),
+``stage`` (a finer-grained progress label), ``result``, ``error``,
+``created_at`` and ``updated_at``.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+FINISHED = ('done', 'failed')
+
+
+class QueueFull(Exception):
+    """Raised when too many jobs are already waiting"""
+
+
+class JobStore(ABC):
+    """Interface for job state backends; all methods must be thread-safe"""
+
+    @abstractmethod
+    def create(self, job):
+        """Store a new job dict"""
+
+    @abstractmethod
+    def update(self, job_id, **fields):
+        """Merge ``fields`` into the job and bump ``updated_at``"""
+
+    @abstractmethod
+    def get(self, job_id):
+        """Return the job dict, or None if unknown or expired"""
+
+    @abstractmethod
+    def purge_expired(self):
+        """Drop finished jobs older than the TTL; returns how many"""
+
+    @abstractmethod
+    def counts(self):
+        """Number of stored jobs per status"""
+
+
+class MemoryJobStore(JobStore):
+    def __init__(self, ttl_seconds=3600, max_jobs=10000):
+        self.ttl = float(ttl_seconds)
+        self.max_jobs = int(max_jobs)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+            # Bound memory even if nobody ever collects the results
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or self._expired(job, time.time()):
+                return None
+            return dict(job)
+
+    def _expired(self, job, now):
+        return job['status'] in FINISHED and now - job['updated_at'] > self.ttl
+
+    def purge_expired(self):
+        with self._lock:
+            now = time.time()
+            expired = [job_id for job_id, job in self._jobs.items() if self._expired(job, now)]
+            for job_id in expired:
+                del self._jobs[job_id]
+            return len(expired)
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return counts
+
+
+class SQLiteJobStore(JobStore):
+    """Jobs in a SQLite table shared by every process using the same file.
+
+    A job that stays queued or running without an update for
+    ``stale_seconds`` belonged to a process that died or restarted, and is
+    reported as failed.
+    """
+
+    def __init__(self, db_path, ttl_seconds=3600, stale_seconds=600):
+        self.ttl = float(ttl_seconds)
+        self.stale = float(stale_seconds)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL, data TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)")
+        self._db.commit()
+
+    def create(self, job):
+        with self._lock:
+            self._db.execute("INSERT INTO jobs (id, status, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?)",
+                             (job['id'], job['status'], job['created_at'], job['updated_at'], json.dumps(job)))
+            self._db.commit()
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            job = json.loads(row[0])
+            job.update(fields, updated_at=time.time())
+            self._db.execute("UPDATE jobs SET status = ?, updated_at = ?, data = ? WHERE id = ?",
+                             (job['status'], job['updated_at'], json.dumps(job), job_id))
+            self._db.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        age = time.time() - job['updated_at']
+        if job['status'] in FINISHED:
+            return None if age > self.ttl else job
+        if age > self.stale:
+            job.update(status='failed', stage='failed', error='Job was interrupted by a server restart')
+        return job
+
+    def purge_expired(self):
+        with self._lock:
+            now = time.time()
+            cursor = self._db.execute(
+                "DELETE FROM jobs WHERE (status IN (?, ?) AND updated_at < ?) OR updated_at < ?",
+                (*FINISHED, now - self.ttl, now - self.stale - self.ttl))
+            self._db.commit()
+            return cursor.rowcount
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class JobRunner:
+    """Run ``fn(progress, *args)`` for each submitted job on a bounded pool.
+
+    ``fn`` reports progress by calling ``progress(stage)`` and returns the
+    JSON-serializable result. At most ``max_pending`` jobs wait for a
+    worker; beyond that ``submit`` raises ``QueueFull``.
+    """
+
+    def __init__(self, store, max_workers=2, max_pending=64, purge_interval=60.0):
+        self.store = store
+        self.max_pending = int(max_pending)
+        self.purge_interval = float(purge_interval)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prediction-job")
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending = 0
+        self._last_purge = time.monotonic()
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, fn, *args):
+        """Queue a job and return its id without waiting for it to run"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise QueueFull(f"{self._pending} jobs already waiting")
+            self._pending += 1
+            self.submitted += 1
+        self._maybe_purge()
+
+        now = time.time()
+        job = {'id': uuid.uuid4().hex, 'status': 'queued', 'stage': 'queued', 'result': None,
+               'error': None, 'created_at': now, 'updated_at': now}
+        self.store.create(job)
+        self._executor.submit(self._run, job['id'], fn, args)
+        return job['id']
+
+    def _run(self, job_id, fn, args):
+        with self._lock:
+            self._pending -= 1
+
+        def progress(stage):
+            self._update(job_id, status='running', stage=stage)
+
+        progress('running')
+        try:
+            result = fn(progress, *args)
+        except Exception as e:
+            self._update(job_id, status='failed', stage='failed', error=str(e))
+            with self._lock:
+                self.failed += 1
+        else:
+            self._update(job_id, status='done', stage='done', result=result)
+            with self._lock:
+                self.completed += 1
+
+    def _update(self, job_id, **fields):
+        self.store.update(job_id, **fields)
+        with self._changed:
+            self._changed.notify_all()
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        self.store.purge_expired()
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def wait_for_change(self, timeout):
+        """Block until any job in this process changes, or ``timeout`` passes.
+
+        Jobs run by other processes (shared SQLite store) are only seen by
+        polling, so callers should use a short timeout.
+        """
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+        stats['stored'] = self.store.counts()
+        return stats
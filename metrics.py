@@ -0,0 +1,352 @@
+"""
+Lightweight metrics with Prometheus text-format export.
+
+Counters, gauges and histograms live in plain dicts guarded by one lock
+per metric, so recording a value costs a dict update and, for histograms,
+a bisect over the bucket bounds: about a microsecond on the request path.
+
+With several worker processes (gunicorn, uwsgi) each process only sees its
+own requests. Give every worker the same ``multiprocess_dir``: each one
+periodically writes a JSON snapshot of its metrics there, named after its
+pid, and ``render`` merges every snapshot it finds. Counters and
+histograms are summed over all snapshots, including those of workers that
+have exited, so totals never go backwards while the directory lives; clear
+it when the server starts. Gauges only count live processes.
+"""
+import atexit
+import json
+import math
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds; tuned for a pipeline whose stages range from microseconds
+# (response building) to seconds (a CNN batch on a busy CPU)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+GAUGE_MODES = ('sum', 'max', 'min', 'all')
+
+# Snapshot files are named after the writing process's pid
+SNAPSHOT_PATTERN = re.compile(r'^\d+\.json(\.tmp)?$')
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {labelvalues}")
+        return tuple(str(value) for value in labelvalues)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(labels), _copy(value)] for labels, value in self._values.items()]
+        return {'kind': self.kind, 'help': self.documentation, 'labelnames': list(self.labelnames),
+                'samples': samples}
+
+
+class Counter(_Metric):
+    """A monotonically increasing count; name it ``*_total``"""
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down.
+
+    ``mode`` says how values from several processes are combined: summed,
+    the max or min, or ``all`` to keep one series per process with a
+    ``pid`` label.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), mode='sum'):
+        if mode not in GAUGE_MODES:
+            raise ValueError(f"mode must be one of {GAUGE_MODES}")
+        super().__init__(name, documentation, labelnames)
+        self.mode = mode
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    @contextmanager
+    def track_inprogress(self, *labelvalues):
+        self.inc(*labelvalues)
+        try:
+            yield
+        finally:
+            self.dec(*labelvalues)
+
+    def snapshot(self):
+        return {**super().snapshot(), 'mode': self.mode}
+
+
+class Histogram(_Metric):
+    """Bucketed observations with a running sum and count"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets if b != math.inf))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, the last one for +Inf, then the sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observe the wall time of the ``with`` block, even if it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def snapshot(self):
+        return {**super().snapshot(), 'buckets': list(self.buckets)}
+
+
+def _copy(value):
+    if isinstance(value, list):
+        return [list(value[0]), value[1]]
+    return value
+
+
+class MetricsRegistry:
+    """A set of metrics, exported together and optionally shared across processes"""
+
+    def __init__(self, multiprocess_dir=None, flush_interval=5.0):
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+        if multiprocess_dir:
+            os.makedirs(multiprocess_dir, exist_ok=True)
+            atexit.register(self._flush_quietly)
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), mode='sum'):
+        return self._register(Gauge(name, documentation, labelnames, mode))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def on_collect(self, callback):
+        """Call ``callback()`` before every snapshot, to refresh gauges that
+        mirror state kept elsewhere"""
+        self._collectors.append(callback)
+        return callback
+
+    def snapshot(self):
+        for callback in self._collectors:
+            try:
+                callback()
+            except Exception as e:
+                print(f"✗ Warning: metrics collector failed: {e}")
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    # -- multi-process -------------------------------------------------
+
+    def write_snapshot(self):
+        """Write this process's snapshot to the shared directory"""
+        if not self.multiprocess_dir:
+            return
+        path = os.path.join(self.multiprocess_dir, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pid': os.getpid(), 'written_at': time.time(), 'metrics': self.snapshot()}, f)
+        os.replace(tmp_path, path)
+
+    def _flush_quietly(self):
+        try:
+            self.write_snapshot()
+        except OSError as e:
+            print(f"✗ Warning: could not write metrics snapshot: {e}")
+
+    def start_flusher(self):
+        """Start the snapshot thread in this process; safe to call on every
+        request and after a fork"""
+        if not self.multiprocess_dir or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_quietly()
+            time.sleep(self.flush_interval)
+
+    def _snapshots(self):
+        """(pid, metrics) for this process and every snapshot on disk"""
+        own_pid = os.getpid()
+        yield own_pid, self.snapshot()
+        if not self.multiprocess_dir:
+            return
+        self._flush_quietly()
+        for name in os.listdir(self.multiprocess_dir):
+            if not name.endswith('.json') or not SNAPSHOT_PATTERN.match(name):
+                continue
+            try:
+                with open(os.path.join(self.multiprocess_dir, name), encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get('pid') != own_pid:
+                yield data.get('pid'), data.get('metrics', {})
+
+    def collect(self):
+        """Merge every process's snapshot into {name: merged metric}"""
+        merged = {}
+        for pid, metrics in self._snapshots():
+            alive = _pid_alive(pid)
+            for name, metric in metrics.items():
+                if metric['kind'] == 'gauge' and not alive:
+                    continue
+                target = merged.setdefault(name, {**metric, 'values': {}})
+                values = target['values']
+                for labels, value in metric['samples']:
+                    key = tuple(labels)
+                    if metric['kind'] == 'gauge':
+                        mode = metric.get('mode', 'sum')
+                        if mode == 'all':
+                            key = key + (str(pid),)
+                            values[key] = value
+                        elif key not in values:
+                            values[key] = value
+                        elif mode == 'sum':
+                            values[key] += value
+                        elif mode == 'max':
+                            values[key] = max(values[key], value)
+                        else:
+                            values[key] = min(values[key], value)
+                    elif metric['kind'] == 'histogram':
+                        if key in values:
+                            counts, total = values[key]
+                            values[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1]]
+                        else:
+                            values[key] = _copy(value)
+                    else:
+                        values[key] = values.get(key, 0) + value
+        return merged
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            labelnames = list(metric['labelnames'])
+            if metric['kind'] == 'gauge' and metric.get('mode') == 'all':
+                labelnames.append('pid')
+            lines.append(f"# HELP {name} {_escape_help(metric['help'])}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            for labels, value in sorted(metric['values'].items()):
+                pairs = list(zip(labelnames, labels))
+                if metric['kind'] == 'histogram':
+                    counts, total = value
+                    cumulative = 0
+                    for bound, count in zip(metric['buckets'] + ['+Inf'], counts):
+                        cumulative += count
+                        le = bound if bound == '+Inf' else _format_value(bound)
+                        lines.append(f"{name}_bucket{_format_labels(pairs + [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(pairs)} {_format_value(total)}")
+                    lines.append(f"{name}_count{_format_labels(pairs)} {cumulative}")
+                else:
+                    lines.append(f"{name}{_format_labels(pairs)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def clear_snapshots(multiprocess_dir):
+    """Remove the snapshot files in ``multiprocess_dir``, leaving anything
+    else there alone; returns how many were removed"""
+    removed = 0
+    try:
+        names = os.listdir(multiprocess_dir)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if SNAPSHOT_PATTERN.match(name):
+            try:
+                os.remove(os.path.join(multiprocess_dir, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError, OSError):
+        return pid is not None
+    return True
+
+
+def _escape_help(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
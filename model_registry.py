@@ -0,0 +1,333 @@
+"""
+Model registry with lazy TensorFlow import and background warm-up.
+
+TensorFlow is imported and the models are loaded the first time they are
+needed, exactly once, under a lock. ``start_warmup`` does the same on a
+background thread and runs one inference so the first real request does
+not pay for graph setup; ``ready`` turns true once that has finished.
+
+Models can be replaced without downtime. ``reload`` loads the current model
+files into a fresh ``Models`` tuple and warms it up while the old one keeps
+serving. It then swaps the reference under the load lock. A prediction
+takes its ``Models`` reference once, so in-flight requests finish on the
+version they started with, and the old models are freed once the last of
+them lets go. ``start_watching`` triggers a reload when the files change.
+Every ``Models`` carries a ``version`` (a fingerprint of its files) that is
+reported with each prediction.
+
+When ``projection_path`` names an existing file, its feature projection
+(see ``projection.py``) is loaded with the models and applied to the CNN
+features before the classifier; otherwise ``Models.projection`` is None.
+Loading fails if the classifier was not trained on that projection.
+Likewise ``cascade_path`` loads the pre-classifier cascade (see
+``cascade.py``) into ``Models.cascade``, so it is swapped with the rest.
+"""
+import gc
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from prediction_cache import model_fingerprint
+
+# Reference point for time-to-ready and time-to-first-byte measurements
+PROCESS_STARTED = time.monotonic()
+
+Models = namedtuple('Models', ['cnn', 'classifier', 'label_encoder', 'version', 'projection', 'cascade'])
+
+
+class ModelRegistry:
+    def __init__(self, cnn_path, classifier_path, label_encoder_path,
+                 classifier_engine='xgboost', input_shape=(224, 224, 3),
+                 cnn_backend='keras', tflite_path=None, tflite_threads=None,
+                 intra_op_threads=0, inter_op_threads=0, xla=False, warmup_batch_sizes=(1,),
+                 projection_path=None, cascade_path=None):
+        self.cnn_path = cnn_path
+        self.cnn_backend = cnn_backend
+        self.tflite_path = tflite_path
+        self.tflite_threads = tflite_threads
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.xla = xla
+        self.warmup_batch_sizes = tuple(warmup_batch_sizes)
+        self.classifier_path = classifier_path
+        self.label_encoder_path = label_encoder_path
+        self.projection_path = projection_path
+        self.cascade_path = cascade_path
+        self.classifier_engine = classifier_engine
+        self.input_shape = input_shape
+
+        self._models = None
+        self._load_lock = threading.Lock()
+        self._warmup_thread = None
+        self._warmup_started = 0.0
+        self._warmup_lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._reload_lock = threading.Lock()
+        self._watch_thread = None
+        self.error = None
+        self.reload_error = None
+        self.reloads = 0
+        self.timings = {}
+
+    @property
+    def loaded(self):
+        return self._models is not None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def reloading(self):
+        return self._reload_lock.locked()
+
+    @property
+    def version(self):
+        models = self._models
+        return models.version if models is not None else None
+
+    @property
+    def model_paths(self):
+        """Files whose change means a new model version"""
+        cnn_path = self.tflite_path if self.cnn_backend == 'tflite' else self.cnn_path
+        paths = [cnn_path, self.classifier_path, self.label_encoder_path]
+        if self.projection_path:
+            paths.append(self.projection_path)
+        if self.cascade_path:
+            paths.append(self.cascade_path)
+        return paths
+
+    def get(self):
+        """Return the loaded models, loading them on first use"""
+        models = self._models
+        if models is None:
+            models = self.load()
+        return models
+
+    def load(self):
+        """Load every model exactly once, however many threads ask"""
+        with self._load_lock:
+            if self._models is not None:
+                return self._models
+            started = time.perf_counter()
+            try:
+                models = self._load_models()
+            except Exception as e:
+                self.error = str(e)
+                raise Exception(f"Failed to load models: {str(e)}")
+
+            self.error = None
+            self.timings['load_seconds'] = time.perf_counter() - started
+            self._models = models
+            return self._models
+
+    def _load_models(self):
+        """Load a fresh set of models from the current files"""
+        # Fingerprint before reading, so a file replaced mid-load shows up as
+        # a newer version and is picked up by the next reload
+        version = model_fingerprint(self.model_paths)
+        started = time.perf_counter()
+        if self.cnn_backend == 'tflite':
+            from tflite_backend import TFLiteFeatureExtractor
+            cnn = TFLiteFeatureExtractor(self.tflite_path, num_threads=self.tflite_threads)
+        else:
+            from compiled_backend import configure_threads
+            from tensorflow.keras.models import load_model
+            if 'tensorflow_import_seconds' not in self.timings:
+                # Thread pools can only be sized before TensorFlow's first op
+                configure_threads(self.intra_op_threads, self.inter_op_threads)
+                self.timings['tensorflow_import_seconds'] = time.perf_counter() - started
+            cnn = load_model(self.cnn_path)
+            if self.cnn_backend == 'compiled':
+                from compiled_backend import CompiledFeatureExtractor
+                cnn = CompiledFeatureExtractor(cnn, self.warmup_batch_sizes, jit_compile=self.xla)
+        if self.classifier_engine == 'numpy':
+            from tree_engine import TreeEnsemble
+            classifier = TreeEnsemble.from_json(self.classifier_path)
+        else:
+            from xgboost import XGBClassifier
+            classifier = XGBClassifier()
+            classifier.load_model(self.classifier_path)
+
+        from sklearn.preprocessing import LabelEncoder
+        label_encoder = LabelEncoder()
+        label_encoder.classes_ = np.load(self.label_encoder_path, allow_pickle=True)
+
+        from projection import Projection, check_head
+        projection = None
+        if self.projection_path and os.path.exists(self.projection_path):
+            projection = Projection.load(self.projection_path)
+        # A head scores only the features it was trained on
+        check_head(self.classifier_path, projection, self.projection_path)
+
+        cascade = None
+        if self.cascade_path:
+            from cascade import CascadeClassifier
+            cascade = CascadeClassifier.from_json(self.cascade_path)
+        return Models(cnn, classifier, label_encoder, version, projection, cascade)
+
+    def warm_up(self):
+        """Load the models and push one dummy batch through them, once"""
+        with self._warm_lock:
+            if self.ready:
+                return
+            self._warm(self.get())
+            self.timings['time_to_ready_seconds'] = time.monotonic() - PROCESS_STARTED
+            self._ready.set()
+
+    def _warm(self, models):
+        if hasattr(models.cnn, 'warm_up'):
+            # Trace every serving batch size now rather than on live requests
+            self.timings['trace_seconds'] = models.cnn.warm_up()
+        started = time.perf_counter()
+        features = models.cnn.predict(np.zeros((1, *self.input_shape), dtype=np.float32), verbose=0)
+        if models.projection is not None:
+            features = models.projection.transform(features)
+        models.classifier.predict_proba(features)
+        self.timings['warmup_seconds'] = time.perf_counter() - started
+
+    def start_warmup(self, retry_interval=30.0):
+        """Warm up on a background thread; safe to call on every request.
+
+        A failed warm-up is retried at most once per ``retry_interval``.
+        """
+        if not self._needs_warmup(retry_interval):
+            return self._warmup_thread
+        with self._warmup_lock:
+            if self._needs_warmup(retry_interval):
+                self._warmup_started = time.monotonic()
+                self._warmup_thread = threading.Thread(target=self._warmup_safely, name="model-warmup",
+                                                       daemon=True)
+                self._warmup_thread.start()
+        return self._warmup_thread
+
+    def _needs_warmup(self, retry_interval):
+        # Also covers a direct warm_up call, which starts no thread
+        if self.ready:
+            return False
+        thread = self._warmup_thread
+        if thread is None:
+            return True
+        if thread.is_alive():
+            return False
+        return time.monotonic() - self._warmup_started >= retry_interval
+
+    def _warmup_safely(self):
+        try:
+            self.warm_up()
+            print(f"✓ Models loaded and warmed up in {self.timings['time_to_ready_seconds']:.1f}s")
+        except Exception as e:
+            self.error = str(e)
+            print(f"✗ Warning: Models not yet available: {e}")
+            print("ℹ Models will be loaded on first prediction attempt")
+
+    def reload(self):
+        """Load and warm the current model files, then swap them in.
+
+        The old models keep serving until the swap; if loading or warming
+        fails they simply stay in place. Returns False without doing
+        anything if a reload is already running.
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        return self._reload_and_release()
+
+    def start_reload(self):
+        """Reload on a background thread; returns the thread, or None if a
+        reload is already running"""
+        if not self._reload_lock.acquire(blocking=False):
+            return None
+        # Taken here rather than on the thread so ``reloading`` is true on return
+        thread = threading.Thread(target=self._reload_and_release, name="model-reload", daemon=True)
+        thread.start()
+        return thread
+
+    def _reload_and_release(self):
+        try:
+            started = time.perf_counter()
+            try:
+                models = self._load_models()
+                self._warm(models)
+            except Exception as e:
+                self.reload_error = str(e)
+                print(f"✗ Warning: Model reload failed, still serving {self.version}: {e}")
+                return False
+
+            with self._load_lock:
+                previous, self._models = self._models, models
+            self._ready.set()
+            self.reload_error = None
+            self.error = None
+            self.reloads += 1
+            self.timings['reload_seconds'] = time.perf_counter() - started
+            print(f"✓ Models reloaded in {self.timings['reload_seconds']:.1f}s: "
+                  f"{previous.version if previous else None} -> {models.version}")
+            # Requests still holding the previous models keep them alive;
+            # collect now so the rest is freed before the next reload
+            del previous
+            gc.collect()
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def start_watching(self, interval=10.0):
+        """Poll the model files every ``interval`` seconds and reload when
+        they change; safe to call more than once.
+
+        A change is acted on only once the fingerprint is the same on two
+        polls in a row, so a file still being copied is not loaded half
+        written.
+        """
+        if interval <= 0 or self._watch_thread is not None:
+            return self._watch_thread
+        with self._warmup_lock:
+            if self._watch_thread is None:
+                self._watch_thread = threading.Thread(target=self._watch, args=(interval,),
+                                                      name="model-watch", daemon=True)
+                self._watch_thread.start()
+        return self._watch_thread
+
+    def _watch(self, interval):
+        seen = failed = None
+        while True:
+            time.sleep(interval)
+            current = self.version
+            fingerprint = model_fingerprint(self.model_paths)
+            # Not loaded yet means the next load reads the new files anyway;
+            # files that failed to load are retried only once they change again
+            if current is not None and fingerprint not in (current, failed) and fingerprint == seen:
+                if not self.reload() and self.reload_error is not None:
+                    failed = fingerprint
+            seen = fingerprint
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def record_first_byte(self):
+        """Record time-to-first-byte once, on the first response served"""
+        if 'time_to_first_byte_seconds' not in self.timings:
+            self.timings['time_to_first_byte_seconds'] = time.monotonic() - PROCESS_STARTED
+
+    def _projection_name(self):
+        models = self._models
+        return str(models.projection) if models is not None and models.projection is not None else None
+
+    def status(self):
+        return {
+            'ready': self.ready,
+            'loaded': self.loaded,
+            'cnn_backend': self.cnn_backend,
+            'xla': self.xla if self.cnn_backend == 'compiled' else None,
+            'classifier_engine': self.classifier_engine,
+            'error': self.error,
+            'model_version': self.version,
+            'projection': self._projection_name(),
+            'reloading': self.reloading,
+            'reloads': self.reloads,
+            'reload_error': self.reload_error,
+            **{name: round(value, 3) for name, value in self.timings.items()},
+        }
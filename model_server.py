@@ -0,0 +1,490 @@
+"""
+Multi-process serving with one shared model server process.
+
+``serve`` starts a supervisor that owns a listening socket, one model
+server process and ``--workers`` HTTP worker processes:
+
+- The model server is the only process that imports TensorFlow and loads
+  the models. It micro-batches requests from every worker together.
+- Workers run the Flask app on the shared socket. They decode and resize
+  uploads themselves and hand the prepared uint8 images to the model
+  server through a shared-memory slot array; only small (id, slot, key)
+  tuples and the results travel through pipes, never pixel arrays.
+- The supervisor restarts any process that dies.
+
+Model hot-swaps happen inside the model server (see ``ModelRegistry.reload``):
+it watches the model files itself, and workers forward ``/admin/models``
+requests to it as control messages that use no slot.
+
+Each worker owns a fixed range of slots, so slots need no cross-process
+locking; a worker frees a slot when its result comes back. A restarted
+worker starts with all of its slots free, which is safe because starting a
+process takes far longer than the server needs to read the requests its
+predecessor left queued. The app module is imported before forking so
+workers share its pages copy-on-write. Needs the ``fork`` start method
+(Linux, macOS).
+
+Usage:
+    python model_server.py serve [--workers 4] [--port 5000]
+    python model_server.py serve --single              # one process, local models
+    python model_server.py compare [--workers 4] [--requests 200] [--concurrency 8]
+"""
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from metrics import clear_snapshots
+from preprocessing import WIDTH, HEIGHT
+
+SLOT_SHAPE = (HEIGHT, WIDTH, 3)
+SLOT_BYTES = int(np.prod(SLOT_SHAPE))
+
+
+def _slot_array(shm, num_slots):
+    return np.ndarray((num_slots, *SLOT_SHAPE), dtype=np.uint8, buffer=shm.buf)
+
+
+class ModelClient:
+    """Worker-side handle on the model server.
+
+    Drop-in for local prediction: ``predict`` takes one prepared uint8
+    image, ``predict_many`` a list, and both return (disease, confidence,
+    model_version) results. ``control`` sends the model server a 'reload'
+    or 'status' command and returns the registry status it replies with.
+    Calls block until the model server answers or ``timeout`` seconds pass.
+    """
+
+    def __init__(self, worker_id, shm, num_slots, slot_range, request_queue, response_queue,
+                 ready_event, timeout=60.0):
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self._slots = _slot_array(shm, num_slots)
+        self._free = queue.Queue()
+        for slot in slot_range:
+            self._free.put(slot)
+        self._requests = request_queue
+        self._responses = response_queue
+        self._ready = ready_event
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Ids carry the pid so a restarted worker ignores answers meant for
+        # its predecessor
+        self._ids = ((os.getpid(), n) for n in itertools.count())
+        self._listener = threading.Thread(target=self._listen, name="model-client", daemon=True)
+        self._listener.start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def submit(self, image, key=None):
+        """Copy ``image`` into a free slot and queue it; returns a Future"""
+        if image.ndim == 4:
+            image = image[0]
+        try:
+            slot = self._free.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("No free shared-memory slot; the model server is not keeping up")
+        self._slots[slot] = image
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, slot)
+        self._requests.put((self.worker_id, request_id, slot, key))
+        return future
+
+    def predict(self, image, key=None):
+        return self.submit(image, key).result(timeout=self.timeout)
+
+    def predict_many(self, images, keys=None):
+        keys = keys if keys is not None else [None] * len(images)
+        futures = [self.submit(image, key) for image, key in zip(images, keys)]
+        return [future.result(timeout=self.timeout) for future in futures]
+
+    def control(self, command):
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, None)
+        self._requests.put((self.worker_id, request_id, None, command))
+        return future.result(timeout=self.timeout)
+
+    def _listen(self):
+        while True:
+            request_id, ok, payload = self._responses.get()
+            with self._lock:
+                pending = self._pending.pop(tuple(request_id), None)
+            if pending is None:
+                continue
+            future, slot = pending
+            if slot is not None:
+                # The slot is only reused once the server is done reading it
+                self._free.put(slot)
+            if ok:
+                future.set_result(tuple(payload) if slot is not None else payload)
+            else:
+                future.set_exception(Exception(payload))
+
+    def status(self):
+        with self._lock:
+            in_flight = len(self._pending)
+        return {
+            'ready': self.ready,
+            'loaded': self.ready,
+            'mode': 'model_server',
+            'worker_id': self.worker_id,
+            'in_flight': in_flight,
+            'error': None,
+        }
+
+
+def _reset_signals():
+    # Forked children inherit the supervisor's handlers; they should die on
+    # SIGTERM and leave Ctrl+C to the supervisor
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _model_server_main(shm, num_slots, request_queue, response_queues, ready_event):
+    """Model server process: load the models once and batch every worker's requests"""
+    import app as leaf_app
+    from batching import MicroBatcher
+
+    _reset_signals()
+    slots = _slot_array(shm, num_slots)
+    leaf_app.metrics.start_flusher()
+    leaf_app.registry.warm_up()
+    print(f"✓ Model server ready (pid {os.getpid()}) in {leaf_app.registry.timings['warmup_seconds']:.1f}s warm-up")
+    ready_event.set()
+    leaf_app.registry.start_watching(leaf_app.app.config['MODEL_WATCH_INTERVAL'])
+
+    # Normalization reads the pixels straight out of shared memory into the
+    # pooled float32 batch buffer
+    batcher = MicroBatcher(leaf_app.predict_batch,
+                           max_batch_size=leaf_app.app.config['BATCH_MAX_SIZE'],
+                           max_wait_ms=leaf_app.app.config['BATCH_MAX_WAIT_MS'],
+                           collate=leaf_app.buffer_pool.batch)
+
+    def reply(worker_id, request_id, future):
+        try:
+            disease, confidence, version = future.result()
+            message = (request_id, True, (str(disease), float(confidence), version))
+        except Exception as e:
+            message = (request_id, False, str(e))
+        response_queues[worker_id].put(message)
+
+    while True:
+        item = request_queue.get()
+        if item is None:
+            break
+        worker_id, request_id, slot, key = item
+        if slot is None:
+            # Control message: ``key`` is the command
+            if key == 'reload':
+                leaf_app.registry.start_reload()
+            response_queues[worker_id].put((request_id, True, leaf_app.registry.status()))
+            continue
+        future = batcher.submit(slots[slot], key)
+        future.add_done_callback(lambda f, w=worker_id, r=request_id: reply(w, r, f))
+    batcher.close()
+
+
+def _worker_main(worker_id, fd, host, port, shm, num_slots, slot_range, request_queue,
+                 response_queue, ready_event):
+    """HTTP worker process: serve the Flask app on the shared socket"""
+    import app as leaf_app
+    from werkzeug.serving import make_server
+
+    _reset_signals()
+    leaf_app.set_model_client(ModelClient(worker_id, shm, num_slots, slot_range, request_queue,
+                                          response_queue, ready_event))
+    server = make_server(host, port, leaf_app.app, threaded=True, fd=fd)
+    server.serve_forever()
+
+
+def serve(host='0.0.0.0', port=5000, workers=4, slots_per_worker=32):
+    """Run the model server and ``workers`` HTTP workers until interrupted"""
+    # Counters are summed over every snapshot, so a configured directory
+    # starts without the previous run's; only the snapshot files are removed
+    metrics_dir = None
+    if not os.environ.get('LEAF_METRICS_DIR'):
+        metrics_dir = tempfile.mkdtemp(prefix='leaf-metrics-')
+        os.environ['LEAF_METRICS_DIR'] = metrics_dir
+    else:
+        clear_snapshots(os.environ['LEAF_METRICS_DIR'])
+    # Polls and event streams for a job can reach any worker, so jobs must
+    # live in one store that every worker opens
+    jobs_dir = None
+    if not os.environ.get('LEAF_JOBS_DB'):
+        jobs_dir = tempfile.mkdtemp(prefix='leaf-jobs-')
+        os.environ['LEAF_JOBS_DB'] = os.path.join(jobs_dir, 'jobs.db')
+    import app  # noqa: F401 - imported before forking so workers share its pages
+
+    ctx = mp.get_context('fork')
+    listener = socket.create_server((host, port), backlog=256)
+    listener.set_inheritable(True)
+    num_slots = workers * slots_per_worker
+    shm = SharedMemory(create=True, size=num_slots * SLOT_BYTES)
+    ready_event = ctx.Event()
+    queues = {}
+
+    def start_model_server():
+        # A process killed while blocked on a queue can leave its lock held,
+        # so every model server gets fresh queues
+        queues['requests'] = ctx.Queue()
+        queues['responses'] = [ctx.Queue() for _ in range(workers)]
+        ready_event.clear()
+        process = ctx.Process(target=_model_server_main, name="leaf-model-server",
+                              args=(shm, num_slots, queues['requests'], queues['responses'], ready_event))
+        process.start()
+        return process
+
+    def start_worker(worker_id):
+        slot_range = range(worker_id * slots_per_worker, (worker_id + 1) * slots_per_worker)
+        process = ctx.Process(target=_worker_main, name=f"leaf-worker-{worker_id}",
+                              args=(worker_id, listener.fileno(), host, port, shm, num_slots, slot_range,
+                                    queues['requests'], queues['responses'][worker_id], ready_event))
+        process.start()
+        return process
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    model_server = start_model_server()
+    worker_processes = [start_worker(i) for i in range(workers)]
+    print(f"✓ Serving on http://{host}:{port} with {workers} workers and one model server "
+          f"(supervisor pid {os.getpid()})")
+    try:
+        while not stopping.wait(1.0):
+            if not model_server.is_alive():
+                # Requests in flight died with it, so the workers are restarted
+                # too rather than left waiting on answers that will never come
+                print(f"✗ Model server exited with code {model_server.exitcode}; restarting it and the workers")
+                _stop(worker_processes)
+                model_server = start_model_server()
+                worker_processes = [start_worker(i) for i in range(workers)]
+                continue
+            for i, process in enumerate(worker_processes):
+                if not process.is_alive():
+                    print(f"✗ Worker {i} exited with code {process.exitcode}; restarting")
+                    worker_processes[i] = start_worker(i)
+    finally:
+        print("ℹ Shutting down")
+        _stop(worker_processes)
+        queues['requests'].put(None)
+        model_server.join(10)
+        _stop([model_server])
+        listener.close()
+        shm.close()
+        shm.unlink()
+        if jobs_dir is not None:
+            shutil.rmtree(jobs_dir, ignore_errors=True)
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def _stop(processes, timeout=5.0):
+    for process in processes:
+        process.terminate()
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+def serve_single(host='0.0.0.0', port=5000):
+    """The single-process server: one process, local models, threaded HTTP"""
+    import app as leaf_app
+    from werkzeug.serving import make_server
+
+    leaf_app.registry.start_warmup()
+    leaf_app.registry.start_watching(leaf_app.app.config['MODEL_WATCH_INTERVAL'])
+    print(f"✓ Serving on http://{host}:{port} in one process (pid {os.getpid()})")
+    make_server(host, port, leaf_app.app, threaded=True).serve_forever()
+
+
+# -- comparison ------------------------------------------------------------
+
+def _process_tree(pid):
+    """pid and every descendant, from /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def _memory_mb(pid):
+    """Proportional set size of a process (RSS where PSS is unavailable)"""
+    for path, field in ((f'/proc/{pid}/smaps_rollup', 'Pss:'), (f'/proc/{pid}/status', 'VmRSS:')):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    return 0.0
+
+
+def _post_image(url, name, data, timeout=120):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    request = urllib.request.Request(url, data=body,
+                                     headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def _wait_ready(base_url, process, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f'{base_url}/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} not ready after {timeout}s")
+
+
+def _load_test(base_url, samples, total_requests, concurrency):
+    from benchmark import summarize
+
+    def one(i):
+        name, data = samples[i % len(samples)]
+        started = time.perf_counter()
+        status = _post_image(f'{base_url}/api/predict', name, data)
+        return status, (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(total_requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        'throughput_rps': round(total_requests / elapsed, 3),
+        'errors': sum(1 for status, _ in results if status != 200),
+        'latency_ms': summarize([ms for _, ms in results]),
+    }
+
+
+def compare(workers=4, total_requests=200, concurrency=8, port=5100, num_images=16):
+    """Measure memory and throughput of the single-process and model-server modes"""
+    from benchmark import load_samples
+
+    samples = load_samples(count=num_images)
+    env = dict(os.environ)
+    # Every request should reach the models
+    env.update({'LEAF_CACHE': '0', 'LEAF_NEAR_DUP': '0', 'LEAF_UPLOAD_PERSIST': 'none'})
+    env.pop('LEAF_METRICS_DIR', None)
+    script = os.path.abspath(__file__)
+    modes = [('single process', ['--single']), (f'model server + {workers} workers', ['--workers', str(workers)])]
+
+    rows = []
+    for offset, (name, extra) in enumerate(modes):
+        mode_port = port + offset
+        base_url = f'http://127.0.0.1:{mode_port}'
+        process = subprocess.Popen([sys.executable, script, 'serve', '--host', '127.0.0.1',
+                                    '--port', str(mode_port), *extra], env=env)
+        try:
+            started = time.perf_counter()
+            _wait_ready(base_url, process)
+            ready_seconds = time.perf_counter() - started
+            _load_test(base_url, samples, min(concurrency * 2, total_requests), concurrency)  # warm
+            result = _load_test(base_url, samples, total_requests, concurrency)
+            pids = _process_tree(process.pid)
+            result.update({'mode': name, 'processes': len(pids), 'ready_seconds': round(ready_seconds, 1),
+                           'memory_mb': round(sum(_memory_mb(pid) for pid in pids), 1)})
+            rows.append(result)
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    print(f"\n{total_requests} requests at concurrency {concurrency}")
+    print(f"{'mode':<28} {'procs':>5} {'PSS MB':>8} {'ready s':>8} {'req/s':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'errors':>6}")
+    for row in rows:
+        latency = row['latency_ms']
+        print(f"{row['mode']:<28} {row['processes']:>5} {row['memory_mb']:>8.1f} {row['ready_seconds']:>8.1f} "
+              f"{row['throughput_rps']:>8.2f} {latency['p50']:>8.1f} {latency['p95']:>8.1f} {row['errors']:>6}")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-process serving with a shared model server")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('serve', help="Run the server")
+    p.add_argument('--host', default='0.0.0.0')
+    p.add_argument('--port', type=int, default=5000)
+    p.add_argument('--workers', type=int, default=int(os.environ.get('LEAF_WORKERS', 4)))
+    p.add_argument('--slots-per-worker', type=int, default=32,
+                   help="Images each worker can have in flight at once")
+    p.add_argument('--single', action='store_true', help="Serve from one process with local models")
+
+    p = sub.add_parser('compare', help="Compare memory and throughput of both modes")
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--requests', type=int, default=200)
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--port', type=int, default=5100, help="First of two free ports to use")
+    p.add_argument('--output', default=None, help="Also write the results as JSON")
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        if args.single:
+            serve_single(args.host, args.port)
+        else:
+            serve(args.host, args.port, args.workers, args.slots_per_worker)
+    else:
+        rows = compare(args.workers, args.requests, args.concurrency, args.port)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(rows, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Perceptual-hash index for reusing results of near-duplicate uploads.
+
+Re-encoded, slightly cropped or resized copies of a leaf photo have
+different bytes but almost the same 64-bit perceptual hash. The index
+finds stored hashes within a small Hamming distance using multi-index
+hashing: the hash is split into ``max_distance + 1`` chunks, and by the
+pigeonhole principle any hash within ``max_distance`` bits matches at
+least one chunk exactly.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from prediction_cache import model_fingerprint
+
+HASH_BITS = 64
+
+
+def perceptual_hash(image):
+    """64-bit DCT perceptual hash (pHash) of a decoded or preprocessed image.
+
+    Accepts a BGR image of shape (H, W, 3) or a preprocessed batch of one
+    image (1, H, W, 3); pixel scale does not matter.
+    """
+    if image.ndim == 4:
+        image = image[0]
+    gray = cv2.cvtColor(image.astype(np.float32, copy=False), cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small)[:8, :8].ravel()
+    # The DC term only encodes brightness, so leave it out of the median
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class NearDuplicateIndex:
+    """Bounded LRU of (hash -> result) with Hamming-radius lookup."""
+
+    def __init__(self, max_distance=4, max_entries=10000, model_paths=(), check_interval=1.0):
+        if not 0 <= max_distance < 16:
+            raise ValueError("max_distance must be between 0 and 15")
+        self.max_distance = int(max_distance)
+        self.max_entries = int(max_entries)
+        self.model_paths = list(model_paths)
+        self.check_interval = float(check_interval)
+
+        n_chunks = self.max_distance + 1
+        bounds = np.linspace(0, HASH_BITS, n_chunks + 1).astype(int)
+        self._chunks = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # hash -> value
+        self._tables = [dict() for _ in self._chunks]  # chunk value -> set of hashes
+        self._fingerprint = model_fingerprint(self.model_paths)
+        self._last_check = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lookup_seconds = 0.0
+        self._hash_seconds = 0.0
+
+    def _chunk_values(self, h):
+        return [(h >> shift) & mask for shift, mask in self._chunks]
+
+    def hash(self, image):
+        """Compute the perceptual hash, recording the time it took"""
+        started = time.perf_counter()
+        h = perceptual_hash(image)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._hash_seconds += elapsed
+        return h
+
+    def lookup(self, h):
+        """Return (value, distance) for the closest stored hash, or None"""
+        started = time.perf_counter()
+        with self._lock:
+            self._check_models()
+            best, best_distance = None, self.max_distance + 1
+            for table, value in zip(self._tables, self._chunk_values(h)):
+                for candidate in table.get(value, ()):
+                    distance = hamming(h, candidate)
+                    if distance < best_distance:
+                        best, best_distance = candidate, distance
+            if best is None:
+                self.misses += 1
+                result = None
+            else:
+                self._entries.move_to_end(best)
+                self.hits += 1
+                result = (self._entries[best], best_distance)
+            self._lookup_seconds += time.perf_counter() - started
+            return result
+
+    def add(self, h, value):
+        with self._lock:
+            if h in self._entries:
+                self._entries[h] = value
+                self._entries.move_to_end(h)
+                return
+            self._entries[h] = value
+            for table, chunk in zip(self._tables, self._chunk_values(h)):
+                table.setdefault(chunk, set()).add(h)
+            while len(self._entries) > self.max_entries:
+                old, _ = self._entries.popitem(last=False)
+                self._unindex(old)
+                self.evictions += 1
+
+    def _unindex(self, h):
+        for table, chunk in zip(self._tables, self._chunk_values(h)):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(h)
+                if not bucket:
+                    del table[chunk]
+
+    def _check_models(self):
+        now = time.monotonic()
+        if not self.model_paths or now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        fingerprint = model_fingerprint(self.model_paths)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self._entries.clear()
+            for table in self._tables:
+                table.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'max_distance': self.max_distance,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'mean_hash_ms': round(self._hash_seconds * 1000 / lookups, 4) if lookups else None,
+                'mean_lookup_ms': round(self._lookup_seconds * 1000 / lookups, 4) if lookups else None,
+            }
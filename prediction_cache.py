@@ -0,0 +1,185 @@
+"""
+Content-hash prediction cache.
+
+Results are keyed by the SHA-256 of the uploaded bytes and held in a
+bounded in-memory LRU with TTL expiry, optionally backed by a SQLite
+table that survives restarts. Every entry is tagged with a fingerprint of
+the model files, so replacing a model invalidates the cache. Every
+``purge_interval`` writes, expired rows are deleted from the SQLite table
+and it is trimmed to its newest ``max_disk_entries`` rows.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_hash(data):
+    """Hex SHA-256 digest of raw upload bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def model_fingerprint(paths):
+    """Fingerprint model files by path, size and modification time"""
+    h = hashlib.sha256()
+    for path in paths:
+        try:
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_size}:{st.st_mtime_ns};".encode())
+        except OSError:
+            h.update(f"{path}:missing;".encode())
+    return h.hexdigest()[:16]
+
+
+class PredictionCache:
+    """Thread-safe LRU + TTL cache with an optional SQLite second tier.
+
+    Values must be JSON-serializable (lists come back as lists).
+    """
+
+    def __init__(self, model_paths, max_entries=1024, ttl_seconds=3600,
+                 db_path=None, check_interval=1.0, max_disk_entries=100000, purge_interval=1000):
+        self.model_paths = list(model_paths)
+        self.max_entries = int(max_entries)
+        self.max_disk_entries = int(max_disk_entries)
+        self.purge_interval = int(purge_interval)
+        self.ttl = float(ttl_seconds)
+        self.check_interval = float(check_interval)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._fingerprint = model_fingerprint(self.model_paths)
+        self._last_check = time.monotonic()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.purged = 0
+        self._writes_since_purge = 0
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                " key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL,"
+                " stored_at REAL NOT NULL, value TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS predictions_stored_at ON predictions (stored_at)")
+            self._db.execute("DELETE FROM predictions WHERE fingerprint != ?", (self._fingerprint,))
+            self._purge()
+
+    def _check_models(self):
+        """Drop everything if the model files changed since the last check"""
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        fingerprint = model_fingerprint(self.model_paths)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self._entries.clear()
+            self.invalidations += 1
+            if self._db is not None:
+                self._db.execute("DELETE FROM predictions WHERE fingerprint != ?", (fingerprint,))
+                self._db.commit()
+
+    def get(self, key):
+        """Return the cached value for ``key`` or None"""
+        with self._lock:
+            self._check_models()
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT stored_at, value FROM predictions WHERE key = ? AND fingerprint = ?",
+                    (key, self._fingerprint)).fetchone()
+                if row is not None and now - row[0] <= self.ttl:
+                    value = json.loads(row[1])
+                    self._remember(key, row[0], value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Store ``value`` under ``key`` in memory and, if configured, on disk"""
+        with self._lock:
+            self._check_models()
+            now = time.time()
+            self._remember(key, now, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predictions (key, fingerprint, stored_at, value) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, self._fingerprint, now, json.dumps(value)))
+                self._writes_since_purge += 1
+                if self._writes_since_purge >= self.purge_interval:
+                    self._purge()
+                else:
+                    self._db.commit()
+
+    def _remember(self, key, stored_at, value):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM predictions")
+                self._db.commit()
+
+    def purge_expired(self):
+        """Remove expired entries from both tiers"""
+        with self._lock:
+            cutoff = time.time() - self.ttl
+            for key in [k for k, (t, _) in self._entries.items() if t < cutoff]:
+                del self._entries[key]
+            if self._db is not None:
+                self._purge()
+
+    def _purge(self):
+        """Delete expired rows and trim the table to max_disk_entries; lock held"""
+        self._writes_since_purge = 0
+        removed = self._db.execute("DELETE FROM predictions WHERE stored_at < ?",
+                                   (time.time() - self.ttl,)).rowcount
+        removed += self._db.execute(
+            "DELETE FROM predictions WHERE key IN ("
+            " SELECT key FROM predictions ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)).rowcount
+        self._db.commit()
+        self.purged += removed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'persistent': self._db is not None,
+                'max_disk_entries': self.max_disk_entries if self._db is not None else None,
+                'disk_purged': self.purged,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+                'model_fingerprint': self._fingerprint,
+            }
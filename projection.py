@@ -0,0 +1,298 @@
+"""
+Projection of CNN features to a smaller embedding before the classifier.
+
+The classifier scores the CNN's full feature vector. Fewer, denser columns
+mean shallower cache footprints during tree traversal and smaller
+embeddings wherever they are kept. A ``Projection`` is fitted offline (PCA
+or a Gaussian random projection) and saved as ``feature_projection.npz``
+next to the models. When that file is present the registry loads it and
+``score_features`` applies it as one ``features @ weights + bias`` over the
+whole batch.
+
+The reduced embedding can be quantized. ``float16`` halves it. ``int8``
+quarters it: per-column scales are fitted with the projection and folded
+into the weights, so quantizing is a round-and-clip on the product, and the
+classifier is trained on the int8 codes themselves. A head must always be
+trained on the projection it is served with; ``fit`` writes both together
+and records the projection's fingerprint in the head's model attributes,
+and the registry refuses to load a head and projection that do not match.
+
+Both commands read the labelled feature cache built by ``train_head.py``.
+
+Usage:
+    python projection.py sweep [--cache head_cache] [--dims 64 128 256 512] [--methods pca random]
+                               [--quantization none float16 int8]
+    python projection.py fit --dim 256 [--method pca] [--quantization int8] [--output-dir retrained]
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+PROJECTION_NAME = 'feature_projection.npz'
+# XGBoost model attribute naming the projection a head was trained on
+HEAD_ATTRIBUTE = 'feature_projection'
+METHODS = ('pca', 'random')
+QUANTIZATION_MODES = ('none', 'float16', 'int8')
+_STORAGE_DTYPES = {'none': np.float32, 'float16': np.float16, 'int8': np.int8}
+# int8 scales are set from this percentile of each column's magnitude, so a
+# few outliers do not waste the code range
+INT8_PERCENTILE = 99.9
+
+
+class Projection:
+    """Affine map of CNN features to ``dim`` columns, optionally quantized"""
+
+    def __init__(self, weights, bias, method='pca', quantization='none'):
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"quantization must be one of {', '.join(QUANTIZATION_MODES)}")
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.bias = np.ascontiguousarray(bias, dtype=np.float32)
+        self.method = str(method)
+        self.quantization = str(quantization)
+        self._fingerprint = None
+
+    @property
+    def input_dim(self):
+        return self.weights.shape[0]
+
+    @property
+    def dim(self):
+        return self.weights.shape[1]
+
+    @property
+    def bytes_per_embedding(self):
+        return self.dim * np.dtype(_STORAGE_DTYPES[self.quantization]).itemsize
+
+    @property
+    def fingerprint(self):
+        """Content hash of the projection, recorded in heads trained on it"""
+        if self._fingerprint is None:
+            h = hashlib.sha256(f"{self.method}:{self.quantization}:{self.weights.shape};".encode())
+            h.update(self.weights.tobytes())
+            h.update(self.bias.tobytes())
+            self._fingerprint = h.hexdigest()[:16]
+        return self._fingerprint
+
+    def __str__(self):
+        return f"{self.method}-{self.dim}-{self.quantization}"
+
+    def transform(self, features):
+        """Classifier input for a batch of CNN features (float32)"""
+        reduced = np.asarray(features, dtype=np.float32) @ self.weights
+        reduced += self.bias
+        if self.quantization == 'float16':
+            return reduced.astype(np.float16).astype(np.float32)
+        if self.quantization == 'int8':
+            np.rint(reduced, out=reduced)
+            np.clip(reduced, -127, 127, out=reduced)
+        return reduced
+
+    def encode(self, features):
+        """Reduced embeddings in their compact storage dtype"""
+        return self.transform(features).astype(_STORAGE_DTYPES[self.quantization])
+
+    def save(self, path):
+        buffer = io.BytesIO()
+        np.savez(buffer, weights=self.weights, bias=self.bias, method=self.method, quantization=self.quantization)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['weights'], data['bias'], str(data['method']), str(data['quantization']))
+
+
+def head_projection(model_path):
+    """Fingerprint of the projection the XGBoost head in ``model_path`` was
+    trained on, or None for a head trained on raw CNN features"""
+    try:
+        with open(model_path, encoding='utf-8') as f:
+            attributes = json.load(f).get('learner', {}).get('attributes', {})
+    except (ValueError, UnicodeDecodeError):
+        # Binary model formats carry no readable attributes
+        return None
+    return attributes.get(HEAD_ATTRIBUTE)
+
+
+def check_head(model_path, projection, projection_path=None):
+    """Raise ValueError unless the head in ``model_path`` was trained on
+    ``projection`` (None meaning raw CNN features)"""
+    trained_on = head_projection(model_path)
+    expected = projection.fingerprint if projection is not None else None
+    if trained_on == expected:
+        return
+    head = f"projection {trained_on}" if trained_on else "raw CNN features"
+    loaded = f"projection {expected} from {projection_path}" if projection is not None else "no projection"
+    raise ValueError(f"{model_path} was trained on {head} but {loaded} is deployed; deploy the head together "
+                     f"with the {PROJECTION_NAME} it was fitted with (projection.py fit writes both), or "
+                     f"remove {PROJECTION_NAME} for a head trained by train_head.py")
+
+
+def fit(features, dim, method='pca', quantization='none', seed=0):
+    """Fit a projection of ``features`` (one row per image) to ``dim`` columns"""
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {', '.join(METHODS)}")
+    features = np.asarray(features, dtype=np.float64)
+    if not 0 < dim <= features.shape[1]:
+        raise ValueError(f"dim must be between 1 and the feature width ({features.shape[1]})")
+    mean = features.mean(axis=0)
+    if method == 'pca':
+        centered = features - mean
+        # Eigenvectors of the d x d covariance; cheaper than an SVD of the
+        # data once there are more images than features
+        _, vectors = np.linalg.eigh(centered.T @ centered)
+        components = vectors[:, ::-1][:, :dim]
+    else:
+        rng = np.random.default_rng(seed)
+        components = rng.standard_normal((features.shape[1], dim)) / np.sqrt(dim)
+    weights = components
+    bias = -mean @ components
+    if quantization == 'int8':
+        reduced = features @ weights + bias
+        scale = np.percentile(np.abs(reduced), INT8_PERCENTILE, axis=0) / 127
+        # Columns with no spread (PCA beyond the rank of the data) would
+        # otherwise get enormous weights; any scale rounds them to zero
+        scale[scale <= scale.max() * 1e-6] = 1.0
+        weights = weights / scale
+        bias = bias / scale
+    return Projection(weights, bias, method, quantization)
+
+
+def _split(labels, holdout, seed):
+    test = np.random.default_rng(seed).random(len(labels)) < holdout
+    if not test.any() or test.all():
+        raise ValueError("Not enough labelled images for a hold-out split; add images or change --holdout")
+    return test
+
+
+def _scoring_ms(classifier, projection, features, batch_size=32, repeats=20):
+    """(ms per single-image call, ms per batch call) for projection plus classifier"""
+    def score(batch):
+        classifier.predict_proba(projection.transform(batch) if projection is not None else batch)
+
+    batch = np.resize(features, (batch_size, features.shape[1])).astype(np.float32)
+    timings = []
+    for rows in (batch[:1], batch):
+        score(rows)
+        started = time.perf_counter()
+        for _ in range(repeats):
+            score(rows)
+        timings.append((time.perf_counter() - started) * 1000 / repeats)
+    return timings
+
+
+def sweep(cache, dims, methods=('pca',), quantizations=('none',), holdout=0.2, seed=0, threads=0, **params):
+    """Retrain the head on every reduced form of the cached features and
+    report accuracy, scoring latency and bytes per embedding"""
+    import app as leaf_app
+    from train_head import load_training_set, open_cache, read_labels, train
+
+    store, version = open_cache(cache, leaf_app)
+    _, features, labels = load_training_set(store, version, read_labels(cache))
+    test = _split(labels, holdout, seed)
+    width = features.shape[1]
+    print(f"ℹ {len(labels)} images, {width} CNN features, {int(test.sum())} held out")
+
+    configs = [(None, width, 'none')] + [(method, dim, quantization) for method in methods for dim in dims
+                                         for quantization in quantizations if dim < width]
+    rows = []
+    for method, dim, quantization in configs:
+        started = time.perf_counter()
+        projection = fit(features[~test], dim, method, quantization, seed) if method else None
+        project = projection.transform if projection is not None else (lambda x: np.asarray(x, dtype=np.float32))
+        classifier, class_names = train(project(features[~test]), labels[~test], threads=threads, seed=seed,
+                                        **params)
+        fit_seconds = time.perf_counter() - started
+        predicted = np.asarray(class_names)[classifier.predict(project(features[test]))]
+        single_ms, batch_ms = _scoring_ms(classifier, projection, features[test])
+        rows.append({
+            'projection': str(projection) if projection is not None else 'none',
+            'dim': dim,
+            'bytes_per_embedding': projection.bytes_per_embedding if projection is not None else width * 4,
+            'accuracy': round(float(np.mean(predicted == labels[test])), 4),
+            'single_ms': round(single_ms, 3),
+            'batch32_ms': round(batch_ms, 3),
+            'fit_seconds': round(fit_seconds, 2),
+        })
+
+    print(f"\n{'projection':<20} {'dim':>5} {'bytes':>7} {'accuracy':>9} {'1 img ms':>9} {'32 img ms':>10} "
+          f"{'fit s':>7}")
+    for row in rows:
+        print(f"{row['projection']:<20} {row['dim']:>5} {row['bytes_per_embedding']:>7} {row['accuracy']:>9.2%} "
+              f"{row['single_ms']:>9.3f} {row['batch32_ms']:>10.3f} {row['fit_seconds']:>7.2f}")
+    return rows
+
+
+def fit_and_save(cache, output_dir, dim, method='pca', quantization='none', seed=0, threads=0, **params):
+    """Fit a projection on every cached labelled image, retrain the head on
+    it and write both, with the classes, to ``output_dir``"""
+    import app as leaf_app
+    from train_head import CLASSES_NAME, MODEL_NAME, load_training_set, open_cache, read_labels, train
+
+    store, version = open_cache(cache, leaf_app)
+    _, features, labels = load_training_set(store, version, read_labels(cache))
+    projection = fit(features, dim, method, quantization, seed)
+    classifier, class_names = train(projection.transform(features), labels, threads=threads, seed=seed, **params)
+    classifier.get_booster().set_attr(**{HEAD_ATTRIBUTE: projection.fingerprint})
+
+    os.makedirs(output_dir, exist_ok=True)
+    projection.save(os.path.join(output_dir, PROJECTION_NAME))
+    classifier.save_model(os.path.join(output_dir, MODEL_NAME))
+    np.save(os.path.join(output_dir, CLASSES_NAME), np.array(class_names, dtype=object), allow_pickle=True)
+    print(f"✓ Wrote a {projection} projection ({features.shape[1]} -> {projection.dim} columns, "
+          f"{projection.bytes_per_embedding} bytes per embedding) and its head to {output_dir}")
+    return projection
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit and compare feature projections for the classifier head")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(p):
+        p.add_argument('--cache', default='head_cache', help="Feature cache built by train_head.py")
+        p.add_argument('--threads', type=int, default=0, help="XGBoost threads; 0 uses every core")
+        p.add_argument('--n-estimators', type=int, default=200)
+        p.add_argument('--max-depth', type=int, default=6)
+        p.add_argument('--learning-rate', type=float, default=0.1)
+        p.add_argument('--seed', type=int, default=0)
+
+    p = sub.add_parser('sweep', help="Report accuracy, latency and size for several target dimensions")
+    add_common(p)
+    p.add_argument('--dims', type=int, nargs='+', default=[64, 128, 256, 512])
+    p.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS))
+    p.add_argument('--quantization', nargs='+', choices=QUANTIZATION_MODES, default=list(QUANTIZATION_MODES))
+    p.add_argument('--holdout', type=float, default=0.2)
+    p.add_argument('--output', default=None, help="Also write the results as JSON")
+
+    p = sub.add_parser('fit', help="Fit one projection, retrain the head on it and save both")
+    add_common(p)
+    p.add_argument('--dim', type=int, required=True)
+    p.add_argument('--method', choices=METHODS, default='pca')
+    p.add_argument('--quantization', choices=QUANTIZATION_MODES, default='none')
+    p.add_argument('--output-dir', default='retrained')
+
+    args = parser.parse_args(argv)
+    params = {'n_estimators': args.n_estimators, 'max_depth': args.max_depth, 'learning_rate': args.learning_rate}
+    if args.command == 'sweep':
+        rows = sweep(args.cache, args.dims, args.methods, args.quantization, args.holdout, args.seed,
+                     args.threads, **params)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(rows, f, indent=2)
+    else:
+        fit_and_save(args.cache, args.output_dir, args.dim, args.method, args.quantization, args.seed,
+                     args.threads, **params)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
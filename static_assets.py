@@ -0,0 +1,217 @@
+"""
+Content-hashed, precompressed static assets and prerendered pages.
+
+``build`` copies every file under ``static/`` to ``static/dist/`` with a
+content hash in its name (``css/style.3f2a9c01d4e7.css``), next to
+``.gz`` and, when the ``brotli`` package is installed, ``.br`` variants
+compressed at the highest level. ``manifest.json`` maps original names to
+hashed ones. Hashed names never change meaning, so they are served with a
+year-long immutable cache lifetime. A new build produces new names, and
+old builds stay valid until they are removed.
+
+``negotiate`` picks the best precompressed variant the client accepts, and
+``PageCache`` holds rendered HTML pages along with their compressed variants
+and ETags. Together they let a request be answered without templating or
+compression work.
+
+Usage:
+    python static_assets.py build [--static static] [--output static/dist]
+    python static_assets.py stats [--output static/dist]
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DEFAULT_OUTPUT = os.path.join(STATIC_ROOT, 'dist')
+MANIFEST_NAME = 'manifest.json'
+# Already-compressed formats gain nothing from another pass
+COMPRESSIBLE = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.map', '.ico', '.xml'}
+# Preference order when the client accepts several encodings equally
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+HASH_LENGTH = 12
+
+
+def compress(data):
+    """{encoding: compressed bytes} for every available encoding that helps"""
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+
+def hashed_name(relpath, data):
+    root, ext = os.path.splitext(relpath)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build(static_root=STATIC_ROOT, output=DEFAULT_OUTPUT):
+    """Write hashed and precompressed copies of every static file; returns the manifest"""
+    manifest = {}
+    output = os.path.abspath(output)
+    for dirpath, dirnames, filenames in os.walk(static_root):
+        # Never feed a previous build back into this one
+        dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) != output]
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, static_root).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            target = hashed_name(relpath, data)
+            target_path = os.path.join(output, target)
+            if not os.path.exists(target_path):
+                _write(target_path, data)
+                if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                    for encoding, body in compress(data).items():
+                        _write(target_path + dict(ENCODINGS)[encoding], body)
+            manifest[relpath] = target
+    _write(os.path.join(output, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def load_manifest(output=DEFAULT_OUTPUT, static_root=STATIC_ROOT, autobuild=True):
+    """The build manifest, rebuilding first if any source file changed.
+
+    Returns an empty manifest (serve the plain files) when there is no
+    build and ``autobuild`` is off, or when the build directory is not
+    writable.
+    """
+    path = os.path.join(output, MANIFEST_NAME)
+    manifest = {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if not autobuild or not _stale(manifest, static_root, output):
+        return manifest
+    try:
+        return build(static_root, output)
+    except OSError as e:
+        print(f"✗ Warning: could not build static assets: {e}")
+        return manifest
+
+
+def _stale(manifest, static_root, output):
+    output = os.path.abspath(output)
+    for dirpath, dirnames, filenames in os.walk(static_root):
+        dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) != output]
+        for name in filenames:
+            relpath = os.path.relpath(os.path.join(dirpath, name), static_root).replace(os.sep, '/')
+            target = manifest.get(relpath)
+            if target is None or not os.path.exists(os.path.join(output, target)):
+                return True
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                if hashed_name(relpath, f.read()) != target:
+                    return True
+    return False
+
+
+def negotiate(accept_encodings, available):
+    """Best encoding in ``available`` that the client accepts, or None for identity.
+
+    ``accept_encodings`` is werkzeug's parsed Accept-Encoding header
+    (``request.accept_encodings``).
+    """
+    best, best_quality = None, 0
+    for encoding, _ in ENCODINGS:
+        if encoding in available:
+            quality = accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+    return best
+
+
+class CachedPage:
+    """A rendered page with its ETag and precompressed variants"""
+
+    def __init__(self, html):
+        self.body = html.encode('utf-8')
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+        self.variants = compress(self.body)
+
+    def select(self, accept_encodings):
+        """(body, encoding or None, etag) for a request's Accept-Encoding"""
+        encoding = negotiate(accept_encodings, self.variants)
+        if encoding is None:
+            return self.body, None, self.etag
+        return self.variants[encoding], encoding, f"{self.etag}-{encoding}"
+
+
+class PageCache:
+    """Rendered pages by key, rendered on first use and then reused"""
+
+    def __init__(self):
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        page = self._pages.get(key)
+        if page is None:
+            page = CachedPage(render())
+            with self._lock:
+                page = self._pages.setdefault(key, page)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self):
+        with self._lock:
+            pages = list(self._pages.items())
+        return {
+            'pages': len(pages),
+            'bytes': sum(len(page.body) for _, page in pages),
+            'compressed_bytes': {encoding: sum(len(page.variants.get(encoding, page.body)) for _, page in pages)
+                                 for encoding, _ in ENCODINGS},
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build hashed, precompressed static assets")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('build', help="Hash and precompress everything under the static directory")
+    p.add_argument('--static', default=STATIC_ROOT)
+    p.add_argument('--output', default=DEFAULT_OUTPUT)
+
+    p = sub.add_parser('stats', help="Show original and compressed sizes of the current build")
+    p.add_argument('--output', default=DEFAULT_OUTPUT)
+
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        manifest = build(args.static, args.output)
+        print(f"✓ Built {len(manifest)} assets into {args.output}")
+        if brotli is None:
+            print("ℹ brotli is not installed; only gzip variants were written (pip install brotli)")
+    with open(os.path.join(args.output, MANIFEST_NAME), encoding='utf-8') as f:
+        manifest = json.load(f)
+    print(f"{'asset':<40} {'bytes':>9} {'gzip':>9} {'br':>9}")
+    for relpath, target in sorted(manifest.items()):
+        path = os.path.join(args.output, target)
+        sizes = [os.path.getsize(path)] + [os.path.getsize(path + suffix) if os.path.exists(path + suffix) else None
+                                           for _, suffix in (('gzip', '.gz'), ('br', '.br'))]
+        print(f"{target:<40} " + ' '.join(f"{size if size is not None else '-':>9}" for size in sizes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+TensorFlow Lite serving backend for the CNN feature extractor.
+
+Converts ``cnn_feature_extractor.h5`` to a ``.tflite`` flatbuffer, with
+optional float16 or int8 post-training quantization, and runs it through
+the TFLite interpreter. The interpreter comes from ``ai_edge_litert`` or
+``tflite_runtime`` when installed, so serving does not need the full
+TensorFlow package; otherwise ``tf.lite`` is used.
+
+Usage:
+    python tflite_backend.py convert [--quantization float16|int8] [--samples DIR]
+    python tflite_backend.py compare --samples DIR [--tflite PATH ...]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from preprocessing import WIDTH, HEIGHT, process_image
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_H5_PATH = os.path.join(BASE_PATH, "cnn_feature_extractor.h5")
+DEFAULT_TFLITE_PATH = os.path.join(BASE_PATH, "cnn_feature_extractor.tflite")
+QUANTIZATION_MODES = ('none', 'float16', 'int8')
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
+
+
+def _interpreter_class():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteFeatureExtractor:
+    """Drop-in replacement for the Keras model's ``predict`` method.
+
+    The interpreter is not thread-safe, so calls are serialized; the input
+    tensor is resized only when the batch size changes.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self._interpreter = _interpreter_class()(model_path=model_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = int(self._input['shape'][0])
+        self._lock = threading.Lock()
+
+    def predict(self, images, verbose=0):
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            if images.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input['index'], images.shape)
+                self._interpreter.allocate_tensors()
+                self._input = self._interpreter.get_input_details()[0]
+                self._output = self._interpreter.get_output_details()[0]
+                self._batch_size = images.shape[0]
+            self._interpreter.set_tensor(self._input['index'], images)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output['index']).copy()
+
+
+def find_images(directory, limit=None):
+    paths = []
+    for dirpath, _, filenames in os.walk(directory):
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(dirpath, name))
+                if limit and len(paths) >= limit:
+                    return paths
+    return paths
+
+
+def convert(h5_path, output_path, quantization='none', samples_dir=None, num_samples=100):
+    """Convert the Keras feature extractor to TFLite"""
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"quantization must be one of {QUANTIZATION_MODES}")
+    model = tf.keras.models.load_model(h5_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        # Calibrate activation ranges on real leaf images when available;
+        # inputs and outputs stay float32 so the backend is a drop-in.
+        paths = find_images(samples_dir, num_samples) if samples_dir else []
+        if not paths:
+            print("ℹ No calibration images given; calibrating on random inputs")
+
+        def representative_dataset():
+            if paths:
+                for path in paths:
+                    yield [process_image(path).astype(np.float32)]
+            else:
+                rng = np.random.default_rng(0)
+                for _ in range(num_samples):
+                    yield [rng.random((1, HEIGHT, WIDTH, 3), dtype=np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+
+    flatbuffer = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(flatbuffer)
+    print(f"✓ Wrote {output_path} ({len(flatbuffer) / 1024 / 1024:.1f} MB, quantization={quantization})")
+    return output_path
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _time_predict(model, images, repeats):
+    model.predict(images[:1], verbose=0)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for image in images:
+            model.predict(image[None], verbose=0)
+    single_ms = (time.perf_counter() - started) * 1000 / (repeats * len(images))
+    model.predict(images, verbose=0)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        model.predict(images, verbose=0)
+    batch_ms = (time.perf_counter() - started) * 1000 / (repeats * len(images))
+    return single_ms, batch_ms
+
+
+def compare(h5_path, tflite_paths, classifier_path, samples_dir, num_samples=32, num_threads=None, repeats=3):
+    """Report latency, memory and agreement of TFLite models against Keras"""
+    paths = find_images(samples_dir, num_samples) if samples_dir else []
+    if paths:
+        images = np.concatenate([process_image(p) for p in paths]).astype(np.float32)
+    else:
+        print("ℹ No sample images given; comparing on random inputs")
+        images = np.random.default_rng(0).random((num_samples, HEIGHT, WIDTH, 3), dtype=np.float32)
+
+    classifier = None
+    if classifier_path and os.path.exists(classifier_path):
+        from xgboost import XGBClassifier
+        classifier = XGBClassifier()
+        classifier.load_model(classifier_path)
+
+    rows = []
+    rss = _rss_mb()
+    from tensorflow.keras.models import load_model
+    keras_model = load_model(h5_path)
+    keras_mb = _rss_mb() - rss
+    reference = keras_model.predict(images, verbose=0)
+    reference_labels = classifier.predict(reference) if classifier is not None else None
+    rows.append(('keras', *_time_predict(keras_model, images, repeats), keras_mb, 1.0, 0.0, 1.0,
+                 os.path.getsize(h5_path)))
+
+    for path in tflite_paths:
+        rss = _rss_mb()
+        model = TFLiteFeatureExtractor(path, num_threads=num_threads)
+        model_mb = _rss_mb() - rss
+        features = model.predict(images)
+        cosine = np.sum(features * reference, axis=1) / (
+            np.linalg.norm(features, axis=1) * np.linalg.norm(reference, axis=1) + 1e-12)
+        max_diff = float(np.abs(features - reference).max())
+        label_agreement = (float(np.mean(classifier.predict(features) == reference_labels))
+                           if classifier is not None else float('nan'))
+        rows.append((os.path.basename(path), *_time_predict(model, images, repeats), model_mb,
+                     float(cosine.min()), max_diff, label_agreement, os.path.getsize(path)))
+
+    print(f"\nCompared on {len(images)} images (num_threads={num_threads})")
+    print(f"{'model':<36} {'bs1 ms':>8} {'batch ms/img':>13} {'+RSS MB':>8} {'size MB':>8} "
+          f"{'min cos':>8} {'max |diff|':>11} {'labels':>7}")
+    for name, single_ms, batch_ms, mem_mb, cos, diff, agree, size in rows:
+        print(f"{name:<36} {single_ms:>8.2f} {batch_ms:>13.2f} {mem_mb:>8.1f} {size / 1024 / 1024:>8.1f} "
+              f"{cos:>8.4f} {diff:>11.2e} {agree * 100:>6.1f}%")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert and compare TFLite CNN backends")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('convert', help="Export the Keras feature extractor to TFLite")
+    p.add_argument('--h5', default=DEFAULT_H5_PATH)
+    p.add_argument('--output', default=None, help="Output path (default: next to the .h5 model)")
+    p.add_argument('--quantization', choices=QUANTIZATION_MODES, default='none')
+    p.add_argument('--samples', default=None, help="Image directory for int8 calibration")
+    p.add_argument('--num-samples', type=int, default=100)
+
+    p = sub.add_parser('compare', help="Compare TFLite models against the Keras model")
+    p.add_argument('--h5', default=DEFAULT_H5_PATH)
+    p.add_argument('--tflite', nargs='+', default=[DEFAULT_TFLITE_PATH])
+    p.add_argument('--classifier', default=os.path.join(BASE_PATH, "xgb_classifier_model.json"))
+    p.add_argument('--samples', default=None, help="Directory of sample images")
+    p.add_argument('--num-samples', type=int, default=32)
+    p.add_argument('--threads', type=int, default=None, help="TFLite interpreter threads")
+
+    args = parser.parse_args(argv)
+    if args.command == 'convert':
+        output = args.output
+        if output is None:
+            suffix = '' if args.quantization == 'none' else f'_{args.quantization}'
+            output = os.path.splitext(args.h5)[0] + suffix + '.tflite'
+        convert(args.h5, output, args.quantization, args.samples, args.num_samples)
+    else:
+        compare(args.h5, args.tflite, args.classifier, args.samples, args.num_samples, args.threads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+Tiled prediction for large field images.
+
+A drone or wide-angle greenhouse shot holds many leaves, and squashing it
+to the 224x224 model input loses the detail the CNN needs. Instead the
+image is cut into overlapping model-sized tiles. Tiles that are mostly
+background, judged by a cheap HSV vegetation mask, are skipped. The rest
+are classified in large batches.
+
+Tiles are never materialized all at once. Positions are generated lazily
+and each batch holds views into the decoded image, which the buffer pool
+normalizes straight into its float32 buffer. Peak memory is therefore the
+decoded image plus one batch. Very large JPEGs are decoded at a reduced
+scale (libjpeg DCT scaling) to keep the decoded image under ``max_pixels``.
+
+Per-tile disease scores are averaged into a coarse heatmap with one cell
+per ``stride`` pixels, so overlapping tiles vote on the cells they share.
+Like the rest of the serving path, this module needs neither TensorFlow
+nor Flask.
+"""
+import cv2
+import numpy as np
+
+from preprocessing import WIDTH, HEIGHT, jpeg_size
+
+HEALTHY = 'healthy'
+
+# OpenCV hue runs 0-180; 20-90 spans yellowing to deep green foliage, so
+# chlorotic (diseased) leaf tissue still counts as leaf
+LEAF_HSV_LOWER = np.array([20, 40, 40], dtype=np.uint8)
+LEAF_HSV_UPPER = np.array([90, 255, 255], dtype=np.uint8)
+
+_SCALED_FLAGS = ((2, cv2.IMREAD_REDUCED_COLOR_2),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (8, cv2.IMREAD_REDUCED_COLOR_8))
+
+
+def decode_for_tiling(data, max_pixels):
+    """Decode image bytes to BGR with at most ``max_pixels`` pixels.
+
+    Returns (image, scale), where ``scale`` is the decoded size over the
+    original size. JPEGs are decoded at the largest libjpeg scale that fits.
+    Other formats, or JPEGs still too large at 1/8, are resized down after
+    decoding.
+    """
+    flag, factor = cv2.IMREAD_COLOR, 1
+    size = jpeg_size(data)
+    if size is not None and size[0] * size[1] > max_pixels:
+        for factor, flag in _SCALED_FLAGS:
+            if -(-size[0] // factor) * -(-size[1] // factor) <= max_pixels:
+                break
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        raise ValueError("Could not decode image data")
+    scale = 1.0 / factor
+    height, width = img.shape[:2]
+    if height * width > max_pixels:
+        shrink = (max_pixels / (height * width)) ** 0.5
+        img = cv2.resize(img, (max(1, int(width * shrink)), max(1, int(height * shrink))),
+                         interpolation=cv2.INTER_AREA)
+        scale *= shrink
+    return img, scale
+
+
+def fit_to_tile(img, tile_width=WIDTH, tile_height=HEIGHT):
+    """Upscale ``img`` so it holds at least one whole tile; returns (image, factor)"""
+    height, width = img.shape[:2]
+    factor = max(tile_width / width, tile_height / height)
+    if factor <= 1:
+        return img, 1.0
+    size = (max(tile_width, round(width * factor)), max(tile_height, round(height * factor)))
+    return cv2.resize(img, size), factor
+
+
+def _axis_positions(length, tile, stride):
+    positions = list(range(0, length - tile + 1, stride))
+    # Align one last tile with the far edge so no strip goes unseen
+    if positions[-1] + tile < length:
+        positions.append(length - tile)
+    return positions
+
+
+def tile_positions(width, height, tile_width=WIDTH, tile_height=HEIGHT, overlap=0.25):
+    """Yield (x, y) of every tile, row by row, covering the whole image"""
+    if not 0 <= overlap < 1:
+        raise ValueError("overlap must be in [0, 1)")
+    stride_x = max(1, int(tile_width * (1 - overlap)))
+    stride_y = max(1, int(tile_height * (1 - overlap)))
+    xs = _axis_positions(width, tile_width, stride_x)
+    for y in _axis_positions(height, tile_height, stride_y):
+        for x in xs:
+            yield x, y
+
+
+def tile_count(width, height, tile_width=WIDTH, tile_height=HEIGHT, overlap=0.25):
+    """Number of tiles ``tile_positions`` yields for an image"""
+    stride_x = max(1, int(tile_width * (1 - overlap)))
+    stride_y = max(1, int(tile_height * (1 - overlap)))
+    return len(_axis_positions(width, tile_width, stride_x)) * len(_axis_positions(height, tile_height, stride_y))
+
+
+def fit_tile_budget(img, max_tiles, overlap=0.25, tile_width=WIDTH, tile_height=HEIGHT):
+    """Downscale ``img`` until it cuts into at most ``max_tiles`` tiles;
+    returns (image, factor)"""
+    height, width = img.shape[:2]
+    factor = 1.0
+    count = tile_count(width, height, tile_width, tile_height, overlap)
+    while count > max_tiles and (width > tile_width or height > tile_height):
+        # Tiles scale with area; the margin avoids creeping up on the budget
+        factor *= 0.98 * (max_tiles / count) ** 0.5
+        width = max(tile_width, int(img.shape[1] * factor))
+        height = max(tile_height, int(img.shape[0] * factor))
+        count = tile_count(width, height, tile_width, tile_height, overlap)
+    if factor == 1.0:
+        return img, 1.0
+    factor = width / img.shape[1]
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA), factor
+
+
+def leaf_fraction(tile):
+    """Fraction of a BGR tile's pixels that look like leaf tissue"""
+    hsv = cv2.cvtColor(tile, cv2.COLOR_BGR2HSV)
+    return cv2.countNonZero(cv2.inRange(hsv, LEAF_HSV_LOWER, LEAF_HSV_UPPER)) / (tile.shape[0] * tile.shape[1])
+
+
+def disease_score(disease, confidence):
+    """Estimate of P(diseased) from a tile's top class and its confidence (percent)"""
+    probability = confidence / 100.0
+    return 1.0 - probability if disease == HEALTHY else probability
+
+
+def predict_tiles(img, predict_fn, batch_size=32, overlap=0.25, min_leaf_fraction=0.15,
+                  scale=1.0, tile_width=WIDTH, tile_height=HEIGHT, max_tiles=None):
+    """Classify the leaf tiles of a decoded BGR image.
+
+    ``predict_fn`` takes a list of uint8 tiles and returns one
+    (disease, confidence, model_version) triple per tile, like
+    ``predict_prepared_batch``.
+    ``scale`` is the size of ``img`` relative to the original photo (as
+    returned by ``decode_for_tiling``); tile positions and sizes are
+    reported in original-photo pixels. An image that would cut into more
+    than ``max_tiles`` tiles is scored at a reduced scale, reported as
+    ``scale``. Returns a dict with the per-tile
+    results, a heatmap of averaged disease scores (None where no leaf tile
+    reached), a summary, and the model versions that scored the tiles in
+    the order they were first seen (more than one only if the models were
+    swapped mid-image).
+    """
+    img, upscale = fit_to_tile(img, tile_width, tile_height)
+    scale *= upscale
+    if max_tiles:
+        img, downscale = fit_tile_budget(img, max_tiles, overlap, tile_width, tile_height)
+        scale *= downscale
+    height, width = img.shape[:2]
+    stride_x = max(1, int(tile_width * (1 - overlap)))
+    stride_y = max(1, int(tile_height * (1 - overlap)))
+    rows, cols = -(-height // stride_y), -(-width // stride_x)
+    score_sum = np.zeros((rows, cols), dtype=np.float64)
+    score_count = np.zeros((rows, cols), dtype=np.int32)
+
+    tiles = []
+    versions = []
+    skipped = 0
+    pending, pending_positions = [], []
+
+    def flush():
+        results = predict_fn(pending)
+        for (x, y), (disease, confidence, version) in zip(pending_positions, results):
+            if version not in versions:
+                versions.append(version)
+            tiles.append({'x': x, 'y': y, 'disease': disease, 'confidence': round(float(confidence), 2)})
+            cells = (slice(y // stride_y, -(-(y + tile_height) // stride_y)),
+                     slice(x // stride_x, -(-(x + tile_width) // stride_x)))
+            score_sum[cells] += disease_score(disease, confidence)
+            score_count[cells] += 1
+        pending.clear()
+        pending_positions.clear()
+
+    for x, y in tile_positions(width, height, tile_width, tile_height, overlap):
+        tile = img[y:y + tile_height, x:x + tile_width]
+        if leaf_fraction(tile) < min_leaf_fraction:
+            skipped += 1
+            continue
+        pending.append(tile)
+        pending_positions.append((x, y))
+        if len(pending) >= batch_size:
+            flush()
+    if pending:
+        flush()
+
+    heatmap = np.divide(score_sum, score_count, out=np.full_like(score_sum, np.nan), where=score_count > 0)
+    if scale != 1.0:
+        for tile in tiles:
+            tile['x'] = round(tile['x'] / scale)
+            tile['y'] = round(tile['y'] / scale)
+    return {
+        'tile_size': [round(tile_width / scale), round(tile_height / scale)],
+        'tiles': tiles,
+        'heatmap': [[None if np.isnan(v) else round(float(v), 3) for v in row] for row in heatmap],
+        'heatmap_cell': [round(stride_x / scale, 2), round(stride_y / scale, 2)],
+        'summary': summarize(tiles, skipped),
+        'model_versions': versions,
+        'scale': scale,
+    }
+
+
+def summarize(tiles, skipped=0):
+    """Aggregate per-tile results into counts and an overall verdict.
+
+    The overall disease is the non-healthy class with the largest summed
+    confidence, or 'healthy' when no tile is diseased; its confidence is
+    the mean over the tiles of that class.
+    """
+    counts, weight = {}, {}
+    for tile in tiles:
+        counts[tile['disease']] = counts.get(tile['disease'], 0) + 1
+        weight[tile['disease']] = weight.get(tile['disease'], 0.0) + tile['confidence']
+    diseased = {disease: w for disease, w in weight.items() if disease != HEALTHY}
+    overall = max(diseased, key=diseased.get) if diseased else HEALTHY
+    leaf_tiles = len(tiles)
+    return {
+        'disease': overall,
+        'confidence': round(weight[overall] / counts[overall], 2) if overall in counts else 0.0,
+        'leaf_tiles': leaf_tiles,
+        'skipped_tiles': skipped,
+        'class_counts': dict(sorted(counts.items(), key=lambda item: -item[1])),
+        'diseased_fraction': round(sum(c for d, c in counts.items() if d != HEALTHY) / leaf_tiles, 3)
+        if leaf_tiles else 0.0,
+    }
@@ -0,0 +1,280 @@
+"""
+Retrain the XGBoost classifier head on cached CNN features.
+
+The CNN feature extractor rarely changes; the classifier on top of it does.
+This tool keeps the CNN features of every labelled image in a
+``FeatureStore`` (the same format and extractor versions the app writes
+with ``LEAF_FEATURE_STORE``, so features of served uploads are reused too)
+and a ``labels.tsv`` of content hash and class next to it. Each run hashes
+the images under the given folders, runs the CNN only over images whose
+features are not cached yet, and then fits ``XGBClassifier`` with the
+multi-threaded ``hist`` tree method on every labelled row in the cache.
+Labels are appended, so folders added in earlier runs stay in the training
+set; a relabelled image takes its latest class.
+
+The output directory receives ``xgb_classifier_model.json`` and
+``label_encoder_classes.npy`` in the formats ``app.py`` loads (and loses
+any ``feature_projection.npz`` left there by ``projection.py``), so pointing
+``LEAF_MODEL_DIR`` at it (or copying them over the served files, which the
+app picks up without a restart) deploys the new head.
+
+Usage:
+    python train_head.py LABELLED_DIR [LABELLED_DIR ...] [--cache head_cache] [--output-dir retrained]
+    python train_head.py LABELLED_DIR --holdout 0.1 --compare-raw
+
+LABELLED_DIR holds one sub-directory per class, named after the class
+(see ``cascade.py``). Images in folders that match no class are skipped.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cascade import find_labelled_images, match_label
+from evaluate import build_dataset
+from feature_store import FeatureStore
+from prediction_cache import content_hash, model_fingerprint
+from preprocessing import BufferPool
+from projection import PROJECTION_NAME
+
+LABELS_NAME = 'labels.tsv'
+MODEL_NAME = 'xgb_classifier_model.json'
+CLASSES_NAME = 'label_encoder_classes.npy'
+
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return content_hash(f.read())
+
+
+def scan(roots, classes, threads=8):
+    """(paths, content hashes, class names) for the labelled images under ``roots``"""
+    paths, labels, unmatched = [], [], 0
+    for root in roots:
+        for path, folder in find_labelled_images(root):
+            label = match_label(folder, classes)
+            if label is None:
+                unmatched += 1
+                continue
+            paths.append(path)
+            labels.append(label)
+    if unmatched:
+        print(f"ℹ Skipped {unmatched} images in folders that match no class")
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        keys = list(pool.map(_hash_file, paths))
+    return paths, keys, labels
+
+
+def read_labels(cache):
+    """{content hash: class} from the cache's label log; later lines win"""
+    labels = {}
+    path = os.path.join(cache, LABELS_NAME)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                key, _, label = line.rstrip('\n').partition('\t')
+                if label:
+                    labels[key] = label
+    return labels
+
+
+def append_labels(cache, keys, labels, known):
+    """Log labels that are new or changed; returns how many were written"""
+    current = {}
+    conflicts = 0
+    for key, label in zip(keys, labels):
+        conflicts += current.get(key, label) != label
+        current[key] = label
+    if conflicts:
+        print(f"ℹ {conflicts} images appear under more than one class; the last folder wins")
+    changed = [(key, label) for key, label in current.items() if known.get(key) != label]
+    if changed:
+        with open(os.path.join(cache, LABELS_NAME), 'a', encoding='utf-8') as f:
+            f.writelines(f"{key}\t{label}\n" for key, label in changed)
+        known.update(changed)
+    return len(changed)
+
+
+def open_cache(cache, leaf_app):
+    """(feature store, id of the app's current CNN extractor version)"""
+    # Same extractor version naming as the app's own feature store
+    backend = leaf_app.app.config['CNN_BACKEND']
+    cnn_path = leaf_app.app.config['TFLITE_MODEL_PATH'] if backend == 'tflite' else leaf_app.CNN_MODEL_PATH
+    store = FeatureStore(cache)
+    version = store.register_version(f"{backend}:{model_fingerprint([cnn_path])}", backend=backend,
+                                     model=os.path.basename(cnn_path))
+    return store, version
+
+
+def load_training_set(store, version, labels):
+    """(keys, features, class names) of every labelled image with cached features"""
+    labelled_keys = sorted(labels)
+    keys = [key for key, row in zip(labelled_keys, store.lookup(labelled_keys, version)) if row >= 0]
+    classes = np.array([labels[key] for key in keys], dtype=object)
+    if len(set(classes)) < 2:
+        raise ValueError("Need cached features for at least two classes to train")
+    if len(keys) < len(labelled_keys):
+        print(f"ℹ {len(labelled_keys) - len(keys)} labelled images have no features from this CNN "
+              f"(unreadable, or cached under another extractor version); left out")
+    return keys, store.get(keys, version), classes
+
+
+def extract(models, paths, keys, store=None, version=None, batch_size=32, parallel=0, prefetch=0):
+    """Run the CNN over ``paths`` and append the features to ``store``.
+
+    With no store the features are computed and discarded, which is what
+    ``--compare-raw`` times. Returns (rows extracted, seconds).
+    """
+    pool = BufferPool(batch_size, max_buffers=1)
+    extracted = 0
+    started = time.perf_counter()
+    # Batches carry row numbers, since unreadable images are dropped on the way
+    for images, rows in build_dataset(paths, np.arange(len(paths), dtype=np.int32), batch_size, parallel, prefetch):
+        with pool.batch(images.numpy()) as inputs:
+            features = models.cnn.predict(inputs, verbose=0)
+        if store is not None:
+            store.append([keys[row] for row in rows.numpy()], features, version)
+        extracted += len(features)
+    return extracted, time.perf_counter() - started
+
+
+def train(features, labels, n_estimators=200, max_depth=6, learning_rate=0.1, threads=0, seed=0):
+    """Fit the classifier head; returns (classifier, class names)"""
+    from sklearn.preprocessing import LabelEncoder
+    from xgboost import XGBClassifier
+
+    encoder = LabelEncoder()
+    y = encoder.fit_transform(labels)
+    classifier = XGBClassifier(tree_method='hist', n_estimators=n_estimators, max_depth=max_depth,
+                               learning_rate=learning_rate, n_jobs=threads or os.cpu_count(),
+                               random_state=seed)
+    classifier.fit(features, y)
+    return classifier, encoder.classes_
+
+
+def retrain(roots, cache, output_dir, batch_size=32, parallel=0, prefetch=0, holdout=0.0,
+            compare_raw=False, threads=0, seed=0, **params):
+    """Bring the cache up to date with ``roots``, retrain and write the new head"""
+    import app as leaf_app
+
+    timings = {}
+    started = time.perf_counter()
+    models = leaf_app.registry.get()
+    classes = [str(c) for c in models.label_encoder.classes_]
+    timings['load_models'] = time.perf_counter() - started
+
+    store, version = open_cache(cache, leaf_app)
+
+    started = time.perf_counter()
+    paths, keys, labels = scan(roots, classes)
+    timings['hash'] = time.perf_counter() - started
+    known = read_labels(cache)
+    relabelled = append_labels(cache, keys, labels, known)
+
+    # The same image may sit in several folders; extract it once
+    missing, seen = [], set()
+    for i in np.flatnonzero(store.lookup(keys, version) < 0):
+        if keys[i] not in seen:
+            seen.add(keys[i])
+            missing.append(int(i))
+    print(f"ℹ {len(paths)} labelled images ({len(set(keys))} distinct), extracting features for "
+          f"{len(missing)} not yet cached; {relabelled} labels new or changed")
+    extracted, timings['extract'] = extract(models, [paths[i] for i in missing], [keys[i] for i in missing],
+                                            store, version, batch_size, parallel, prefetch)
+
+    started = time.perf_counter()
+    train_keys, features, train_labels = load_training_set(store, version, known)
+    timings['load_features'] = time.perf_counter() - started
+
+    report = {'images': len(train_keys), 'extracted': extracted, 'feature_dim': int(features.shape[1])}
+    if holdout:
+        rng = np.random.default_rng(seed)
+        test = rng.random(len(train_keys)) < holdout
+        classifier, class_names = train(features[~test], train_labels[~test], threads=threads, seed=seed, **params)
+        predicted = np.asarray(class_names)[classifier.predict(features[test])]
+        report['holdout_images'] = int(test.sum())
+        report['holdout_accuracy'] = round(float(np.mean(predicted == train_labels[test])), 4) if test.any() else None
+
+    started = time.perf_counter()
+    classifier, class_names = train(features, train_labels, threads=threads, seed=seed, **params)
+    timings['train'] = time.perf_counter() - started
+
+    os.makedirs(output_dir, exist_ok=True)
+    # A projection left by projection.py fit would be loaded with this head,
+    # which is trained on raw CNN features
+    stale = os.path.join(output_dir, PROJECTION_NAME)
+    if os.path.exists(stale):
+        os.remove(stale)
+        print(f"ℹ Removed {stale}; the new head is trained on raw CNN features")
+    classifier.save_model(os.path.join(output_dir, MODEL_NAME))
+    np.save(os.path.join(output_dir, CLASSES_NAME), np.array(class_names, dtype=object), allow_pickle=True)
+    report['classes'] = [str(c) for c in class_names]
+
+    # What retraining used to cost: the CNN over every training image, then
+    # the same fit. Images from earlier runs may no longer be on disk, so the
+    # CNN rate is measured on this run's images and scaled up.
+    if compare_raw:
+        count, seconds = extract(models, paths, keys, None, None, batch_size, parallel, prefetch)
+        report['raw_rate_source'] = 'measured'
+    else:
+        count, seconds = extracted, timings['extract']
+        report['raw_rate_source'] = 'estimated from this run'
+    if count:
+        timings['raw_extract'] = seconds / count * len(train_keys)
+    report['seconds'] = {name: round(value, 3) for name, value in timings.items()}
+    return report
+
+
+def print_report(report, output_dir):
+    seconds = report['seconds']
+    print(f"✓ Trained on {report['images']} images ({report['feature_dim']} features, "
+          f"{len(report['classes'])} classes) -> {output_dir}")
+    if 'holdout_accuracy' in report:
+        print(f"  hold-out accuracy: {report['holdout_accuracy']:.2%} on {report['holdout_images']} images")
+    print(f"\n{'step':<16} {'seconds':>9}")
+    for name in ('load_models', 'hash', 'extract', 'load_features', 'train'):
+        print(f"{name:<16} {seconds[name]:>9.2f}")
+    cached = seconds['hash'] + seconds['extract'] + seconds['load_features'] + seconds['train']
+    print(f"\nFrom the cache: {cached:.2f}s (extracted {report['extracted']} new images)")
+    if 'raw_extract' in seconds:
+        total = seconds['raw_extract'] + seconds['train']
+        print(f"From raw images: {total:.2f}s (CNN rate {report['raw_rate_source']}), "
+              f"{total / max(cached, 1e-9):.1f}x longer")
+    else:
+        print("ℹ Nothing was extracted this run; pass --compare-raw to time retraining from raw images")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Retrain the XGBoost head on cached CNN features")
+    parser.add_argument('labelled_dirs', nargs='+')
+    parser.add_argument('--cache', default='head_cache', help="Feature cache directory (a feature store)")
+    parser.add_argument('--output-dir', default='retrained')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--parallel', type=int, default=0, help="Decode threads; 0 lets tf.data tune it")
+    parser.add_argument('--prefetch', type=int, default=0, help="Batches read ahead; 0 lets tf.data tune it")
+    parser.add_argument('--threads', type=int, default=0, help="XGBoost threads; 0 uses every core")
+    parser.add_argument('--n-estimators', type=int, default=200)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--learning-rate', type=float, default=0.1)
+    parser.add_argument('--holdout', type=float, default=0.0, help="Fraction held out to report accuracy")
+    parser.add_argument('--compare-raw', action='store_true',
+                        help="Also time the CNN over every image, as retraining without the cache would")
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    for root in args.labelled_dirs:
+        if not os.path.isdir(root):
+            print(f"✗ {root} is not a directory")
+            return 1
+    report = retrain(args.labelled_dirs, args.cache, args.output_dir, args.batch_size, args.parallel,
+                     args.prefetch, args.holdout, args.compare_raw, args.threads, args.seed,
+                     n_estimators=args.n_estimators, max_depth=args.max_depth, learning_rate=args.learning_rate)
+    print_report(report, args.output_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
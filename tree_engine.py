@@ -0,0 +1,192 @@
+"""
+Vectorized NumPy evaluation of an XGBoost tree ensemble.
+
+Loads ``xgb_classifier_model.json`` into flat arrays (split feature,
+threshold, children, leaf value) and walks every tree for a whole batch
+at once, one tree level per step, without going through the XGBoost
+booster.
+
+Usage:
+    python tree_engine.py [MODEL_JSON]    # check against XGBoost and benchmark
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+def _parse_base_score(value):
+    value = value.strip()
+    if value.startswith('['):
+        return np.array([float(v) for v in value.strip('[]').split(',')], dtype=np.float64)
+    return np.array([float(value)], dtype=np.float64)
+
+
+class TreeEnsemble:
+    """Flat-array form of a gbtree model for binary or multi-class objectives"""
+
+    def __init__(self, split_index, threshold, left, right, default_left, value,
+                 roots, tree_class, n_classes, base_margin, objective, max_depth, n_features):
+        self.split_index = split_index
+        self.threshold = threshold
+        self.default_left = default_left
+        self.value = value
+        self.roots = roots
+        self.n_classes = n_classes
+        self.objective = objective
+        self.max_depth = max_depth
+        self.n_features = n_features
+        self.base_margin = base_margin
+        # children[2 * i] is the left child of node i, children[2 * i + 1] the right
+        self.children = np.stack([left, right], axis=1).ravel()
+
+        # Leaf sums are scattered into per-class margins with one matmul
+        self.class_matrix = np.zeros((len(roots), max(n_classes, 1)), dtype=np.float32)
+        self.class_matrix[np.arange(len(roots)), tree_class] = 1.0
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            model = json.load(f)
+        learner = model['learner']
+        booster = learner['gradient_booster']
+        if booster.get('name') != 'gbtree':
+            raise ValueError(f"Unsupported booster {booster.get('name')!r}; only gbtree is supported")
+        objective = learner['objective']['name']
+        params = learner['learner_model_param']
+        n_classes = int(params.get('num_class', '0'))
+        n_features = int(params['num_feature'])
+        trees = booster['model']['trees']
+        tree_info = booster['model']['tree_info']
+
+        split_index, threshold, left, right, default_left, value, roots = [], [], [], [], [], [], []
+        max_depth = 0
+        offset = 0
+        for tree in trees:
+            if any(tree.get('split_type', [])):
+                raise ValueError("Categorical splits are not supported")
+            lc = np.asarray(tree['left_children'], dtype=np.int64)
+            rc = np.asarray(tree['right_children'], dtype=np.int64)
+            n = len(lc)
+            idx = np.arange(n)
+            is_leaf = lc == -1
+            # Leaves point at themselves so extra steps past a leaf are no-ops
+            left.append(np.where(is_leaf, idx, lc) + offset)
+            right.append(np.where(is_leaf, idx, rc) + offset)
+            split_index.append(np.where(is_leaf, 0, tree['split_indices']))
+            threshold.append(np.asarray(tree['split_conditions'], dtype=np.float32))
+            default_left.append(np.asarray(tree['default_left'], dtype=bool))
+            # XGBoost keeps leaf values in split_conditions
+            value.append(np.where(is_leaf, np.asarray(tree['split_conditions'], dtype=np.float32), 0.0))
+            roots.append(offset)
+            max_depth = max(max_depth, _depth(lc, rc))
+            offset += n
+
+        base = _parse_base_score(params['base_score'])
+        if objective.startswith('binary:logistic') or objective == 'binary:logitraw':
+            if objective != 'binary:logitraw':
+                base = np.log(base / (1.0 - base))
+        elif objective.startswith('multi:'):
+            if base.size == 1:
+                base = np.repeat(base, n_classes)
+        else:
+            raise ValueError(f"Unsupported objective {objective!r}")
+
+        return cls(
+            split_index=np.concatenate(split_index).astype(np.int32),
+            threshold=np.concatenate(threshold),
+            left=np.concatenate(left).astype(np.int32),
+            right=np.concatenate(right).astype(np.int32),
+            default_left=np.concatenate(default_left),
+            value=np.concatenate(value).astype(np.float32),
+            roots=np.asarray(roots, dtype=np.int32),
+            tree_class=np.asarray(tree_info, dtype=np.int64),
+            n_classes=n_classes,
+            base_margin=base.astype(np.float32),
+            objective=objective,
+            max_depth=max_depth,
+            n_features=n_features,
+        )
+
+    def leaf_values(self, X):
+        """Leaf value reached in every tree, shape (N, n_trees)"""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected features of shape (N, {self.n_features}), got {X.shape}")
+        flat_X = X.ravel()
+        row_offset = (np.arange(X.shape[0], dtype=np.int64) * X.shape[1])[:, None]
+        node = np.broadcast_to(self.roots, (X.shape[0], len(self.roots))).copy()
+        missing_values = np.isnan(flat_X).any()
+        for _ in range(self.max_depth):
+            x = np.take(flat_X, row_offset + np.take(self.split_index, node))
+            # NaN compares false, so missing values go right unless default_left
+            go_right = ~(x < np.take(self.threshold, node))
+            if missing_values:
+                go_right &= ~(np.isnan(x) & np.take(self.default_left, node))
+            node = np.take(self.children, 2 * node + go_right)
+        return np.take(self.value, node)
+
+    def margin(self, X):
+        """Raw per-class scores, shape (N, n_classes) or (N, 1) for binary"""
+        return self.leaf_values(X) @ self.class_matrix + self.base_margin
+
+    def predict_proba(self, X):
+        margin = self.margin(X).astype(np.float64)
+        if self.n_classes > 1:
+            margin -= margin.max(axis=1, keepdims=True)
+            np.exp(margin, out=margin)
+            margin /= margin.sum(axis=1, keepdims=True)
+            return margin
+        positive = 1.0 / (1.0 + np.exp(-margin[:, 0]))
+        return np.stack([1.0 - positive, positive], axis=1)
+
+    def predict(self, X):
+        return np.argmax(self.predict_proba(X), axis=1)
+
+
+def _depth(left, right):
+    depth = np.zeros(len(left), dtype=np.int64)
+    for i in range(len(left)):
+        if left[i] != -1:
+            depth[left[i]] = depth[right[i]] = depth[i] + 1
+    return int(depth.max()) + 1
+
+
+def check_and_benchmark(model_path, batch_sizes=(1, 32, 1024), repeats=20, atol=1e-5):
+    """Compare against XGBoost's predict_proba and time both engines"""
+    from xgboost import XGBClassifier
+
+    engine = TreeEnsemble.from_json(model_path)
+    reference = XGBClassifier()
+    reference.load_model(model_path)
+
+    rng = np.random.default_rng(0)
+    X = rng.random((max(batch_sizes), engine.n_features), dtype=np.float32)
+    X[rng.random(X.shape) < 0.01] = np.nan
+    diff = np.abs(engine.predict_proba(X) - reference.predict_proba(X)).max()
+    agree = np.mean(engine.predict(X) == reference.predict(X))
+    status = "✓" if diff <= atol and agree == 1.0 else "✗"
+    print(f"{status} max |p_numpy - p_xgboost| = {diff:.2e} (tolerance {atol:.0e}), "
+          f"label agreement {agree * 100:.2f}%")
+
+    print(f"\n{'batch':>6} {'xgboost ms':>12} {'numpy ms':>10} {'speedup':>8}")
+    for batch_size in batch_sizes:
+        batch = X[:batch_size]
+        timings = []
+        for fn in (reference.predict_proba, engine.predict_proba):
+            fn(batch)
+            started = time.perf_counter()
+            for _ in range(repeats):
+                fn(batch)
+            timings.append((time.perf_counter() - started) * 1000 / repeats)
+        print(f"{batch_size:>6} {timings[0]:>12.3f} {timings[1]:>10.3f} {timings[0] / timings[1]:>7.2f}x")
+    return diff <= atol and agree == 1.0
+
+
+if __name__ == '__main__':
+    default_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "xgb_classifier_model.json")
+    ok = check_and_benchmark(sys.argv[1] if len(sys.argv) > 1 else default_path)
+    sys.exit(0 if ok else 1)
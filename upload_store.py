@@ -0,0 +1,241 @@
+"""
+Content-addressed storage for uploaded images.
+
+Every upload is stored once, as ``<root>/<ab>/<sha256>.<ext>`` where ``ab``
+is the first two hex digits of the hash, so byte-identical uploads share a
+file and no directory grows past a few thousand entries. Re-uploading an
+image refreshes its modification time, which is what the retention policy
+looks at: files older than ``max_age_seconds`` are removed, then the
+oldest files go until the store fits in ``max_bytes``.
+
+Because a name is a hash of the content, it never changes meaning, which
+is what lets ``/uploads/<name>`` be served with a strong ETag and an
+immutable, year-long cache lifetime.
+
+Usage:
+    python upload_store.py migrate [--root uploads]   # move legacy flat files in
+    python upload_store.py stats [--root uploads]
+    python upload_store.py evict [--root uploads] [--max-bytes N] [--max-age-days N]
+"""
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+
+from prediction_cache import content_hash
+from upload_writer import write_file
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+EXTENSIONS = {'png': 'png', 'jpg': 'jpg', 'jpeg': 'jpg', 'gif': 'gif', 'bmp': 'bmp'}
+NAME_PATTERN = re.compile(r'^([0-9a-f]{64})\.(png|jpg|gif|bmp)$')
+
+
+def normalize_extension(filename):
+    """Canonical extension for an upload filename ('jpeg' becomes 'jpg')"""
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return EXTENSIONS.get(ext, 'jpg')
+
+
+class UploadStore:
+    def __init__(self, root, max_bytes=0, max_age_seconds=0):
+        self.root = root
+        self.max_bytes = int(max_bytes or 0)
+        self.max_age_seconds = float(max_age_seconds or 0)
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._evictor = None
+        self.stored = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+    def name_for(self, data, filename):
+        """Content-addressed name for ``data`` uploaded as ``filename``"""
+        return f"{content_hash(data)}.{normalize_extension(filename)}"
+
+    def path_for(self, name):
+        """Filesystem path for a stored name, or None if the name is not one"""
+        match = NAME_PATTERN.match(name)
+        if match is None:
+            return None
+        return os.path.join(self.root, match.group(1)[:2], name)
+
+    def put(self, data, filename, writer=None, digest=None):
+        """Store ``data`` unless an identical file exists; returns its name.
+
+        With a ``BackgroundWriter`` the name is returned at once and every
+        filesystem call happens on the writer thread; until the write lands
+        the bytes can be read back with ``pending``. None is returned if
+        the writer's queue is full. ``digest`` is the SHA-256 hex of
+        ``data`` when already known.
+        """
+        name = f"{digest or content_hash(data)}.{normalize_extension(filename)}"
+        path = self.path_for(name)
+        if writer is None:
+            self._store(path, data)
+        elif not writer.submit(path, data, self._store):
+            return None
+        return name
+
+    def pending(self, name, writer):
+        """Bytes of a stored name that ``writer`` has not written yet, or None"""
+        path = self.path_for(name)
+        if path is None or writer is None:
+            return None
+        return writer.pending(path)
+
+    def _store(self, path, data):
+        try:
+            # Refresh the age of an existing copy instead of writing another
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        else:
+            with self._lock:
+                self.deduplicated += 1
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, data)
+        with self._lock:
+            self.stored += 1
+
+    def _entries(self):
+        """(mtime, size, path) for every stored file"""
+        entries = []
+        with os.scandir(self.root) as shards:
+            for shard in shards:
+                if not (shard.is_dir() and len(shard.name) == 2):
+                    continue
+                with os.scandir(shard.path) as files:
+                    for entry in files:
+                        if NAME_PATTERN.match(entry.name):
+                            try:
+                                stat = entry.stat()
+                            except FileNotFoundError:
+                                continue
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self, now=None):
+        """Apply the retention policy once; returns (files, bytes) removed"""
+        if not (self.max_bytes or self.max_age_seconds):
+            return 0, 0
+        now = time.time() if now is None else now
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = removed_bytes = 0
+        for mtime, size, path in entries:
+            too_old = self.max_age_seconds and now - mtime > self.max_age_seconds
+            too_big = self.max_bytes and total > self.max_bytes
+            if not (too_old or too_big):
+                # Entries are oldest first, so nothing later is too old either
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+            removed_bytes += size
+        with self._lock:
+            self.evicted += removed
+            self.evicted_bytes += removed_bytes
+        return removed, removed_bytes
+
+    def start_eviction(self, interval=300.0):
+        """Apply the retention policy every ``interval`` seconds on a daemon thread"""
+        if self._evictor is not None or not (self.max_bytes or self.max_age_seconds):
+            return self._evictor
+
+        def run():
+            while True:
+                try:
+                    self.evict()
+                except OSError as e:
+                    print(f"✗ Warning: upload eviction failed: {e}")
+                time.sleep(interval)
+
+        self._evictor = threading.Thread(target=run, name="upload-evictor", daemon=True)
+        self._evictor.start()
+        return self._evictor
+
+    def migrate(self, legacy_dir=None):
+        """Move flat, timestamp-named files from ``legacy_dir`` into the store.
+
+        Files keep their modification time so retention treats them by
+        their real age; duplicates are deleted. Returns a summary dict.
+        """
+        legacy_dir = legacy_dir or self.root
+        moved = duplicates = skipped = 0
+        for entry in sorted(os.scandir(legacy_dir), key=lambda e: e.name):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            ext = entry.name.rsplit('.', 1)[-1].lower() if '.' in entry.name else ''
+            if ext not in EXTENSIONS:
+                skipped += 1
+                continue
+            with open(entry.path, 'rb') as f:
+                data = f.read()
+            mtime = entry.stat().st_mtime
+            path = self.path_for(self.name_for(data, entry.name))
+            if os.path.exists(path):
+                os.utime(path, (mtime, max(mtime, os.path.getmtime(path))))
+                os.remove(entry.path)
+                duplicates += 1
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(entry.path, path)
+            os.utime(path, (mtime, mtime))
+            moved += 1
+        return {'moved': moved, 'duplicates_removed': duplicates, 'skipped': skipped}
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                'files': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'max_age_seconds': self.max_age_seconds,
+                'stored': self.stored,
+                'deduplicated': self.deduplicated,
+                'evicted': self.evicted,
+                'evicted_bytes': self.evicted_bytes,
+            }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the content-addressed upload store")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('migrate', help="Move legacy flat uploads into the store")
+    p.add_argument('--root', default=DEFAULT_ROOT)
+    p.add_argument('--legacy', default=None, help="Directory of legacy files (default: the store root)")
+
+    p = sub.add_parser('stats', help="Show file count and size")
+    p.add_argument('--root', default=DEFAULT_ROOT)
+
+    p = sub.add_parser('evict', help="Apply a retention policy once")
+    p.add_argument('--root', default=DEFAULT_ROOT)
+    p.add_argument('--max-bytes', type=int, default=0)
+    p.add_argument('--max-age-days', type=float, default=0)
+
+    args = parser.parse_args(argv)
+    if args.command == 'migrate':
+        summary = UploadStore(args.root).migrate(args.legacy)
+        print(f"✓ Moved {summary['moved']} files, removed {summary['duplicates_removed']} duplicates, "
+              f"skipped {summary['skipped']}")
+    elif args.command == 'stats':
+        for key, value in UploadStore(args.root).stats().items():
+            print(f"{key:>16}: {value}")
+    else:
+        store = UploadStore(args.root, args.max_bytes, args.max_age_days * 86400)
+        files, size = store.evict()
+        print(f"✓ Removed {files} files ({size / 1024 / 1024:.1f} MB)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
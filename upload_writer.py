@@ -0,0 +1,92 @@
+"""
+Background persistence of uploaded images.
+
+Keeps disk writes off the request thread: handlers hand the raw upload
+bytes to a writer thread and carry on with the prediction. Until a write
+lands its bytes stay readable through ``pending``, so an upload can be
+served as soon as its name is handed out.
+"""
+import atexit
+import os
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """Write (path, bytes) pairs to disk on a daemon thread.
+
+    The queue is bounded so a slow disk cannot make memory grow without
+    limit; when it is full new uploads are dropped and counted.
+    """
+
+    def __init__(self, max_pending=256):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name="upload-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, path, data, write=None):
+        """Queue ``data`` to be written to ``path``; returns False if dropped.
+
+        ``write(path, data)`` does the write on the writer thread and
+        defaults to ``write_file``. A path that is already queued is not
+        queued again.
+        """
+        with self._lock:
+            if path in self._pending:
+                return True
+            try:
+                self._queue.put_nowait((path, data, write or write_file))
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._pending[path] = data
+            return True
+
+    def pending(self, path):
+        """Bytes queued for ``path`` that are not on disk yet, or None"""
+        with self._lock:
+            return self._pending.get(path)
+
+    def flush(self):
+        """Block until every queued write has finished"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            path, data, write = self._queue.get()
+            try:
+                write(path, data)
+                with self._lock:
+                    self.written += 1
+            except OSError as e:
+                print(f"✗ Warning: could not save upload {path}: {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                # Only forget the bytes once the file is there to be served
+                with self._lock:
+                    self._pending.pop(path, None)
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+
+def write_file(path, data):
+    """Write bytes atomically so readers never see a partial image"""
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)